@@ -1,17 +1,32 @@
+import asyncio
+import time
 from datetime import datetime, timedelta, timezone
+from io import BytesIO
 
 import disnake
 from disnake.ext import commands, tasks
 from PIL import Image
 
 from main import tracked_templates
-from utils.discord_utils import get_image_url, image_to_file
+from utils.discord_utils import get_image_url
 from utils.log import get_logger
-from utils.setup import db_servers, db_stats, db_templates, db_users, stats, ws_client
+from utils.setup import (
+    db_servers,
+    db_stats,
+    db_templates,
+    db_users,
+    pixel_journal,
+    snapshot_store,
+    stats,
+    ws_client,
+)
 from utils.time_converter import local_to_utc
 
 logger = get_logger("clock")
 
+# maximum number of snapshots sent at the same time
+SNAPSHOT_SEND_CONCURRENCY = 5
+
 
 class Clock(commands.Cog):
     """A class used to manage background periodic tasks.
@@ -46,13 +61,20 @@ class Clock(commands.Cog):
     async def before_update_stats(self):
         await self.bot.wait_until_ready()
 
+        # index the pxls names for the autocomplete
+        try:
+            await db_stats.load_name_index()
+        except Exception:
+            logger.exception("Unexpected error in 'load_name_index'")
+
         # update the data on startup
         try:
             await self._update_stats_data()
         except Exception:
             logger.exception("Unexpected error in 'update_stats_data'")
 
-        # start the websocket to update the board
+        # start the websocket to update the board and the templates progress
+        ws_client.add_pixel_listener(tracked_templates.on_pixel)
         ws_client.start()
 
         # load the templates from the database
@@ -129,6 +151,13 @@ class Clock(commands.Cog):
             ws_client.resume()
             return
 
+        # track the templates progress on the new board
+        if tracked_templates.combo is not None:
+            try:
+                tracked_templates.update_all_progress()
+            except Exception:
+                logger.exception("Couldn't update the templates progress:")
+
         # save the color stats
         if record_id:
             try:
@@ -138,6 +167,11 @@ class Clock(commands.Cog):
                 logger.exception("Couldn't save color stats:")
 
         ws_client.resume()
+        latency, max_latency = ws_client.get_apply_latency()
+        logger.debug(
+            f"Websocket: {ws_client.get_message_rate():.1f} messages/s, "
+            f"apply latency: {latency * 1000:.0f}ms (max: {max_latency * 1000:.0f}ms)"
+        )
 
         # send snapshots
         try:
@@ -227,33 +261,75 @@ class Clock(commands.Cog):
                         pass
 
     async def send_snapshots(self):
-        """Send snapshots for the servers where a channel is set"""
+        """Save a snapshot in the local store and send it for the servers where a
+        channel is set"""
+        snapshot_time = datetime.now(timezone.utc)
+        canvas_code = await stats.get_canvas_code()
+        with stats.board_lock:
+            board_array = stats.board_array.copy()
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                None,
+                snapshot_store.save,
+                canvas_code,
+                snapshot_time.replace(tzinfo=None),
+                board_array,
+            )
+        except Exception:
+            logger.exception("Couldn't save the snapshot in the store:")
+
         channels = await db_servers.get_all_snapshots_channels()
         if not channels:
             return
-        snapshot_saved = False
-        array = stats.palettize_array(stats.board_array)
-        board_img = Image.fromarray(array)
-        snapshot_time = datetime.now(timezone.utc)
+
+        # encode the snapshot once for all the channels
+        start = time.perf_counter()
+
+        def encode_snapshot() -> bytes:
+            board_img = Image.fromarray(stats.palettize_array(board_array))
+            with BytesIO() as image_binary:
+                board_img.save(image_binary, "PNG")
+                return image_binary.getvalue()
+
+        png_bytes = await asyncio.get_running_loop().run_in_executor(
+            None, encode_snapshot
+        )
+        encode_time = time.perf_counter() - start
         filename = f"snapshot_{snapshot_time.strftime('%FT%H%M')}.png"
 
-        for channel_id in channels:
+        snapshot_saved = False
+        # disnake waits for the rate limits of each channel, the semaphore keeps
+        # the sends from hitting the global rate limit
+        semaphore = asyncio.Semaphore(SNAPSHOT_SEND_CONCURRENCY)
+
+        async def send_snapshot(channel_id) -> bool:
+            nonlocal snapshot_saved
             try:
                 channel = self.bot.get_channel(int(channel_id))
                 embed = disnake.Embed(title="Canvas Snapshot", color=0x66C5CC)
                 embed.timestamp = snapshot_time
-                file = await image_to_file(board_img, filename, embed)
-                m = await channel.send(file=file, embed=embed)
+                embed.set_image(url=f"attachment://{filename}")
+                file = disnake.File(BytesIO(png_bytes), filename=filename)
+                async with semaphore:
+                    m = await channel.send(file=file, embed=embed)
             except Exception:
-                continue
-            else:
-                if not snapshot_saved:
-                    await db_stats.save_snapshot(
-                        snapshot_time.replace(tzinfo=None),
-                        await stats.get_canvas_code(),
-                        get_image_url(m.embeds[0].image),
-                    )
-                    snapshot_saved = True
+                return False
+            if not snapshot_saved:
+                snapshot_saved = True
+                await db_stats.save_snapshot(
+                    snapshot_time.replace(tzinfo=None),
+                    canvas_code,
+                    get_image_url(m.embeds[0].image),
+                )
+            return True
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*[send_snapshot(c) for c in channels])
+        logger.debug(
+            f"Snapshot sent to {sum(results)}/{len(channels)} channels "
+            f"(encode: {encode_time:.2f}s, fan-out: {time.perf_counter() - start:.2f}s, "
+            f"size: {len(png_bytes) / 2**20:.1f} MiB)"
+        )
 
     async def create_record(self):
         # get the 'last updated' datetime and its timezone
@@ -322,9 +398,24 @@ class Clock(commands.Cog):
 
     async def update_boards(self):
         # update the canvas boards
-        await stats.fetch_board()
-        await stats.fetch_virginmap()
-        await stats.fetch_placemap()
+        fetch_time = time.time()
+        await asyncio.gather(
+            stats.fetch_board(), stats.fetch_virginmap(), stats.fetch_placemap()
+        )
+        # the pixels received since the fetch are replayed on the keyframe
+        canvas_code = await stats.get_canvas_code()
+        with stats.board_lock:
+            board_array, force = pixel_journal.copy_keyframe(
+                canvas_code, stats.board_array
+            )
+        await asyncio.get_running_loop().run_in_executor(
+            None,
+            pixel_journal.save_keyframe,
+            canvas_code,
+            board_array,
+            fetch_time,
+            force,
+        )
 
     async def update_template_stats(self):
         """Update all the tracked templates"""
@@ -337,19 +428,22 @@ class Clock(commands.Cog):
                 # await db_templates.delete_template(temp)
                 tracked_templates.list.remove(temp)
                 logger.info(f"Template '{name}' deleted. Reason: new canvas code")
-                continue
-            progress = temp.update_progress()
-            await db_templates.create_template_stat(temp, dt, progress)
-        # update the combo and save its progress
+        # update the combo and the progress of all the templates at once
         tracked_templates.update_combo(self.bot.user.id, canvas_code)
-        combo_progress = tracked_templates.combo.update_progress()
-        if (
-            await db_templates.create_combo_stat(
-                tracked_templates.combo, dt, combo_progress
-            )
-            is None
-        ):
+        combo_progress = tracked_templates.update_all_progress()
+        template_stats = [
+            (temp.id, dt, temp.current_progress)
+            for temp in tracked_templates.list
+            if temp.id is not None
+        ]
+        combo_id = await db_templates.get_combo_id(tracked_templates.combo)
+        if combo_id is None:
             logger.warning("Combo stats could not saved.")
+        else:
+            template_stats.append((combo_id, dt, combo_progress))
+
+        # save all the progress in a single transaction
+        await db_templates.create_template_stats(template_stats)
 
 
 def setup(bot: commands.Bot):
@@ -1,6 +1,7 @@
 import asyncio
 import os
 import time
+from io import BytesIO
 
 import disnake
 import numpy as np
@@ -19,8 +20,10 @@ from utils.log import get_logger
 from utils.pxls.archives import (
     check_canvas_code,
     check_key,
+    get_canvas_heatmap,
     get_canvas_image,
     get_user_placemap,
+    shutdown_hash_pool,
 )
 from utils.setup import PXLS_URL, db_canvas, db_users, stats
 
@@ -82,6 +85,9 @@ class Placemap(commands.Cog):
         self.bot: commands.Bot = bot
         self.cd = commands.CooldownMapping.from_cooldown(1, 30, commands.BucketType.user)
 
+    def cog_unload(self):
+        shutdown_hash_pool()
+
     @commands.slash_command(name="placemap")
     async def _placemap(
         self,
@@ -236,6 +242,84 @@ class Placemap(commands.Cog):
             view.message = await ctx.original_message()
         self.cd.get_bucket(ctx).reset()
 
+    @commands.slash_command(name="heatmap")
+    async def _heatmap(
+        self,
+        inter: disnake.AppCmdInter,
+        canvas_code: str = commands.Param(
+            name="canvas-code", autocomplete=autocomplete_log_canvases
+        ),
+    ):
+        """Get the heatmap of the pixels placed on a given canvas.
+
+        Parameters
+        ----------
+        canvas_code: The canvas code for which you want to see the heatmap.
+        """
+        await inter.response.defer()
+        await self.heatmap(inter, canvas_code)
+
+    @commands.command(
+        name="heatmap",
+        usage="<canvas code>",
+        description="Get the heatmap of the pixels placed on a given canvas.",
+    )
+    async def p_heatmap(self, ctx, *, canvas_code):
+        async with ctx.typing():
+            await self.heatmap(ctx, canvas_code)
+
+    async def heatmap(self, ctx, canvas_code_input):
+        # check cooldown
+        bucket = self.cd.get_bucket(ctx)
+        retry_after = bucket.get_retry_after()
+        if retry_after:
+            raise commands.CommandOnCooldown(bucket, retry_after, self.cd.type)
+
+        canvas_code = check_canvas_code(canvas_code_input)
+        if canvas_code is None:
+            return await ctx.send(
+                f":x: The given canvas code `{canvas_code_input}` is invalid."
+            )
+
+        canvas_codes = await db_canvas.get_logs_canvases()
+        if canvas_code not in canvas_codes:
+            return await ctx.send(
+                ":x: This canvas code is invalid or doesn't have logs yet."
+            )
+
+        self.cd.update_rate_limit(ctx)
+        start = time.time()
+        try:
+            image_bytes, top_list, total = await get_canvas_heatmap(canvas_code)
+        except Exception:
+            logger.exception(f"Error while generating c{canvas_code} heatmap")
+            return await ctx.send(
+                embed=disnake.Embed(
+                    color=disnake.Color.red(),
+                    description=":x: An error occurred while generating the heatmap.",
+                )
+            )
+        end = time.time()
+
+        top_text = "\n".join(
+            f"**{i+1}.** `({x}, {y})`: `{format_number(placed)}` pixels"
+            for i, (x, y, placed) in enumerate(top_list)
+        )
+        embed = disnake.Embed(
+            title=f"Canvas {canvas_code} Heatmap",
+            description=f"Pixels placed: `{format_number(total)}`",
+            color=0x66C5CC,
+        )
+        embed.add_field(
+            name="Most Replaced Pixels", value=top_text or "N/A", inline=False
+        )
+        embed.set_footer(text=f"Generated in {format_number(end-start)}s")
+        filename = f"heatmap_c{canvas_code}.png"
+        embed.set_image(url=f"attachment://{filename}")
+        heatmap_file = disnake.File(BytesIO(image_bytes), filename=filename)
+        await ctx.send(embed=embed, file=heatmap_file)
+        self.cd.get_bucket(ctx).reset()
+
     @commands.slash_command(name="canvas")
     async def _canvas(
         self,
@@ -304,17 +304,13 @@ class PxlsStats(commands.Cog):
             record_id_list.append(record_id)
             record_list.append(record)
 
-        sql = """
-            SELECT canvas_count, alltime_count, record_id
-            FROM pxls_user_stat
-            JOIN pxls_name ON pxls_name.pxls_name_id = pxls_user_stat.pxls_name_id
-            WHERE pxls_user_id = ?
-            AND record_id IN ({})
-            ORDER BY record_id
-        """.format(
-            ", ".join(["?"] * len(record_id_list))
-        )
-        rows = await db_conn.sql_select(sql, (user_id,) + tuple(record_id_list))
+        rows = []
+        for record_id in record_id_list:
+            row = await db_stats.get_user_stat_at(
+                record_id, "pxls_user_id = ?", (user_id,)
+            )
+            if row is not None:
+                rows.append(row)
 
         diff_list = []
         for id in record_id_list:
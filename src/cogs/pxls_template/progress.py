@@ -1,11 +1,10 @@
 import asyncio
 import re
 import time
-from copy import deepcopy
+from copy import copy, deepcopy
 from datetime import datetime, timedelta, timezone
 from io import BytesIO
 
-import aiohttp
 import disnake
 import numpy as np
 import pandas as pd
@@ -28,6 +27,7 @@ from utils.discord_utils import (
     get_image_url,
     image_to_file,
 )
+from utils.http_client import get_http_client
 from utils.image.image_utils import find_upscale, v_concatenate
 from utils.plot_utils import (
     fig2img,
@@ -42,7 +42,15 @@ from utils.pxls.template_manager import (
     make_before_after_gif,
     parse_template,
 )
-from utils.setup import PXLS_URL, db_stats, db_templates, db_users, imgur_app, stats
+from utils.setup import (
+    PXLS_URL,
+    db_stats,
+    db_templates,
+    db_users,
+    imgur_app,
+    snapshot_store,
+    stats,
+)
 from utils.table_to_image import table_to_image
 from utils.time_converter import (
     format_datetime,
@@ -683,10 +691,13 @@ class Progress(commands.Cog):
         coords: str = None,
         temp_per_page=15,
     ):
-        if tracked_templates.is_loading:
-            return await ctx.send(":x: Templates are loading, try again later.")
         public_tracked_templates = tracked_templates.get_all_public_templates()
         if len(public_tracked_templates) == 0:
+            if tracked_templates.is_loading:
+                loaded, total = tracked_templates.loading_progress
+                return await ctx.send(
+                    f":x: Templates are loading ({loaded}/{total}), try again later."
+                )
             return await ctx.send("No templates tracked :'(")
 
         titles = [t[0] for t in self.sort_options]
@@ -733,18 +744,33 @@ class Progress(commands.Cog):
             ctx.author.id
         )
 
+        # get the progress of all the templates now and for each timeframe at once
+        timeframes = [{"hours": 1}, {"hours": 6}, {"days": 1}, {"days": 7}]
+        datetimes = [now] + [now - timedelta(**tf) for tf in timeframes]
+        await db_templates.get_combo_id(tracked_templates.combo)
+        all_progress = await db_templates.get_all_templates_progress_at(
+            await stats.get_canvas_code(), datetimes
+        )
+
         for template in public_tracked_templates:
             line_colors = [None, None, None, None]
             # template info
             name = template.name
             total = template.total_placeable
             # last progress
-            last_progress = await db_templates.get_template_progress(template, now)
-            if not last_progress:
+            template_progress = all_progress.get(template.id) or [None] * len(datetimes)
+            last_progress = template_progress[0]
+            if template.current_progress is not None:
+                # live progress tracked with the websocket
+                current_progress = template.current_progress
+            elif last_progress:
+                current_progress = last_progress["progress"]
+            else:
+                current_progress = None
+            if current_progress is None:
                 current_progress = togo = percentage = "N/A"
                 line_colors.append(None)
             else:
-                current_progress = last_progress["progress"]
                 togo = total - current_progress
                 percentage = (current_progress / total) * 100
                 line_colors.append(get_percentage_color(percentage))
@@ -776,11 +802,8 @@ class Progress(commands.Cog):
                     continue
 
             # timeframes speeds
-            timeframes = [{"hours": 1}, {"hours": 6}, {"days": 1}, {"days": 7}]
             values = []
-            for tf in timeframes:
-                td = timedelta(**tf)
-                tf_progress = await db_templates.get_template_progress(template, now - td)
+            for tf_progress in template_progress[1:]:
                 if not tf_progress or not last_progress:
                     values.append("N/A")
                     line_colors.append(None)
@@ -1667,36 +1690,51 @@ class Progress(commands.Cog):
             canvas_start_date = canvas_start_date.replace(tzinfo=timezone.utc)
             lower_dt = max(canvas_start_date, lower_dt)
 
-        # get the snapshots URLs
+        # get the snapshots from the local store and from their URLs for the
+        # datetimes missing in the store (e.g. before the store was set up)
         canvas_code = await stats.get_canvas_code()
+        stored_datetimes = snapshot_store.get_snapshot_datetimes(
+            canvas_code,
+            lower_dt.astimezone(timezone.utc).replace(tzinfo=None),
+            higher_dt.astimezone(timezone.utc).replace(tzinfo=None),
+        )
         snapshot_urls = await db_stats.get_snapshots_between(
             lower_dt.astimezone(timezone.utc),
             higher_dt.astimezone(timezone.utc),
             canvas_code,
         )
-        if len(snapshot_urls) < 2:
+        # {datetime: URL or None if the snapshot is in the store}
+        snapshots = {dt: None for dt in stored_datetimes}
+        for snapshot_url in snapshot_urls:
+            # the datetimes of the store are rounded to the second
+            snapshots.setdefault(snapshot_url[0].replace(microsecond=0), snapshot_url[2])
+        snapshots = sorted(snapshots.items())
+        if len(snapshots) < 2:
             return await ctx.send(":x: The Time Frame Given is too short.")
-        snapshot_urls = shorten_list(snapshot_urls, min(nb_frames, len(snapshot_urls)))
-        nb_frames = len(snapshot_urls)
+        snapshots = shorten_list(snapshots, min(nb_frames, len(snapshots)))
+        snapshot_datetimes = [snapshot[0] for snapshot in snapshots]
+        nb_frames = len(snapshot_datetimes)
 
         # enable the cooldown
         self.timelapse_cd.update_rate_limit(ctx)
 
-        # download the snapshots
+        from_store = all(url is None for _, url in snapshots)
+        step = "Reading" if from_store else "Downloading"
         embed = disnake.Embed(color=0x66C5CC, title="Timelapse")
-        embed.description = "<a:typing:675416675591651329> **Downloading snapshots**...\n"
+        embed.description = f"<a:typing:675416675591651329> **{step} snapshots**...\n"
         m = await ctx.send(embed=embed)
         if m is None:
             m = await ctx.original_message()
+        start = time.time()
+        offset = 5  # offset around the template area (for the "canvas" display)
 
         MAX_TASKS = 5  # number of simultaneous downloads
         MAX_TIME = 120  # timeout before error
-        start = time.time()
 
-        async def download_frame(url, sess, sem):
+        async def download_frame(url, http_client, sem):
             async with sem:
-                async with sess.get(url) as res:
-                    content = await res.read()
+                async with http_client.request("GET", url) as res:
+                    content = await http_client.read(res)
                 if res.status != 200:
                     return None
                 else:
@@ -1705,15 +1743,16 @@ class Progress(commands.Cog):
         tasks = []
         sem = asyncio.Semaphore(MAX_TASKS)
         try:
-            async with aiohttp.client.ClientSession() as sess:
-                for url in snapshot_urls:
+            http_client = get_http_client()
+            for _, url in snapshots:
+                if url is not None:
                     tasks.append(
                         asyncio.wait_for(
-                            download_frame(url[2], sess, sem),
+                            download_frame(url, http_client, sem),
                             timeout=MAX_TIME,
                         )
                     )
-                snapshot_images = await asyncio.gather(*tasks)
+            snapshot_images = await asyncio.gather(*tasks)
         except Exception:
             embed.description = "**:x: Downloading snapshots**... error\n"
             embed.description += "An error occurred while downloading the snapshots."
@@ -1721,27 +1760,76 @@ class Progress(commands.Cog):
             await m.edit(embed=embed)
             return
 
-        # crop the template area
-        embed.description = "✅ **Downloading the snapshots**... done!\n\n<a:typing:675416675591651329> **Cropping the snapshots**..."
-        await m.edit(embed=embed)
-        frames = []
-        for snapshot_image in snapshot_images:
-            if display == "canvas":
-                offset = 5  # offset around the template area
-                ss_frame = snapshot_image.crop(
-                    (
-                        template.ox - offset,
-                        template.oy - offset,
-                        template.ox + template.width + offset,
-                        template.oy + template.height + offset,
+        if not from_store:
+            # crop the template area
+            embed.description = "✅ **Downloading the snapshots**... done!\n\n<a:typing:675416675591651329> **Cropping the snapshots**..."
+            await m.edit(embed=embed)
+        frame_region = (
+            template.ox - offset,
+            template.oy - offset,
+            template.ox + template.width + offset,
+            template.oy + template.height + offset,
+        )
+
+        # the progress of the frames is computed on a copy to not change the live
+        # progress of a tracked template
+        frame_template = copy(template)
+
+        def make_frames():
+            frames = []
+            downloaded_images = iter(snapshot_images)
+            # board where the template area of the stored snapshots is read
+            board_array = None
+            for snapshot_dt, url in snapshots:
+                if url is not None:
+                    snapshot_image = next(downloaded_images)
+                    if display == "canvas":
+                        ss_frame = snapshot_image.crop(frame_region)
+                        snapshot_image.close()
+                    elif display == "progress":
+                        snapshot_array = reduce(snapshot_image, get_rgba_palette())
+                        frame_template.update_progress(snapshot_array)
+                        ss_frame = frame_template.get_progress_image(
+                            board_array=snapshot_array
+                        )
+                elif display == "canvas":
+                    frame_array = snapshot_store.read(
+                        canvas_code, snapshot_dt, frame_region
                     )
-                )
-                snapshot_image.close()
-            elif display == "progress":
-                snapshot_array = reduce(snapshot_image, get_rgba_palette())
-                template.update_progress(snapshot_array)
-                ss_frame = template.get_progress_image(board_array=snapshot_array)
+                    ss_frame = Image.fromarray(stats.palettize_array(frame_array))
+                elif display == "progress":
+                    # only the template area of the board is read
+                    if board_array is None:
+                        board_array = np.full(
+                            snapshot_store.get_shape(canvas_code, snapshot_dt),
+                            255,
+                            dtype=np.uint8,
+                        )
+                    x0, y0 = max(template.ox, 0), max(template.oy, 0)
+                    x1 = min(template.ox + template.width, board_array.shape[1])
+                    y1 = min(template.oy + template.height, board_array.shape[0])
+                    if x0 < x1 and y0 < y1:
+                        board_array[y0:y1, x0:x1] = snapshot_store.read(
+                            canvas_code, snapshot_dt, (x0, y0, x1, y1)
+                        )
+                    frame_template.update_progress(board_array)
+                    ss_frame = frame_template.get_progress_image(board_array=board_array)
+                frames.append(ss_frame)
+            return frames
 
+        try:
+            snapshot_frames = await asyncio.get_running_loop().run_in_executor(
+                None, make_frames
+            )
+        except Exception:
+            embed.description = f"**:x: {step} snapshots**... error\n"
+            embed.description += "An error occurred while reading the snapshots."
+            embed.color = disnake.Color.red()
+            await m.edit(embed=embed)
+            return
+
+        frames = []
+        for ss_frame in snapshot_frames:
             # upscale the images if they're too big
             scale = find_upscale(ss_frame)
             if scale > 1:
@@ -1753,7 +1841,7 @@ class Progress(commands.Cog):
                 ss_frame_resized = ss_frame
             frames.append(ss_frame_resized)
 
-        embed.description = "✅ **Downloading the snapshots**... done!\n\n✅ **Cropping the snapshots**... done!"
+        embed.description = f"✅ **{step} the snapshots**... done!\n\n✅ **Cropping the snapshots**... done!"
         embed.description += (
             "\n\n<a:typing:675416675591651329> **Saving and sending the GIF**..."
         )
@@ -1771,8 +1859,8 @@ class Progress(commands.Cog):
         animated_img.seek(0)
 
         # prepare the embed with the informations
-        t0 = snapshot_urls[0][0]
-        t1 = snapshot_urls[-1][0]
+        t0 = snapshot_datetimes[0]
+        t1 = snapshot_datetimes[-1]
         diff_time = t1 - t0
         time_per_frame = diff_time / nb_frames
         description = "• Between {} and {}\n• Total time: `{}`\n• 1 frame = `{}`\n• Number of frames: `{}`\n• Frame duration: `{}ms` `({}fps)`".format(
@@ -1794,7 +1882,7 @@ class Progress(commands.Cog):
             await m.edit(embed=embed, file=file)
         except Exception:
             embed.set_footer(text="")
-            embed.description = "✅ **Downloading the snapshots**... done!\n\n✅ **Cropping the snapshots**... done!"
+            embed.description = f"✅ **{step} the snapshots**... done!\n\n✅ **Cropping the snapshots**... done!"
             embed.description += "\n\n:x: **Saving and sending the GIF**... error\n(most likely the GIF is too big for discord's limit of 8MB)"
             embed.description += (
                 "\n\n<a:typing:675416675591651329> **Uploading to imgur**..."
@@ -1815,7 +1903,7 @@ class Progress(commands.Cog):
                     msg += f"(add `{cmd}` to the command)."
                 else:
                     msg = "unexpected error"
-                embed.description = "✅ **Downloading the snapshots**... done!\n\n✅ **Cropping the snapshots**... done!"
+                embed.description = f"✅ **{step} the snapshots**... done!\n\n✅ **Cropping the snapshots**... done!"
                 embed.description += "\n\n:x: **Saving and sending the GIF**... error\n(most likely the GIF is too big for discord's limit of 8MB)"
                 embed.description += f"\n\n:x: **Uploading to imgur**... {msg}"
                 embed.color = disnake.Color.red()
@@ -1,24 +1,123 @@
+import asyncio
 import os
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
 
 import asqlite
 
 DB_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "database.db")
 
+# number of read-only connections kept open in the pool
+READER_POOL_SIZE = 4
+# number of compiled statements kept by sqlite for each connection
+STATEMENT_CACHE_SIZE = 256
+# pragmas applied to every connection when it is opened
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-32000",  # 32MB (negative values are in KiB)
+    "PRAGMA mmap_size=268435456",  # 256MB
+    "PRAGMA busy_timeout=5000",
+)
+
 
 class DbConnection:
-    def __init__(self) -> None:
+    """A pool of long-lived connections to the database.
+
+    Reads are spread over `pool_size` read-only connections and all the writes
+    go through a single writer connection, which lets the reads run concurrently
+    with the writes thanks to the WAL journal mode."""
+
+    def __init__(self, pool_size: int = READER_POOL_SIZE) -> None:
         self.db_file: str = DB_FILE
         self.conn = None
+        self.pool_size = pool_size
+
+        # the pool is opened lazily on the first query, in the running event loop
+        self._pool_loop = None
+        self._pool_opening = None
+        self._readers = None
+        self._reader_conns = []
+        self._writer = None
+        self._write_lock = None
+
+    async def _connect(self, readonly=False):
+        """Open a new connection with the pool pragmas."""
+        conn = await asqlite.connect(
+            self.db_file,
+            detect_types=asqlite.PARSE_DECLTYPES,
+            cached_statements=STATEMENT_CACHE_SIZE,
+        )
+        async with conn.cursor() as cursor:
+            for pragma in CONNECTION_PRAGMAS:
+                await cursor.execute(pragma)
+            if readonly:
+                await cursor.execute("PRAGMA query_only=ON")
+        return conn
+
+    async def _open_pool(self):
+        try:
+            self._writer = await self._connect()
+            self._write_lock = asyncio.Lock()
+            self._readers = asyncio.Queue()
+            self._reader_conns = []
+            for _ in range(self.pool_size):
+                reader = await self._connect(readonly=True)
+                self._reader_conns.append(reader)
+                self._readers.put_nowait(reader)
+        except Exception:
+            # let the next query try to open the pool again
+            self._pool_loop = None
+            raise
+
+    async def _ensure_pool(self):
+        """Open the pool if it isn't opened in the current event loop."""
+        loop = asyncio.get_running_loop()
+        if self._pool_loop is not loop:
+            # the connections are bound to the loop that opened them
+            # (the scripts can run more than one event loop)
+            self._pool_loop = loop
+            self._pool_opening = loop.create_task(self._open_pool())
+        await self._pool_opening
+
+    @asynccontextmanager
+    async def _reader(self):
+        """Borrow a read-only connection from the pool."""
+        await self._ensure_pool()
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def _writer_conn(self):
+        """Get exclusive access to the writer connection."""
+        await self._ensure_pool()
+        async with self._write_lock:
+            yield self._writer
+
+    async def close_pool(self):
+        """Close all the connections of the pool."""
+        if self._pool_loop is not asyncio.get_running_loop():
+            return
+        await self._pool_opening
+        for conn in self._reader_conns + [self._writer]:
+            await conn.close()
+        self._reader_conns = []
+        self._writer = None
+        self._pool_loop = None
 
     async def create_connection(self):
-        self.conn = await asqlite.connect(DB_FILE, detect_types=asqlite.PARSE_DECLTYPES)
+        self.conn = await self._connect()
 
     async def close_connection(self):
         await self.conn.close()
 
     async def sql_select(self, query, param: tuple = None):
         """Execute the query with the given parameters and return all the rows selected."""
-        async with asqlite.connect(DB_FILE, detect_types=asqlite.PARSE_DECLTYPES) as conn:
+        async with self._reader() as conn:
             async with conn.cursor() as cursor:
                 if param:
                     await cursor.execute(query, param)
@@ -29,7 +128,7 @@ class DbConnection:
 
     async def sql_update(self, query, param: tuple = None):
         """Execute the query with the given parameter, commit the connection and return the number of lines changed."""
-        async with asqlite.connect(DB_FILE, detect_types=asqlite.PARSE_DECLTYPES) as conn:
+        async with self._writer_conn() as conn:
             async with conn.cursor() as cursor:
                 if param:
                     await cursor.execute(query, param)
@@ -40,7 +139,7 @@ class DbConnection:
 
     async def sql_insert(self, query, param: tuple = None) -> int:
         """Same as `sql_update()` but returns the rowid of the last element inserted"""
-        async with asqlite.connect(DB_FILE, detect_types=asqlite.PARSE_DECLTYPES) as conn:
+        async with self._writer_conn() as conn:
             async with conn.cursor() as cursor:
                 if param:
                     await cursor.execute(query, param)
@@ -48,3 +147,62 @@ class DbConnection:
                     await cursor.execute(query)
                 await conn.commit()
                 return cursor.get_cursor().lastrowid
+
+    async def sql_update_many(self, query, params_list: list) -> int:
+        """Execute the query for every parameters in the list in a single transaction
+        and return the number of lines changed."""
+        async with self.transaction() as cursor:
+            await cursor.executemany(query, params_list)
+            return cursor.get_cursor().rowcount
+
+    @asynccontextmanager
+    async def transaction(self):
+        """Get a cursor of the writer connection in a transaction, the transaction
+        is committed at the end of the block or rolled back if it raises."""
+        async with self._writer_conn() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute("BEGIN TRANSACTION;")
+                try:
+                    yield cursor
+                except BaseException:
+                    await cursor.execute("ROLLBACK;")
+                    raise
+                await cursor.execute("COMMIT;")
+
+    async def sql_select_closest(
+        self, table: str, dt: datetime, where: str = None, param: tuple = ()
+    ):
+        """Return the row of `table` with the closest `datetime` column to `dt`
+        (or None if there is no row).
+
+        The row is found with 2 index seeks (the last row before `dt` and the first
+        row after it) instead of computing the time difference on the whole table.
+
+        :param where: an SQL condition to filter the rows
+        :param param: the parameters used in the `where` condition"""
+        dt = to_naive_utc(dt)
+        condition = f"({where}) AND " if where else ""
+        sql = "SELECT * FROM {} WHERE {}datetime {} ? ORDER BY datetime {} LIMIT 1"
+        before = await self.sql_select(
+            sql.format(table, condition, "<=", "DESC"), tuple(param) + (dt,)
+        )
+        after = await self.sql_select(
+            sql.format(table, condition, ">=", "ASC"), tuple(param) + (dt,)
+        )
+        return closest_row(before[0] if before else None, after[0] if after else None, dt)
+
+
+def to_naive_utc(dt: datetime) -> datetime:
+    """Convert a datetime to a naive datetime in UTC (the format used in the database)."""
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def closest_row(before, after, dt: datetime):
+    """Pick the row with the closest `datetime` to `dt` between 2 rows (that can be None)."""
+    if before is None or after is None:
+        return before or after
+    if dt - before["datetime"] <= after["datetime"] - dt:
+        return before
+    return after
@@ -0,0 +1,195 @@
+import os
+import shutil
+
+import numpy as np
+
+from database.db_connection import DbConnection
+from utils.pxls.canvas_log import replace_folder
+
+STATS_HISTORY_FOLDER = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), "stats_history"
+)
+
+# values used in the count arrays
+NULL_COUNT = -1  # the count is NULL in the database
+ABSENT = -2  # the user has no row for this record
+
+COLUMNS = ("alltime_count", "canvas_count")
+
+
+class CanvasStatsHistory:
+    """The pxls_user_stat history of a canvas in a columnar format.
+
+    Only the changes are stored: each user has a slice of "events" with the index
+    of the record where its counts changed and the new counts. The value of a user
+    at a record is the value of its last event before (or at) this record.
+
+    Files in the canvas folder (loaded as memory-mapped arrays):
+    - `record_ids.npy`: the sorted record IDs of the canvas
+    - `name_ids.npy`: the sorted pxls_name IDs of the users
+    - `offsets.npy`: the events of `name_ids[i]` are `offsets[i]:offsets[i+1]`
+    - `record_indexes.npy`: the record index of each event
+    - `alltime_count.npy`, `canvas_count.npy`: the counts of each event"""
+
+    def __init__(self, folder: str) -> None:
+        self.folder = folder
+
+        def load(name):
+            return np.load(os.path.join(folder, f"{name}.npy"), mmap_mode="r")
+
+        self.record_ids: np.ndarray = load("record_ids")
+        self.name_ids: np.ndarray = load("name_ids")
+        self.offsets: np.ndarray = load("offsets")
+        self.record_indexes: np.ndarray = load("record_indexes")
+        self.counts = {column: load(column) for column in COLUMNS}
+
+    def has_records(self, record_ids) -> bool:
+        """Check if all the given records are in the history."""
+        return bool(np.isin(record_ids, self.record_ids).all())
+
+    def get_counts(self, name_ids, record_ids, column: str) -> np.ndarray:
+        """Get the counts of the given users at the given records.
+
+        Return an array of shape (len(name_ids), len(record_ids)) with the counts,
+        `NULL_COUNT` or `ABSENT`."""
+        record_indexes = np.searchsorted(self.record_ids, record_ids)
+        res = np.full((len(name_ids), len(record_ids)), ABSENT, dtype=np.int64)
+        counts = self.counts[column]
+        for i, name_id in enumerate(name_ids):
+            pos = np.searchsorted(self.name_ids, name_id)
+            if pos >= len(self.name_ids) or self.name_ids[pos] != name_id:
+                continue
+            start, end = self.offsets[pos], self.offsets[pos + 1]
+            events = np.searchsorted(
+                self.record_indexes[start:end], record_indexes, side="right"
+            )
+            found = events > 0
+            res[i, found] = counts[start:end][events[found] - 1]
+        return res
+
+
+class StatsHistoryStore:
+    """Optional columnar copy of the pxls_user_stat table for each canvas,
+    used to read large ranges of stats without going through SQLite.
+
+    The canvases are exported with `export_canvas()` (see scripts/export_stats_history.py)."""
+
+    def __init__(self, folder: str = STATS_HISTORY_FOLDER) -> None:
+        self.folder = folder
+        self._canvases = {}
+
+    def canvas_folder(self, canvas_code) -> str:
+        return os.path.join(self.folder, f"c{canvas_code}")
+
+    def get(self, canvas_code) -> CanvasStatsHistory:
+        """Get the history of a canvas or None if it wasn't exported."""
+        if canvas_code is None:
+            return None
+        if canvas_code not in self._canvases:
+            folder = self.canvas_folder(canvas_code)
+            if not os.path.exists(os.path.join(folder, "offsets.npy")):
+                return None
+            self._canvases[canvas_code] = CanvasStatsHistory(folder)
+        return self._canvases[canvas_code]
+
+    async def export_canvas(self, db_conn: DbConnection, canvas_code) -> CanvasStatsHistory:
+        """Export the pxls_user_stat rows of a canvas in the columnar format."""
+        records = await db_conn.sql_select(
+            "SELECT record_id FROM record WHERE canvas_code = ? ORDER BY record_id",
+            (canvas_code,),
+        )
+        record_ids = np.array([r["record_id"] for r in records], dtype=np.int64)
+        rows = await db_conn.sql_select(
+            """
+            SELECT pxls_name_id, pxls_user_stat.record_id, alltime_count, canvas_count
+            FROM pxls_user_stat
+            JOIN record ON record.record_id = pxls_user_stat.record_id
+            WHERE canvas_code = ?
+            ORDER BY pxls_name_id, pxls_user_stat.record_id
+            """,
+            (canvas_code,),
+        )
+        delta_records = await db_conn.sql_select(
+            """
+            SELECT delta_record.record_id FROM delta_record
+            JOIN record ON record.record_id = delta_record.record_id
+            WHERE canvas_code = ?
+            """,
+            (canvas_code,),
+        )
+        delta_record_ids = [r["record_id"] for r in delta_records]
+        arrays = build_events(record_ids, rows, delta_record_ids)
+
+        # write in a temporary folder first so an interrupted export is never used
+        folder = self.canvas_folder(canvas_code)
+        tmp_folder = folder + ".tmp"
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+        os.makedirs(tmp_folder)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_folder, f"{name}.npy"), array)
+        replace_folder(tmp_folder, folder)
+        self._canvases.pop(canvas_code, None)
+        return self.get(canvas_code)
+
+
+def build_events(record_ids: np.ndarray, rows, delta_record_ids=()) -> dict:
+    """Convert pxls_user_stat rows sorted by (pxls_name_id, record_id) to the
+    arrays of a `CanvasStatsHistory`.
+
+    A user without a row in a delta record keeps its counts, it's only absent
+    from the full records where it has no row."""
+    nb_records = len(record_ids)
+    full_indexes = np.flatnonzero(~np.isin(record_ids, delta_record_ids))
+    name_id = np.array([r[0] for r in rows], dtype=np.int64)
+    record_index = np.searchsorted(
+        record_ids, np.array([r[1] for r in rows], dtype=np.int64)
+    )
+    alltime = np.array(
+        [NULL_COUNT if r[2] is None else r[2] for r in rows], dtype=np.int64
+    )
+    canvas = np.array([NULL_COUNT if r[3] is None else r[3] for r in rows], dtype=np.int64)
+
+    if len(rows):
+        new_user = np.r_[True, name_id[1:] != name_id[:-1]]
+        # a row following a record where the user was absent
+        after_gap = np.r_[True, record_index[1:] != record_index[:-1] + 1] | new_user
+        changed = np.r_[True, (alltime[1:] != alltime[:-1]) | (canvas[1:] != canvas[:-1])]
+        keep = new_user | after_gap | changed
+        # the user is absent from the first full record after the last row of
+        # each run of consecutive records (if it's before the next row of the user)
+        run_end = np.r_[new_user[1:] | after_gap[1:], True]
+        next_index = np.where(
+            np.r_[~new_user[1:], False], np.r_[record_index[1:], nb_records], nb_records
+        )
+        full_pos = np.searchsorted(full_indexes, record_index[run_end], side="right")
+        absent_index = np.append(full_indexes, nb_records)[full_pos]
+        absent_name = name_id[run_end]
+        valid = absent_index < next_index[run_end]
+        absent_index = absent_index[valid]
+        absent_name = absent_name[valid]
+    else:
+        keep = np.zeros(0, dtype=bool)
+        absent_index = absent_name = np.zeros(0, dtype=np.int64)
+
+    events_name = np.concatenate([name_id[keep], absent_name])
+    events_index = np.concatenate([record_index[keep], absent_index])
+    events_alltime = np.concatenate(
+        [alltime[keep], np.full(len(absent_name), ABSENT, dtype=np.int64)]
+    )
+    events_canvas = np.concatenate(
+        [canvas[keep], np.full(len(absent_name), ABSENT, dtype=np.int64)]
+    )
+    order = np.lexsort((events_index, events_name))
+    events_name = events_name[order]
+
+    name_ids = np.unique(events_name)
+    offsets = np.searchsorted(events_name, name_ids)
+    offsets = np.append(offsets, len(events_name)).astype(np.int64)
+    return {
+        "record_ids": record_ids,
+        "name_ids": name_ids,
+        "offsets": offsets,
+        "record_indexes": events_index[order].astype(np.int32),
+        "alltime_count": events_alltime[order],
+        "canvas_count": events_canvas[order],
+    }
@@ -1,17 +1,43 @@
+import bisect
+import time
 from datetime import datetime, timedelta
 from sqlite3 import IntegrityError
 
-from database.db_connection import DbConnection
+from database.db_connection import DbConnection, closest_row, to_naive_utc
+from database.db_stats_history import ABSENT, NULL_COUNT, StatsHistoryStore
+from utils.log import get_logger
+from utils.pxls.name_index import NameIndex
 from utils.pxls.pxls_stats_manager import PxlsStatsManager
 from utils.utils import shorten_list
 
+logger = get_logger(__name__)
+
+# maximum number of records between 2 full records when only the changed user
+# stats are saved (1 day with a record every 15 minutes)
+FULL_RECORD_INTERVAL = 96
+
 
 class DbStatsManager:
     """A class to manage the pxls stats in the database"""
 
-    def __init__(self, db_conn: DbConnection, stats: PxlsStatsManager) -> None:
+    def __init__(
+        self, db_conn: DbConnection, stats: PxlsStatsManager, delta_ingestion=False
+    ) -> None:
         self.db = db_conn
         self.stats_manager = stats
+        # only save the user stats that changed since the last record
+        self.delta_ingestion = delta_ingestion
+        # state of the last stats ingestion (init on the first ingestion)
+        self._names_dict: dict[str, int] = None
+        self._last_counts: dict[int, tuple] = None
+        self._last_canvas_code = None
+        self._records_since_full = 0
+        # index of the pxls names for the autocomplete (init with self.load_name_index())
+        self.name_index: NameIndex = None
+        # in-memory timeline of the records (init with self.load_record_timeline())
+        self.record_timeline: dict[str, RecordTimeline] = None
+        # columnar copy of the user stats for the exported canvases
+        self.history_store = StatsHistoryStore()
 
     async def create_tables(self):
         create_pxls_general_stats_table = """
@@ -65,12 +91,34 @@ class DbStatsManager:
                 url TEXT
             );"""
 
+        # records where only the user stats that changed were saved
+        create_delta_record_table = """
+            CREATE TABLE IF NOT EXISTS delta_record(
+                record_id INTEGER PRIMARY KEY,
+                FOREIGN KEY(record_id) REFERENCES record(record_id)
+            );"""
+
         await self.db.sql_update(create_pxls_general_stats_table)
         await self.db.sql_update(create_record_table)
         await self.db.sql_update(create_pxls_user_stat_table)
         await self.db.sql_update(create_palette_color_table)
         await self.db.sql_update(create_color_stat_table)
         await self.db.sql_update(create_snapshot_table)
+        await self.db.sql_update(create_delta_record_table)
+
+        # indexes used to find the closest row to a datetime
+        await self.db.sql_update(
+            "CREATE INDEX IF NOT EXISTS record_canvas_code_datetime ON record(canvas_code, datetime);"
+        )
+        await self.db.sql_update(
+            "CREATE INDEX IF NOT EXISTS pxls_general_stat_datetime ON pxls_general_stat(datetime);"
+        )
+        await self.db.sql_update(
+            "CREATE INDEX IF NOT EXISTS pxls_general_stat_canvas_code_datetime ON pxls_general_stat(canvas_code, datetime);"
+        )
+        await self.db.sql_update(
+            "CREATE INDEX IF NOT EXISTS snapshot_canvas_code_datetime ON snapshot(canvas_code, datetime);"
+        )
 
     # pxls user stats functions #
     async def create_record(self, last_updated, canvas_code):
@@ -80,64 +128,136 @@ class DbStatsManager:
         try:
             # create a time record
             record_id = await self.db.sql_insert(sql, (last_updated, canvas_code))
-            return record_id
         except IntegrityError:
             # there is already a record for this time
             return None
+        if self.record_timeline is not None:
+            self._add_to_timeline(
+                dict(record_id=record_id, datetime=last_updated, canvas_code=canvas_code)
+            )
+        return record_id
 
-    async def update_all_pxls_stats(self, alltime_stats, canvas_stats, record_id):
-        """Insert all the pxls stats data in the database"""
+    async def load_record_timeline(self):
+        """Load all the records in memory, sorted by datetime for each canvas."""
+        sql = "SELECT record_id, datetime, canvas_code FROM record ORDER BY datetime"
+        rows = await self.db.sql_select(sql)
+        self.record_timeline = {None: RecordTimeline()}
+        for row in rows:
+            self._add_to_timeline(dict(row))
 
-        await self.db.create_connection()
-        async with self.db.conn.cursor() as cur:
-            # make a dictionary of key: username, value: {alltime: ..., canvas: ...}
-            users = {}
-            for user in alltime_stats:
-                username = user["username"]
-                alltime_count = user["pixels"]
-                users[username] = {"alltime": alltime_count, "canvas": 0}
-
-            for user in canvas_stats:
-                username = user["username"]
-                canvas_count = user["pixels"]
-                try:
-                    users[username]["canvas"] = canvas_count
-                except KeyError:
-                    users[username] = {"alltime": None, "canvas": canvas_count}
+    def _add_to_timeline(self, record: dict):
+        if record["canvas_code"] is None:
+            return
+        # add the record in the timeline of all the canvases and of its canvas
+        self.record_timeline[None].add(record)
+        if record["canvas_code"] not in self.record_timeline:
+            self.record_timeline[record["canvas_code"]] = RecordTimeline()
+        self.record_timeline[record["canvas_code"]].add(record)
+
+    async def update_all_pxls_stats(self, alltime_stats, canvas_stats, record_id):
+        """Insert all the pxls stats data in the database.
+
+        With `delta_ingestion`, only the users with different counts than in the
+        last record are saved and the record is added in the `delta_record` table:
+        a user without a row in a delta record has the same counts as in its last
+        row since the last full record. A full record is saved after a restart,
+        on a new canvas, when a user leaves the toplists and at least every
+        `FULL_RECORD_INTERVAL` records."""
+        start = time.perf_counter()
+
+        # make a dictionary of key: username, value: {alltime: ..., canvas: ...}
+        users = {}
+        for user in alltime_stats:
+            username = user["username"]
+            alltime_count = user["pixels"]
+            users[username] = {"alltime": alltime_count, "canvas": 0}
+
+        for user in canvas_stats:
+            username = user["username"]
+            canvas_count = user["pixels"]
+            try:
+                users[username]["canvas"] = canvas_count
+            except KeyError:
+                users[username] = {"alltime": None, "canvas": canvas_count}
 
+        canvas_code = await self.stats_manager.get_canvas_code()
+        if self._names_dict is None:
             # get all the pxls_name_id in a dictionary (pxls_name:pxls_name_id)
             pxls_names = await self.db.sql_select(
                 "SELECT pxls_name_id, name FROM pxls_name"
             )
-            names_dict = {}
-            for name in pxls_names:
-                names_dict[name["name"]] = name["pxls_name_id"]
-
-            # get the values to insert for each user
-            values_list = []
-            for username in users.keys():
-                alltime_count = users[username]["alltime"]
-                canvas_count = users[username]["canvas"]
-                try:
-                    # get user id
-                    pxls_name_id = names_dict[username]
-                except KeyError:
-                    # if user does not exist, create it
-                    pxls_name_id = await self.create_pxls_user(username, cur)
-                    names_dict[username] = pxls_name_id
-
-                values = (record_id, pxls_name_id, alltime_count, canvas_count)
-                values_list.append(values)
+            self._names_dict = {name["name"]: name["pxls_name_id"] for name in pxls_names}
 
-            sql = """
-                INSERT INTO pxls_user_stat (record_id, pxls_name_id, alltime_count, canvas_count)
-                VALUES (?,?,?,?)"""
-            await cur.execute("BEGIN TRANSACTION;")
-            await cur.executemany(sql, values_list)
-            await cur.execute("COMMIT;")
+        new_names = []
+        try:
+            async with self.db.transaction() as cur:
+                counts = {}
+                for username, user_counts in users.items():
+                    pxls_name_id = self._names_dict.get(username)
+                    if pxls_name_id is None:
+                        # if user does not exist, create it
+                        pxls_name_id = await self.create_pxls_user(username, cur)
+                        self._names_dict[username] = pxls_name_id
+                        new_names.append(username)
+                    counts[pxls_name_id] = (user_counts["alltime"], user_counts["canvas"])
+
+                full_record = (
+                    not self.delta_ingestion
+                    or self._last_counts is None
+                    or canvas_code != self._last_canvas_code
+                    or self._records_since_full + 1 >= FULL_RECORD_INTERVAL
+                    # the users absent from the toplists must be absent from the record
+                    or not self._last_counts.keys() <= counts.keys()
+                )
+                if full_record:
+                    changed = counts.keys()
+                else:
+                    changed = [
+                        pxls_name_id
+                        for pxls_name_id, user_counts in counts.items()
+                        if self._last_counts.get(pxls_name_id) != user_counts
+                    ]
+                    await cur.execute(
+                        "INSERT INTO delta_record (record_id) VALUES (?)", record_id
+                    )
 
-        await self.db.conn.commit()
-        await self.db.close_connection()
+                values_list = [
+                    (record_id, pxls_name_id) + counts[pxls_name_id]
+                    for pxls_name_id in changed
+                ]
+                sql = """
+                    INSERT INTO pxls_user_stat (record_id, pxls_name_id, alltime_count, canvas_count)
+                    VALUES (?,?,?,?)"""
+                await cur.executemany(sql, values_list)
+        except Exception:
+            # the names created in the transaction were rolled back
+            self._names_dict = None
+            self._last_counts = None
+            raise
+
+        if self.name_index is not None:
+            for username in new_names:
+                self.name_index.add(username)
+            if self._last_counts is not None:
+                self.name_index.touch(
+                    [
+                        username
+                        for username in users.keys()
+                        if self._last_counts.get(self._names_dict[username])
+                        != counts[self._names_dict[username]]
+                    ]
+                )
+        self._last_counts = counts
+        self._last_canvas_code = canvas_code
+        self._records_since_full = 0 if full_record else self._records_since_full + 1
+        logger.info(
+            "User stats saved: {}/{} rows ({} record) in {:.2f}s".format(
+                len(values_list),
+                len(counts),
+                "full" if full_record else "delta",
+                time.perf_counter() - start,
+            )
+        )
 
     async def create_pxls_user(self, username, cur):
         """create a 'pxls_user' and its associated 'pxls_name'"""
@@ -159,11 +279,76 @@ class DbStatsManager:
         else:
             return res[0][0]
 
+    async def get_full_record_id(self, record_id):
+        """Get the last full record (with the stats of all the users) at or before
+        the given record."""
+        sql = """
+            SELECT record_id FROM record
+            WHERE record_id <= ?
+            AND record_id NOT IN (SELECT record_id FROM delta_record)
+            ORDER BY record_id DESC
+            LIMIT 1"""
+        rows = await self.db.sql_select(sql, (record_id,))
+        return rows[0]["record_id"] if rows else None
+
+    async def get_delta_records(self, record_id1, record_id2) -> set:
+        """Get the IDs of the delta records between 2 records."""
+        sql = "SELECT record_id FROM delta_record WHERE record_id BETWEEN ? AND ?"
+        rows = await self.db.sql_select(sql, (record_id1, record_id2))
+        return {r["record_id"] for r in rows}
+
+    async def get_user_stats_at_sql(self, record_id) -> tuple[str, tuple]:
+        """Get a subquery selecting the pxls_user_stat rows of all the users at a
+        record and its parameters.
+
+        In a delta record, the users without a row get their last row since the
+        last full record."""
+        full_record_id = await self.get_full_record_id(record_id)
+        if full_record_id is None or full_record_id == record_id:
+            return "(SELECT * FROM pxls_user_stat WHERE record_id = ?)", (record_id,)
+        sql = """(
+            SELECT ? AS record_id, s.pxls_name_id, s.alltime_count, s.canvas_count
+            FROM pxls_user_stat s
+            JOIN (
+                SELECT pxls_name_id, MAX(record_id) AS record_id
+                FROM pxls_user_stat
+                WHERE record_id BETWEEN ? AND ?
+                GROUP BY pxls_name_id
+            ) last_stat USING (pxls_name_id, record_id)
+        )"""
+        return sql, (record_id, full_record_id, record_id)
+
+    async def get_user_stat_at(self, record_id, where: str, param: tuple):
+        """Get the counts of a user at a record (None if the user has no stats).
+
+        :param where: an SQL condition on the pxls_name table to select the user
+        :param param: the parameters used in the `where` condition"""
+        full_record_id = await self.get_full_record_id(record_id)
+        sql = """
+            SELECT canvas_count, alltime_count, ? AS record_id
+            FROM pxls_user_stat
+            JOIN pxls_name ON pxls_name.pxls_name_id = pxls_user_stat.pxls_name_id
+            WHERE ({})
+            AND pxls_user_stat.record_id BETWEEN ? AND ?
+            ORDER BY pxls_user_stat.record_id DESC
+            LIMIT 1""".format(
+            where
+        )
+        rows = await self.db.sql_select(
+            sql, (record_id,) + tuple(param) + (full_record_id, record_id)
+        )
+        return rows[0] if rows else None
+
     async def get_last_two_alltime_counts(self, pxls_user_id: int) -> tuple:
         """Get a tuple of the last 2 alltime pixel counts in the database for
-        a given user (used to check if the user hit a milestone)"""
+        a given user (used to check if the user hit a milestone).
+
+        Return None if the count didn't change in the last record: the users
+        only have rows when their counts change in the delta records."""
         sql = """
-        SELECT name, alltime_count FROM pxls_name
+        SELECT name, alltime_count, record_id,
+            (SELECT MAX(record_id) FROM record) AS last_record_id
+        FROM pxls_name
         INNER JOIN(pxls_user_stat) ON pxls_user_stat.pxls_name_id = pxls_name.pxls_name_id
         WHERE pxls_user_id = ?
         ORDER BY record_id DESC
@@ -172,10 +357,18 @@ class DbStatsManager:
         res = await self.db.sql_select(sql, pxls_user_id)
         if len(res) == 0:
             raise ValueError(f"No use found with ID: '{pxls_user_id}'")
+        elif len(res) == 1 or res[0]["record_id"] != res[0]["last_record_id"]:
+            return None
         else:
             return (res[0][0], res[0][1], res[1][1])
 
     async def get_last_leaderboard(self):
+        last_record = await self.db.sql_select(
+            "SELECT record_id FROM record ORDER BY datetime DESC LIMIT 1"
+        )
+        if not last_record:
+            return []
+        user_stats, param = await self.get_user_stats_at_sql(last_record[0]["record_id"])
         sql = """
         SELECT
             name,
@@ -184,12 +377,13 @@ class DbStatsManager:
             ROW_NUMBER() OVER(ORDER BY (canvas_count) DESC) AS canvas_rank,
             canvas_count,
             datetime
-        FROM pxls_user_stat p
+        FROM {} p
         JOIN record r ON r.record_id = p.record_id
-        JOIN pxls_name n ON n.pxls_name_id = p.pxls_name_id
-        WHERE r.datetime = (SELECT MAX(datetime) FROM record)"""
+        JOIN pxls_name n ON n.pxls_name_id = p.pxls_name_id""".format(
+            user_stats
+        )
 
-        rows = await self.db.sql_select(sql)
+        rows = await self.db.sql_select(sql, param)
         return rows
 
     async def get_stats_history(self, user_list, date1, date2, canvas_opt):
@@ -206,25 +400,23 @@ class DbStatsManager:
             "SELECT * FROM record WHERE datetime BETWEEN ? AND ? AND canvas_code IS {} ORDER BY datetime".format(f"'{canvas_to_select}'" if canvas_to_select else "NOT NULL"),
             (record1["datetime"], record2["datetime"]),
         )
+        records_datetimes = {r["record_id"]: r["datetime"] for r in records}
         records = [r["record_id"] for r in records]
         if len(records) > 1000:
             records = shorten_list(records, 1000)
-        sql = """
-            SELECT name, {0} as pixels, datetime
-            FROM pxls_user_stat
-            JOIN record ON record.record_id = pxls_user_stat.record_id
-            JOIN pxls_name ON pxls_name.pxls_name_id = pxls_user_stat.pxls_name_id
-            WHERE name IN ({1})
-            AND pxls_user_stat.record_id IN ({2})
-            {3}
-            ORDER BY {0} """.format(
-            "canvas_count" if canvas_opt else "alltime_count",
-            ", ".join("?" for u in user_list),
-            ", ".join("?" for r in records),
-            "AND alltime_count is not NULL" if not canvas_opt else "",
-        )
 
-        rows = await self.db.sql_select(sql, tuple(user_list) + tuple(records))
+        canvas_history = None
+        if records and record1["canvas_code"] == record2["canvas_code"]:
+            canvas_history = self.history_store.get(record1["canvas_code"])
+        if canvas_history is not None and canvas_history.has_records(records):
+            # read the stats from the columnar history
+            rows = await self._get_stats_history_from_store(
+                canvas_history, user_list, records, records_datetimes, canvas_opt
+            )
+        else:
+            rows = await self._get_stats_history_from_db(
+                user_list, records, records_datetimes, canvas_opt
+            )
 
         # group by user
         users_dict = {}
@@ -242,6 +434,111 @@ class DbStatsManager:
         users_list = list(users_dict.items())
         return (past_time, recent_time, users_list)
 
+    async def _get_stats_history_from_db(
+        self, user_list, records, records_datetimes, canvas_opt
+    ):
+        sql = """
+            SELECT name, {0} as pixels, datetime, pxls_user_stat.record_id
+            FROM pxls_user_stat
+            JOIN record ON record.record_id = pxls_user_stat.record_id
+            JOIN pxls_name ON pxls_name.pxls_name_id = pxls_user_stat.pxls_name_id
+            WHERE name IN ({1})
+            AND pxls_user_stat.record_id IN ({2})
+            {3}
+            ORDER BY {0} """.format(
+            "canvas_count" if canvas_opt else "alltime_count",
+            ", ".join("?" for u in user_list),
+            ", ".join("?" for r in records),
+            "AND alltime_count is not NULL" if not canvas_opt else "",
+        )
+
+        rows = await self.db.sql_select(sql, tuple(user_list) + tuple(records))
+
+        if not records:
+            return rows
+        delta_records = await self.get_delta_records(records[0], records[-1])
+        if not delta_records.intersection(records):
+            return rows
+        return await self._fill_delta_records(
+            rows, user_list, records, records_datetimes, delta_records, canvas_opt
+        )
+
+    async def _fill_delta_records(
+        self, rows, user_list, records, records_datetimes, delta_records, canvas_opt
+    ):
+        """Add the rows of the users without a row in the delta records (their
+        counts didn't change since their previous row)."""
+        column = "canvas_count" if canvas_opt else "alltime_count"
+        # the counts of the users before the first record
+        last_counts = {}
+        if records[0] in delta_records:
+            user_stats, param = await self.get_user_stats_at_sql(records[0])
+            sql = """
+                SELECT name, {0} as pixels
+                FROM {1} s
+                JOIN pxls_name ON pxls_name.pxls_name_id = s.pxls_name_id
+                WHERE name IN ({2})""".format(
+                column, user_stats, ", ".join("?" for u in user_list)
+            )
+            start_rows = await self.db.sql_select(sql, param + tuple(user_list))
+            last_counts = {r["name"]: r["pixels"] for r in start_rows}
+
+        rows_dict = {(r["name"], r["record_id"]): r for r in rows}
+        names = list(dict.fromkeys(user_list))
+        res = []
+        for record_id in records:
+            for name in names:
+                row = rows_dict.get((name, record_id))
+                if row is not None:
+                    last_counts[name] = row["pixels"]
+                    res.append(row)
+                elif record_id not in delta_records:
+                    # the user is absent from this full record
+                    last_counts.pop(name, None)
+                elif name in last_counts:
+                    pixels = last_counts[name]
+                    if pixels is None and not canvas_opt:
+                        continue
+                    res.append(
+                        dict(
+                            name=name,
+                            pixels=pixels,
+                            datetime=records_datetimes[record_id],
+                            record_id=record_id,
+                        )
+                    )
+        # same order as 'ORDER BY pixels' (NULL first)
+        res.sort(key=lambda r: (r["pixels"] is not None, r["pixels"] or 0))
+        return res
+
+    async def _get_stats_history_from_store(
+        self, canvas_history, user_list, records, records_datetimes, canvas_opt
+    ):
+        """Same as `_get_stats_history_from_db()` but using the columnar history."""
+        sql = "SELECT pxls_name_id, name FROM pxls_name WHERE name IN ({})".format(
+            ", ".join("?" for u in user_list)
+        )
+        names = await self.db.sql_select(sql, tuple(user_list))
+        name_ids = [n["pxls_name_id"] for n in names]
+        column = "canvas_count" if canvas_opt else "alltime_count"
+        counts = canvas_history.get_counts(name_ids, records, column)
+
+        rows = []
+        for name, user_counts in zip(names, counts):
+            for record_id, count in zip(records, user_counts.tolist()):
+                if count == ABSENT or (count == NULL_COUNT and not canvas_opt):
+                    continue
+                rows.append(
+                    dict(
+                        name=name["name"],
+                        pixels=None if count == NULL_COUNT else count,
+                        datetime=records_datetimes[record_id],
+                    )
+                )
+        # same order as 'ORDER BY pixels' (NULL first)
+        rows.sort(key=lambda r: (r["pixels"] is not None, r["pixels"] or 0))
+        return rows
+
     async def get_grouped_stats_history(
         self, user_list, dt1, dt2, groupby_opt, canvas_opt
     ):
@@ -287,14 +584,15 @@ class DbStatsManager:
                 {0} as pixels,
                 {0}-(LAG({0}) OVER (ORDER BY name, datetime)) as placed,
                 MIN(record.datetime) as first_datetime,
-                MAX(record.datetime) as last_datetime
+                MAX(record.datetime) as last_datetime,
+                strftime(?, datetime) as grp
             FROM pxls_user_stat
             JOIN record ON record.record_id = pxls_user_stat.record_id
             JOIN pxls_name ON pxls_name.pxls_name_id = pxls_user_stat.pxls_name_id
             WHERE name IN ({1})
                 AND pxls_user_stat.record_id BETWEEN ? AND ?
                 AND canvas_code IS {2}
-            GROUP BY strftime(?,datetime), name""".format(
+            GROUP BY grp, name""".format(
             "canvas_count" if canvas_opt else "alltime_count",
             ", ".join("?" for u in user_list),
             f"'{canvas_to_select}'" if canvas_to_select else "NOT NULL",
@@ -302,8 +600,15 @@ class DbStatsManager:
 
         rows = await self.db.sql_select(
             sql,
-            tuple(user_list) + (record1["record_id"], record2["record_id"], groupby),
+            (groupby,) + tuple(user_list) + (record1["record_id"], record2["record_id"]),
         )
+        delta_records = await self.get_delta_records(
+            record1["record_id"], record2["record_id"]
+        )
+        if delta_records:
+            rows = await self._fill_delta_groups(
+                rows, user_list, record1, record2, groupby, canvas_opt, canvas_to_select
+            )
 
         # group by user
         users_dict = {}
@@ -336,6 +641,71 @@ class DbStatsManager:
             )
             return past_time, now_time, res_list
 
+    async def _fill_delta_groups(
+        self, rows, user_list, record1, record2, groupby, canvas_opt, canvas_to_select
+    ):
+        """Add the rows of the groups where the users have no row in the delta
+        records (their counts didn't change) and compute the pixels placed in
+        each group from the counts carried forward."""
+        column = "canvas_count" if canvas_opt else "alltime_count"
+        sql = """
+            SELECT
+                strftime(?, datetime) as grp,
+                MIN(datetime) as first_datetime,
+                MAX(datetime) as last_datetime
+            FROM record
+            WHERE record_id BETWEEN ? AND ? AND canvas_code IS {}
+            GROUP BY grp
+            ORDER BY grp""".format(
+            f"'{canvas_to_select}'" if canvas_to_select else "NOT NULL"
+        )
+        groups = await self.db.sql_select(
+            sql, (groupby, record1["record_id"], record2["record_id"])
+        )
+
+        # the counts of the users at the first record
+        user_stats, param = await self.get_user_stats_at_sql(record1["record_id"])
+        sql = """
+            SELECT name, {0} as pixels
+            FROM {1} s
+            JOIN pxls_name ON pxls_name.pxls_name_id = s.pxls_name_id
+            WHERE name IN ({2})""".format(
+            column, user_stats, ", ".join("?" for u in user_list)
+        )
+        start_rows = await self.db.sql_select(sql, param + tuple(user_list))
+        start_counts = {r["name"]: r["pixels"] for r in start_rows}
+
+        rows_dict = {(r["name"], r["grp"]): r for r in rows}
+        row_names = {r["name"] for r in rows}
+        names = [
+            n for n in dict.fromkeys(user_list) if n in start_counts or n in row_names
+        ]
+        res = []
+        for name in names:
+            last_pixels = start_counts.get(name)
+            found = name in start_counts
+            for group in groups:
+                row = rows_dict.get((name, group["grp"]))
+                if row is None and not found:
+                    continue
+                found = True
+                pixels = last_pixels if row is None else row["pixels"]
+                if pixels is None or last_pixels is None:
+                    placed = None
+                else:
+                    placed = pixels - last_pixels
+                res.append(
+                    dict(
+                        name=name,
+                        pixels=pixels,
+                        placed=placed,
+                        first_datetime=group["first_datetime"],
+                        last_datetime=group["last_datetime"],
+                    )
+                )
+                last_pixels = pixels
+        return res
+
     async def get_leaderboard_between(self, dt1, dt2, canvas, orderby_opt):
         """ Get the leaderboard between 2 dates
         ### Parameters
@@ -383,20 +753,22 @@ class DbStatsManager:
         ), "orderby paramater must be: 'placed', 'canvas' or 'alltime'"
         orderby = order_dict[orderby_opt]
 
+        stats_a, param_a = await self.get_user_stats_at_sql(record1["record_id"])
+        stats_b, param_b = await self.get_user_stats_at_sql(record2["record_id"])
+        stats_last, param_last = await self.get_user_stats_at_sql(
+            last_record["record_id"]
+        )
         sql = """
         SELECT
             ROW_NUMBER() OVER(ORDER BY ({0}) DESC) AS rank,
             pxls_name.name,
             last.{1}_count,
             b.{1}_count - a.{1}_count as placed
-        FROM pxls_user_stat a, pxls_user_stat b, pxls_user_stat last
+        FROM {2} a, {3} b, {4} last
         INNER JOIN(pxls_name) ON pxls_name.pxls_name_id = a.pxls_name_id
         WHERE a.pxls_name_id = b.pxls_name_id AND a.pxls_name_id = last.pxls_name_id
-            AND last.record_id = ?
-            AND a.record_id =  ?
-            AND b.record_id = ?
         ORDER BY {0} DESC""".format(
-            orderby, "canvas" if canvas else "alltime"
+            orderby, "canvas" if canvas else "alltime", stats_a, stats_b, stats_last
         )
 
         return (
@@ -404,10 +776,7 @@ class DbStatsManager:
             last_record["datetime"],
             record1["datetime"],
             record2["datetime"],
-            await self.db.sql_select(
-                sql,
-                (last_record["record_id"], record1["record_id"], record2["record_id"]),
-            ),
+            await self.db.sql_select(sql, param_a + param_b + param_last),
         )
 
     async def get_pixels_at(
@@ -422,42 +791,25 @@ class DbStatsManager:
             canvas_to_select = None
 
         record = await self.find_record(datetime, canvas_to_select)
-        record_id = record["record_id"]
-        sql = """
-            SELECT canvas_count, alltime_count, record_id
-            FROM pxls_user_stat
-            JOIN pxls_name ON pxls_name.pxls_name_id = pxls_user_stat.pxls_name_id
-            WHERE name = ?
-            AND record_id = ?"""
-        rows = await self.db.sql_select(sql, (user_name, record_id))
+        row = await self.get_user_stat_at(record["record_id"], "name = ?", (user_name,))
 
-        if len(rows) == 0:
+        if row is None:
             return (None, None)
         else:
-            return (record["datetime"], rows[0])
+            return (record["datetime"], row)
 
     async def find_record(self, dt, canvas_code=None):
         """find the record with  the closest date to the given date in the database
         :param dt: the datetime to find
         :param canvas_code: the canvas to find the record in, if None, will search among all the canvases"""
-        if canvas_code is None:
-            canvas_code = "NOT NULL"  # to get all the canvas codes
-        else:
-            canvas_code = f"'{str(canvas_code)}'"
-
-        sql = """
-            SELECT
-                record_id,
-                datetime,
-                canvas_code,
-                min(abs(JulianDay(datetime) - JulianDay(?)))*24*3600 as diff_with_time
-            FROM record
-            WHERE canvas_code IS {}
-            """.format(
-            canvas_code
-        )
-        res = await self.db.sql_select(sql, (dt))
-        return res[0]
+        if self.record_timeline is None:
+            await self.load_record_timeline()
+        timeline = self.record_timeline.get(canvas_code)
+        record = timeline.find_closest(to_naive_utc(dt)) if timeline else None
+        if record is None:
+            # no record found for this canvas
+            return dict(record_id=None, datetime=None, canvas_code=None)
+        return record
 
         # general stats functions #
 
@@ -466,23 +818,20 @@ class DbStatsManager:
         (this is used to plot the stat)"""
 
         if canvas_code is None:
-            sql = """
-                SELECT datetime, min(abs(JulianDay(datetime) - JulianDay(?)))*24*3600 as diff_with_time
-                FROM pxls_general_stat"""
+            where = None
+            param = ()
         else:
-            sql = """
-                SELECT datetime, min(abs(JulianDay(datetime) - JulianDay(?)))*24*3600 as diff_with_time
-                FROM pxls_general_stat
-                WHERE canvas_code = ?"""
+            where = "canvas_code = ?"
+            param = (canvas_code,)
 
-        closest_data1 = await self.db.sql_select(
-            sql, (dt1,) + ((canvas_code,) if canvas_code else ())
+        closest_data1 = await self.db.sql_select_closest(
+            "pxls_general_stat", dt1, where, param
         )
-        closest_dt1 = closest_data1[0][0]
-        closest_data2 = await self.db.sql_select(
-            sql, (dt2,) + ((canvas_code,) if canvas_code else ())
+        closest_dt1 = closest_data1["datetime"] if closest_data1 else None
+        closest_data2 = await self.db.sql_select_closest(
+            "pxls_general_stat", dt2, where, param
         )
-        closest_dt2 = closest_data2[0][0]
+        closest_dt2 = closest_data2["datetime"] if closest_data2 else None
 
         sql = """
             SELECT value, datetime, canvas_code
@@ -588,7 +937,8 @@ class DbStatsManager:
                     datetime,
                     canvas_code,
                     record.record_id,
-                    {0}-(LAG({0}) OVER (ORDER BY datetime)) as placed
+                    {0}-(LAG({0}) OVER (ORDER BY datetime)) as placed,
+                    LAG(record.record_id) OVER (ORDER BY datetime) as previous_record_id
                 FROM pxls_user_stat
                 JOIN record on record.record_id = pxls_user_stat.record_id
                 JOIN pxls_name on pxls_name.pxls_name_id = pxls_user_stat.pxls_name_id
@@ -596,7 +946,7 @@ class DbStatsManager:
                 AND datetime > ?
                 ORDER BY datetime desc
             ) p
-            WHERE p.placed = 0
+            WHERE p.placed = 0 OR p.previous_record_id < p.record_id - 1
             LIMIT 1""".format(
             "canvas_count" if canvas else "alltime_count"
         )
@@ -607,6 +957,13 @@ class DbStatsManager:
 
         if len(res) == 0:
             return None
+        elif res[0]["placed"] != 0:
+            # the user has no row in the previous (delta) records: it didn't
+            # place in the record just before this one
+            previous_record = await self.db.sql_select(
+                "SELECT * FROM record WHERE record_id = ?", res[0]["record_id"] - 1
+            )
+            return previous_record[0] if previous_record else None
         else:
             return res[0]
 
@@ -675,12 +1032,19 @@ class DbStatsManager:
             if len(res) == 0:
                 return None
 
-        # get the record just after the one we found
+        # get the record of the next row after the one we found
         # go get the last time where the count was the same as the given one
+        # (the users only have rows when their counts change in the delta records)
         record_id = res[0]["record_id"]
-        last_pixel_record = await self.db.sql_select(
-            "SELECT * FROM record WHERE record_id = ?", record_id + 1
-        )
+        sql = """
+            SELECT record.*
+            FROM pxls_user_stat
+            JOIN record on record.record_id = pxls_user_stat.record_id
+            WHERE pxls_name_id = ? AND pxls_user_stat.record_id > ?
+            ORDER BY pxls_user_stat.record_id
+            LIMIT 1
+        """
+        last_pixel_record = await self.db.sql_select(sql, (name_id, record_id))
         return last_pixel_record[0]
 
     async def get_stats_per_canvas(self, user_list):
@@ -702,16 +1066,16 @@ class DbStatsManager:
             for canvas in last_canvas_records:
                 record_id = canvas["record_id"]
                 canvas_code = canvas["canvas_code"]
-                sql = """
-                    SELECT name, alltime_count as pixels, canvas_count as placed, canvas_code
-                    FROM pxls_user_stat
-                        JOIN pxls_name on pxls_user_stat.pxls_name_id = pxls_name.pxls_name_id
-                        JOIN record r on r.record_id = pxls_user_stat.record_id
-                    WHERE r.record_id = ?
-                        AND name = ? """
-                rows = await self.db.sql_select(sql, (record_id, user))
-                if rows:
-                    user_data.append(rows[0])
+                row = await self.get_user_stat_at(record_id, "name = ?", (user,))
+                if row:
+                    user_data.append(
+                        {
+                            "name": user,
+                            "pixels": row["alltime_count"],
+                            "placed": row["canvas_count"],
+                            "canvas_code": canvas_code,
+                        }
+                    )
                 else:
                     user_data.append(
                         {
@@ -731,6 +1095,18 @@ class DbStatsManager:
         )
         return (past_time, now_time, res)
 
+    async def load_name_index(self):
+        """Index all the pxls names in memory."""
+        sql = "SELECT name FROM pxls_name ORDER BY pxls_name_id"
+        rows = await self.db.sql_select(sql)
+        self.name_index = NameIndex(r["name"] for r in rows)
+
+    async def search_pxls_names(self, string: str, limit: int = 25) -> list[str]:
+        """Get the pxls names containing a string, the recently active names first."""
+        if self.name_index is None:
+            await self.load_name_index()
+        return self.name_index.search(string, limit)
+
     async def get_all_pxls_names(self):
         sql = "SELECT name from pxls_name ORDER BY pxls_name_id"
         rows = await self.db.sql_select(sql)
@@ -773,12 +1149,27 @@ class DbStatsManager:
 
     async def get_snapshot_at(self, dt, canvas_code):
         """Get the snapshot closest to the given datetime (dt)"""
-        sql = """
-            SELECT
-                *,
-                min(abs(JulianDay(datetime) - JulianDay(?)))*24*3600 as diff_with_time
-            FROM snapshot
-            WHERE canvas_code = ?
-            """
-        res = await self.db.sql_select(sql, (dt, canvas_code))
-        return res[0] if res else None
+        return await self.db.sql_select_closest(
+            "snapshot", dt, "canvas_code = ?", (canvas_code,)
+        )
+
+
+class RecordTimeline:
+    """A list of records sorted by datetime to find the closest record to a
+    datetime with a binary search."""
+
+    def __init__(self) -> None:
+        self.datetimes: list[datetime] = []
+        self.records: list[dict] = []
+
+    def add(self, record: dict):
+        index = bisect.bisect_right(self.datetimes, record["datetime"])
+        self.datetimes.insert(index, record["datetime"])
+        self.records.insert(index, record)
+
+    def find_closest(self, dt: datetime):
+        """Find the record with the closest datetime to `dt` (None if the timeline is empty)."""
+        index = bisect.bisect_left(self.datetimes, dt)
+        before = self.records[index - 1] if index > 0 else None
+        after = self.records[index] if index < len(self.records) else None
+        return closest_row(before, after, dt)
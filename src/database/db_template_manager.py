@@ -3,7 +3,7 @@ from datetime import datetime, timezone
 # This import is only necessary for type hints
 from typing import TYPE_CHECKING
 
-from database.db_connection import DbConnection
+from database.db_connection import DbConnection, closest_row
 
 if TYPE_CHECKING:
     from utils.pxls.template_manager import Template, Combo
@@ -51,9 +51,20 @@ class DbTemplateManager:
                 FOREIGN KEY(template_id) REFERENCES template(id)
             );
         """
+        # covering index used to seek the progress of a template around a datetime
+        create_template_stat_index = """
+            CREATE INDEX IF NOT EXISTS template_stat_template_id_datetime
+            ON template_stat(template_id, datetime, progress);
+        """
+        create_template_stat_datetime_index = """
+            CREATE INDEX IF NOT EXISTS template_stat_datetime
+            ON template_stat(datetime);
+        """
         await self.db.sql_update(create_template_table)
         await self.db.sql_update(create_template_stat_table)
         await self.db.sql_update(create_template_manager_table)
+        await self.db.sql_update(create_template_stat_index)
+        await self.db.sql_update(create_template_stat_datetime_index)
 
     async def get_template_id(self, t: "Template"):
         """Return the template ID matching with the args from the database, Return None if it doesn't exist"""
@@ -88,6 +99,16 @@ class DbTemplateManager:
         sql = "INSERT INTO template_stat(template_id, datetime, progress) VALUES(?, ?, ?)"
         return await self.db.sql_insert(sql, (template_id, datetime, progress))
 
+    async def create_template_stats(self, stats: list):
+        """Add many template stats in the database in a single transaction.
+
+        :param stats: a list of (template_id, datetime, progress) tuples
+        :return: the number of stats inserted"""
+        if not stats:
+            return 0
+        sql = "INSERT INTO template_stat(template_id, datetime, progress) VALUES(?, ?, ?)"
+        return await self.db.sql_update_many(sql, stats)
+
     async def update_template(self, t: "Template", new_url, new_name, new_owner_id):
         """Update a template URL, return None"""
         template_id = await self.get_template_id(t)
@@ -120,39 +141,76 @@ class DbTemplateManager:
 
     async def get_template_progress(self, template: "Template", datetime):
         """Get the progress of a template at a given datetime"""
+        template_id = template.id or await self.get_template_id(template)
+        if not template_id:
+            return None
+        return await self.db.sql_select_closest(
+            "template_stat", datetime, "template_id = ?", (template_id,)
+        )
+
+    async def get_all_templates_progress_at(self, canvas_code, datetimes: list):
+        """Get the progress of all the templates of a canvas at the given datetimes.
+
+        For each datetime, the closest stat is found with 2 index seeks per template
+        (the last stat before and the first stat after the datetime).
+
+        Return a dictionary {template_id: [progress_at_datetime, ...]} with a dict
+        (`datetime`, `progress`) for each datetime or None if there is no stat."""
         sql = """
-            SELECT *, min(abs(JulianDay(datetime) - JulianDay(?)))*24*3600 as diff_with_time
-            FROM template_stat
-            WHERE template_id = (
-                SELECT id
+            WITH closest AS (
+                SELECT
+                    id,
+                    (
+                        SELECT rowid FROM template_stat
+                        WHERE template_id = template.id AND datetime <= ?
+                        ORDER BY datetime DESC LIMIT 1
+                    ) AS before_rowid,
+                    (
+                        SELECT rowid FROM template_stat
+                        WHERE template_id = template.id AND datetime >= ?
+                        ORDER BY datetime LIMIT 1
+                    ) AS after_rowid
                 FROM template
-                WHERE name = ? AND canvas_code = ? and owner_id = ? and hidden = ?
+                WHERE canvas_code = ?
             )
+            SELECT
+                closest.id AS template_id,
+                b.datetime AS before_datetime,
+                b.progress AS before_progress,
+                a.datetime AS after_datetime,
+                a.progress AS after_progress
+            FROM closest
+            LEFT JOIN template_stat b ON b.rowid = closest.before_rowid
+            LEFT JOIN template_stat a ON a.rowid = closest.after_rowid
         """
-        res = await self.db.sql_select(
-            sql,
-            (
-                datetime,
-                template.name,
-                template.canvas_code,
-                template.owner_id,
-                template.hidden,
-            ),
-        )
-        if not res or all([r is None for r in list(res[0])]):
-            return None
-        else:
-            return res[0]
+        res = {}
+        for i, dt in enumerate(datetimes):
+            rows = await self.db.sql_select(sql, (dt, dt, canvas_code))
+            for row in rows:
+                progress_list = res.setdefault(row["template_id"], [None] * len(datetimes))
+                before = after = None
+                if row["before_datetime"] is not None:
+                    before = dict(
+                        datetime=row["before_datetime"], progress=row["before_progress"]
+                    )
+                if row["after_datetime"] is not None:
+                    after = dict(
+                        datetime=row["after_datetime"], progress=row["after_progress"]
+                    )
+                progress_list[i] = closest_row(before, after, dt)
+        return res
 
     async def get_template_oldest_progress(self, template: "Template"):
-        """Get the progress of a template at a given datetime"""
+        """Get the oldest progress of a template"""
         template_id = await self.get_template_id(template)
         sql = """
-            SELECT *, min(abs(JulianDay(datetime) - JulianDay(?)))*24*3600 as diff_with_time
+            SELECT *
             FROM template_stat
             WHERE template_id = ?
+            ORDER BY datetime
+            LIMIT 1
         """
-        res = await self.db.sql_select(sql, (datetime.min, template_id))
+        res = await self.db.sql_select(sql, (template_id,))
         if not res:
             return None
         else:
@@ -190,11 +248,20 @@ class DbTemplateManager:
     async def create_combo_stat(self, combo: "Combo", datetime, progress):
         """Save the combo stats in the database, create a combo template in the
         database if it's not found"""
-        if not await self.get_template_id(combo):
-            await self.create_template(combo)
-            logger.info("New combo created in the database")
+        if not await self.get_combo_id(combo):
+            return None
         return await self.create_template_stat(combo, datetime, progress)
 
+    async def get_combo_id(self, combo: "Combo"):
+        """Get the combo ID and cache it in `combo.id`, create a combo template
+        in the database if it's not found"""
+        if combo.id is None:
+            combo.id = await self.get_template_id(combo)
+        if combo.id is None:
+            combo.id = await self.create_template(combo)
+            logger.info("New combo created in the database")
+        return combo.id
+
     async def check_duplicate_name(self, t: "Template"):
         sql = "SELECT * FROM template where LOWER(name) = LOWER(?) AND canvas_code = ? AND hidden = ?"
         res = await self.db.sql_select(sql, (t.name, t.canvas_code, t.hidden))
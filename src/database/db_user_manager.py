@@ -204,7 +204,15 @@ class DbUserManager:
             INNER JOIN pxls_name ON pxls_name.pxls_user_id = server_pxls_user.pxls_user_id
             INNER JOIN pxls_user_stat ON pxls_user_stat.pxls_name_id = pxls_name.pxls_name_id
             WHERE server_id = ?
-            AND record_id = (SELECT MAX(record_id) FROM record)
+            AND record_id = (
+                -- the last row of the user since the last full record
+                SELECT MAX(s.record_id) FROM pxls_user_stat s
+                WHERE s.pxls_name_id = pxls_name.pxls_name_id
+                AND s.record_id >= (
+                    SELECT MAX(record_id) FROM record
+                    WHERE record_id NOT IN (SELECT record_id FROM delta_record)
+                )
+            )
         """
         rows = await self.db.sql_select(sql, server_id)
         return rows
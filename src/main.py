@@ -6,6 +6,7 @@ import disnake
 from disnake.ext import commands
 from dotenv import load_dotenv
 
+from utils.http_client import get_http_client
 from utils.log import close_loggers, get_logger, setup_loggers
 from utils.pxls.template_manager import TemplateManager
 from utils.setup import (
@@ -13,6 +14,7 @@ from utils.setup import (
     GUILD_IDS,
     GUILD_MEMBER_MIN,
     db_canvas,
+    db_conn,
     db_servers,
     db_stats,
     db_templates,
@@ -31,7 +33,17 @@ allowed_mentions = disnake.AllowedMentions(
     roles=False,
     replied_user=False,
 )
-bot = commands.Bot(
+
+
+class Bot(commands.Bot):
+    async def close(self):
+        """Close the bot, then the shared HTTP session and database connections."""
+        await super().close()
+        await get_http_client().close()
+        await db_conn.close_pool()
+
+
+bot = Bot(
     command_prefix=db_servers.get_prefix,
     help_command=None,
     intents=intents,
@@ -39,6 +39,9 @@ async def get_stats_df(dt1, dt2, canvas: bool) -> pandas.DataFrame:
 
     record1 = await db_stats.find_record(dt1, canvas_code)
     record2 = await db_stats.find_record(dt2, canvas_code)
+    last_stats, last_stats_param = await db_stats.get_user_stats_at_sql(
+        record2["record_id"]
+    )
 
     sql = """
     SELECT datetime, name, alltime_count, canvas_count
@@ -49,10 +52,11 @@ async def get_stats_df(dt1, dt2, canvas: bool) -> pandas.DataFrame:
     AND record.canvas_code = ?
     AND pxls_user_stat.pxls_name_id in (
         SELECT pxls_name_id
-        FROM pxls_user_stat
-        WHERE record_id = ?
+        FROM {}
         ORDER BY canvas_count DESC
-        LIMIT 100 )"""
+        LIMIT 100 )""".format(
+        last_stats
+    )
 
     sql_colors = """
     SELECT datetime, color_name as name, amount_placed as canvas_count, color_hex
@@ -72,14 +76,48 @@ async def get_stats_df(dt1, dt2, canvas: bool) -> pandas.DataFrame:
                 record1["record_id"],
                 record2["record_id"],
                 canvas_code,
-                record2["record_id"],
-            ),
+            )
+            + last_stats_param,
         )
     print("nb rows:", len(rows))
 
     # step 1 - group by date
     users_dict = {}
     dates_dict = {}
+    if not colors:
+        # the users without a row in a delta record have the same counts as in
+        # their previous row: start from the counts at the first record and
+        # carry them forward on all the records
+        first_stats, first_stats_param = await db_stats.get_user_stats_at_sql(
+            record1["record_id"]
+        )
+        sql_first = """
+        SELECT name, alltime_count, canvas_count
+        FROM {} s
+        JOIN pxls_name ON pxls_name.pxls_name_id = s.pxls_name_id
+        WHERE s.pxls_name_id in (
+            SELECT pxls_name_id
+            FROM {}
+            ORDER BY canvas_count DESC
+            LIMIT 100 )""".format(
+            first_stats, last_stats
+        )
+        first_rows = await db_conn.sql_select(
+            sql_first, first_stats_param + last_stats_param
+        )
+        records = await db_conn.sql_select(
+            """
+            SELECT datetime FROM record
+            WHERE record_id BETWEEN ? AND ? AND canvas_code = ?
+            ORDER BY record_id""",
+            (record1["record_id"], record2["record_id"], canvas_code),
+        )
+        for record in records:
+            dates_dict[record["datetime"]] = {}
+        for row in first_rows:
+            dates_dict[record1["datetime"]][row["name"]] = (
+                row["canvas_count"] if canvas else row["alltime_count"]
+            )
     for row in rows:
         name = row["name"]
         dt = row["datetime"]
@@ -96,6 +134,12 @@ async def get_stats_df(dt1, dt2, canvas: bool) -> pandas.DataFrame:
 
         users_dict[name] = None
 
+    if not colors:
+        last_values = {}
+        for dt, values in dates_dict.items():
+            last_values.update(values)
+            dates_dict[dt] = dict(last_values)
+
     if not colors:
         # truncate the data to only keep the top 100 (at the time of dt2)
         last_values_sorted = sorted(
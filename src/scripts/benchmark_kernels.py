@@ -0,0 +1,114 @@
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from numba import get_num_threads  # noqa: E402
+
+from utils.image.ciede2000 import rgb2lab  # noqa: E402
+from utils.pxls.template import (  # noqa: E402
+    PARALLEL_CHUNK_ROWS,
+    UNSET_INDEX,
+    _fast_reduce,
+    _fast_reduce_parallel,
+    _fill_palette_lut,
+    _fill_palette_lut_parallel,
+    nearest_color_idx_ciede2000,
+    nearest_color_idx_euclidean,
+)
+from utils.pxls.template_manager import (  # noqa: E402
+    fast_detemplatize,
+    fast_detemplatize_parallel,
+)
+
+SIZES = [128, 256, 512, 1024, 2048]
+NB_COLORS = 32
+# number of distinct colors in the synthetic images
+IMAGE_COLORS = 50000
+STYLE_SIZE = 3
+
+
+def timeit(func, *args, repeat=3) -> float:
+    """Get the best time of `repeat` calls in milliseconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def make_image(size, rng: np.random.Generator) -> np.ndarray:
+    """Make an RGBA image with `IMAGE_COLORS` colors and some transparent pixels."""
+    colors = rng.integers(0, 256, (IMAGE_COLORS, 4), dtype=np.uint8)
+    colors[:, 3] = np.where(rng.random(IMAGE_COLORS) < 0.1, 0, 255)
+    return colors[rng.integers(0, IMAGE_COLORS, (size, size))]
+
+
+def make_styled_template(size, rng: np.random.Generator) -> np.ndarray:
+    """Make a template image styled with a dotted style."""
+    image = make_image(size, rng)
+    styled = np.zeros((size * STYLE_SIZE, size * STYLE_SIZE, 4), dtype=np.uint8)
+    styled[1::STYLE_SIZE, 1::STYLE_SIZE] = image
+    return styled
+
+
+def benchmark_reduce(image, palette, lab_palette):
+    serial = timeit(_fast_reduce, image, palette, nearest_color_idx_euclidean)
+    parallel = timeit(_fast_reduce_parallel, image, palette, False, PARALLEL_CHUNK_ROWS)
+    serial_lab = timeit(_fast_reduce, image, lab_palette, nearest_color_idx_ciede2000)
+    parallel_lab = timeit(
+        _fast_reduce_parallel, image, lab_palette, True, PARALLEL_CHUNK_ROWS, repeat=1
+    )
+    return serial, parallel, serial_lab, parallel_lab
+
+
+def benchmark_lut(image, lab_palette):
+    rgb = image[:, :, :3].astype(np.uint32)
+    keys = np.unique((rgb[:, :, 0] << 16) | (rgb[:, :, 1] << 8) | rgb[:, :, 2])
+
+    def fill_serial():
+        lut = np.full(2**24, UNSET_INDEX, dtype=np.uint8)
+        _fill_palette_lut(lut, keys, lab_palette, nearest_color_idx_ciede2000)
+
+    def fill_parallel():
+        lut = np.full(2**24, UNSET_INDEX, dtype=np.uint8)
+        _fill_palette_lut_parallel(lut, keys, lab_palette, True)
+
+    return timeit(fill_serial, repeat=1), timeit(fill_parallel, repeat=1)
+
+
+def benchmark_detemplatize(styled, size):
+    args = (styled, size, size, STYLE_SIZE)
+    return timeit(fast_detemplatize, *args), timeit(fast_detemplatize_parallel, *args)
+
+
+def main():
+    rng = np.random.default_rng(0)
+    palette = rng.integers(0, 256, (NB_COLORS, 3), dtype=np.uint8)
+    lab_palette = np.asarray([rgb2lab(color) for color in palette])
+
+    # compile the kernels before timing them
+    small_image = make_image(8, rng)
+    benchmark_reduce(small_image, palette, lab_palette)
+    benchmark_lut(small_image, lab_palette)
+    benchmark_detemplatize(make_styled_template(8, rng), 8)
+
+    print(f"{get_num_threads()} threads, times in ms (serial / parallel)\n")
+    header = ["size", "reduce", "reduce ciede2000", "lut ciede2000", "detemplatize"]
+    print("".join(f"{h:>24}" for h in header))
+    for size in SIZES:
+        image = make_image(size, rng)
+        r, rp, rl, rlp = benchmark_reduce(image, palette, lab_palette)
+        lut, lutp = benchmark_lut(image, lab_palette)
+        d, dp = benchmark_detemplatize(make_styled_template(size, rng), size)
+        results = [(r, rp), (rl, rlp), (lut, lutp), (d, dp)]
+        cells = [f"{size}x{size}"] + [f"{a:.1f} / {b:.1f}" for a, b in results]
+        print("".join(f"{c:>24}" for c in cells))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import argparse
 import asyncio
 import os
 import re
@@ -12,14 +13,25 @@ from bs4 import BeautifulSoup
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 
+from utils.http_client import get_http_client  # noqa: E402
+from utils.pxls.canvas_log import LogConverter, conversion_lock  # noqa: E402
 from utils.setup import PXLS_URL, DbCanvasManager, DbConnection  # noqa: E402
-from utils.utils import get_content  # noqa: E402
+from utils.utils import BadResponseError, get_content  # noqa: E402
 
 basepath = os.path.dirname(__file__)
 CANVASES_FOLDER = os.path.abspath(
     os.path.join(basepath, "..", "..", "resources", "canvases")
 )
 LOGS_URL = f"{PXLS_URL}/extra/logs/"
+# number of logs downloaded at the same time in batch mode
+DOWNLOAD_CONCURRENCY = 3
+# size of the chunks read from the download (in bytes)
+DOWNLOAD_CHUNK_SIZE = 2**20
+# number of chunks buffered between the download and the extraction
+QUEUE_SIZE = 16
+# minimum size of a log line (date, hash, x, y, color, action and the tabs), used
+# to allocate the columns before knowing the number of lines
+MIN_LINE_SIZE = 95
 
 
 def sizeof_fmt(num, suffix="B"):
@@ -49,7 +61,160 @@ async def get_logs_urls():
     return logs_urls
 
 
+class DownloadStream:
+    """A file-like object with the bytes of a download, read by the extraction
+    thread: the bytes of the partial file downloaded before and then the chunks
+    put in the queue by the download (an empty chunk at the end).
+
+    `read()` can return fewer bytes than asked, like a raw stream."""
+
+    def __init__(self, part_path, resume_size, queue: asyncio.Queue, loop) -> None:
+        self.part_file = open(part_path, "rb") if resume_size else None
+        self.resume_size = resume_size
+        self.queue = queue
+        self.loop = loop
+        self.chunk = b""
+        self.pos = 0
+        self.eof = False
+
+    def _next_chunk(self) -> bytes:
+        if self.part_file is not None:
+            chunk = self.part_file.read(min(DOWNLOAD_CHUNK_SIZE, self.resume_size))
+            self.resume_size -= len(chunk)
+            if chunk:
+                return chunk
+            self.part_file.close()
+            self.part_file = None
+        chunk = asyncio.run_coroutine_threadsafe(self.queue.get(), self.loop).result()
+        if isinstance(chunk, Exception):
+            raise chunk
+        return chunk
+
+    def read(self, size=-1) -> bytes:
+        if self.pos == len(self.chunk) and not self.eof:
+            self.chunk, self.pos = self._next_chunk(), 0
+            self.eof = not self.chunk
+        end = len(self.chunk) if size < 0 else self.pos + size
+        data = self.chunk[self.pos : end]
+        self.pos += len(data)
+        return data
+
+
+def extract_logs(stream: DownloadStream, extract_dir):
+    """Extract a .tar.xz stream and convert the logs to the columnar format while
+    they are extracted (run in a thread)."""
+    with tarfile.open(fileobj=stream, mode="r|xz") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            path = os.path.join(extract_dir, os.path.basename(member.name))
+            if not member.name.endswith(".log"):
+                with tar.extractfile(member) as src, open(path, "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+                continue
+            # the bot can't convert the log at the same time
+            with conversion_lock(path):
+                converter = LogConverter(path, member.size // MIN_LINE_SIZE + 1)
+                # the log gets its name once complete (an existing log is never
+                # partial)
+                with tar.extractfile(member) as src, open(path + ".part", "wb") as dst:
+                    for line in src:
+                        dst.write(line)
+                        converter.add_line(line.decode("utf-8"))
+                os.utime(path + ".part", (member.mtime, member.mtime))
+                os.replace(path + ".part", path)
+                converter.close()
+
+
+async def download_logs(log, extract_dir):
+    """Download the logs of a canvas, they are extracted and converted while they
+    are downloaded. The download is saved in a partial file resumed on the next
+    run if it is interrupted."""
+    os.makedirs(extract_dir, exist_ok=True)
+    part_path = os.path.join(extract_dir, log["filename"] + ".part")
+    resume_size = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {"Range": f"bytes={resume_size}-"} if resume_size else {}
+    timeout = aiohttp.ClientTimeout(sock_connect=10.0, sock_read=60.0)
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+
+    async with get_http_client().request(
+        "GET", log["url"], headers=headers, timeout=timeout
+    ) as r:
+        if r.status == 416:
+            # the partial file is already complete
+            response = None
+        elif r.status in (200, 206):
+            response = r
+            if r.status == 200:
+                # the server doesn't support resuming: start again
+                resume_size = 0
+        else:
+            raise BadResponseError(f"The URL leads to an error {r.status}")
+        if resume_size:
+            print(f"c{log['canvas_code']}: resuming from {sizeof_fmt(resume_size)}")
+
+        async def download():
+            try:
+                with open(part_path, "ab" if resume_size else "wb") as part_file:
+                    if response is not None:
+                        chunks = response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE)
+                        async for chunk in chunks:
+                            part_file.write(chunk)
+                            await queue.put(chunk)
+            except Exception as e:
+                # stop the extraction
+                await queue.put(e)
+                raise
+            await queue.put(b"")
+
+        stream = DownloadStream(part_path, resume_size, queue, loop)
+        download_task = asyncio.ensure_future(download())
+        extraction = loop.run_in_executor(None, extract_logs, stream, extract_dir)
+        try:
+            await asyncio.gather(download_task, extraction)
+        finally:
+            # the download is blocked if the extraction failed
+            download_task.cancel()
+    os.remove(part_path)
+
+
+async def download_canvas_logs(log, semaphore: asyncio.Semaphore = None):
+    canvas_code = log["canvas_code"]
+    extract_dir = os.path.join(CANVASES_FOLDER, canvas_code)
+    log_path = os.path.join(extract_dir, f"pixels_c{canvas_code}.sanit.log")
+    if os.path.exists(log_path):
+        print(f"c{canvas_code}: logs already downloaded (final image might be missing)")
+        return
+    async with semaphore or asyncio.Semaphore():
+        print(f"c{canvas_code}: downloading and extracting into {extract_dir}...")
+        start = time.time()
+        try:
+            await download_logs(log, extract_dir)
+        except Exception as e:
+            print(f"c{canvas_code}: failed ({e!r}), run again to resume the download")
+            return
+        print(f"c{canvas_code}: done in {round(time.time() - start, 2)} seconds")
+
+
 async def main():
+    parser = argparse.ArgumentParser(
+        description="Download the logs of the canvases that don't have logs yet."
+    )
+    parser.add_argument(
+        "-y",
+        "--yes",
+        action="store_true",
+        help="download all the logs without confirmation (batch mode)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=DOWNLOAD_CONCURRENCY,
+        help="number of logs downloaded at the same time in batch mode",
+    )
+    args = parser.parse_args()
     start = time.time()
 
     # getting the canvases that already have logs
@@ -60,58 +225,41 @@ async def main():
 
     # getting the logs available on the pxls page
     logs_urls = await get_logs_urls()
+    missing_logs = [
+        log for log in logs_urls if log["canvas_code"] not in canvases_with_logs
+    ]
 
-    for log in logs_urls:
+    if args.yes:
+        total, used, free = shutil.disk_usage("/")
+        print(f"{len(missing_logs)} logs to download, Free Space: {sizeof_fmt(free)}")
+        semaphore = asyncio.Semaphore(args.jobs)
+        await asyncio.gather(
+            *[download_canvas_logs(log, semaphore) for log in missing_logs]
+        )
+        missing_logs = []
+
+    for log in missing_logs:
         canvas_code = log["canvas_code"]
         logs_url = log["url"]
-        filename = log["filename"]
-        if canvas_code not in canvases_with_logs:
-            # get file size
-            session = aiohttp.ClientSession()
-            d = await session.head(logs_url)
-            await session.close()
+        # get file size
+        async with get_http_client().request("HEAD", logs_url) as d:
             size = d.content_length
 
-            # get disk free space
-            total, used, free = shutil.disk_usage("/")
-            print("-" * 73)
-            input_str = "Logs to download for c{}: {}\nSize: {}, Free Space: {} - Confirm download? (y/n): ".format(
-                canvas_code,
-                logs_url,
-                sizeof_fmt(size),
-                sizeof_fmt(free),
-            )
+        # get disk free space
+        total, used, free = shutil.disk_usage("/")
+        print("-" * 73)
+        input_str = "Logs to download for c{}: {}\nSize: {}, Free Space: {} - Confirm download? (y/n): ".format(
+            canvas_code,
+            logs_url,
+            sizeof_fmt(size),
+            sizeof_fmt(free),
+        )
 
-            if input(input_str).lower() == "y":
-                # check if log is already here
-                extract_dir = os.path.join(CANVASES_FOLDER, canvas_code)
-                log_path = os.path.join(extract_dir, f"pixels_c{canvas_code}.sanit.log")
-                if os.path.exists(log_path):
-                    print("Logs already downloaded (final canvas image might be missing)")
-                    continue
-
-                # download compressed
-                compressed_logs_path = os.path.join(os.curdir, filename)
-                print(f"Dowloading into {compressed_logs_path}... ", end="", flush=True)
-                compressed_logs = await get_content(logs_url, "bytes")
-                open(compressed_logs_path, "wb").write(compressed_logs)
-                print("done! ")
-
-                try:
-                    if not os.path.exists(extract_dir):
-                        os.makedirs(extract_dir)
-                    print(f"Extracting into {extract_dir}... ", end="", flush=True)
-                    tar = tarfile.open(compressed_logs_path, "r:xz")
-                    tar.extractall(extract_dir)
-                    tar.close()
-                    print("done!")
-                finally:
-                    print(f"Deleting {compressed_logs_path}... ", end="", flush=True)
-                    os.remove(compressed_logs_path)
-                    del compressed_logs_path
-                    print("done!")
-            else:
-                print("Cancelled")
+        if input(input_str).lower() == "y":
+            await download_canvas_logs(log)
+        else:
+            print("Cancelled")
+    await get_http_client().close()
     print("Done in", round(time.time() - start, 2), "seconds")
     return None
 
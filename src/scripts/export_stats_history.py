@@ -0,0 +1,46 @@
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from database.db_stats_history import StatsHistoryStore  # noqa: E402
+from utils.setup import DbConnection  # noqa: E402
+
+""" Script to export the user stats of finished canvases in the columnar history
+store (used to read the stats history of these canvases without SQLite) """
+
+
+async def main():
+    start = time.time()
+    db_conn = DbConnection()
+    store = StatsHistoryStore()
+
+    # the last canvas is still running so its history isn't exported
+    rows = await db_conn.sql_select(
+        "SELECT canvas_code, MAX(datetime) AS end FROM record GROUP BY canvas_code ORDER BY end"
+    )
+    canvas_codes = [r["canvas_code"] for r in rows if r["canvas_code"] is not None][:-1]
+
+    for canvas_code in canvas_codes:
+        if store.get(canvas_code) is not None:
+            print(f"c{canvas_code}: already exported")
+            continue
+        print(f"c{canvas_code}: exporting... ", end="", flush=True)
+        export_start = time.time()
+        history = await store.export_canvas(db_conn, canvas_code)
+        print(
+            "done! ({} users, {} records, {} events in {}s)".format(
+                len(history.name_ids),
+                len(history.record_ids),
+                len(history.record_indexes),
+                round(time.time() - export_start, 2),
+            )
+        )
+    await db_conn.close_pool()
+    print("Done in", round(time.time() - start, 2), "seconds")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
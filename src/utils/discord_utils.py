@@ -470,8 +470,7 @@ async def autocomplete_palette_with_none(inter: disnake.AppCmdInter, user_input:
 
 async def autocomplete_pxls_name(inter: disnake.AppCmdInter, user_input: str):
     """Auto-complete with all the pxls names in the database."""
-    names = await db_stats.get_all_pxls_names()
-    return [name for name in names if user_input.lower() in name.lower()][:25]
+    return await db_stats.search_pxls_names(user_input)
 
 
 async def autocomplete_builtin_palettes(inter: disnake.AppCmdInter, user_input: str):
@@ -0,0 +1,141 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Callable
+
+import aiohttp
+from aiohttp.client_exceptions import ClientConnectionError
+
+# maximum number of open connections (in total and for each host)
+CONNECTION_LIMIT = 100
+CONNECTION_LIMIT_PER_HOST = 10
+# time to keep an idle connection open to reuse it (in seconds)
+KEEPALIVE_TIMEOUT = 30
+# maximum size of a response body (in bytes)
+MAX_BODY_SIZE = 100 * 2**20  # 100 MB
+# number of times a request is retried and the delay before the first retry
+# (doubled after each retry)
+RETRIES = 2
+RETRY_BACKOFF = 0.5  # seconds
+# response status retried for the idempotent requests
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class HttpClient:
+    """An application-wide HTTP client with a pool of keep-alive connections.
+
+    All the requests share the same `aiohttp.ClientSession`, it is opened
+    lazily in the running event loop. The idempotent requests (GET and HEAD) are
+    retried with an exponential backoff on connection errors and on the
+    `RETRY_STATUSES`.
+
+    :param session_factory: a function returning the session to use, it can be
+    used to send the requests to a local server in tests"""
+
+    def __init__(
+        self,
+        session_factory: Callable[[], aiohttp.ClientSession] = None,
+        retries: int = RETRIES,
+        retry_backoff: float = RETRY_BACKOFF,
+        max_body_size: int = MAX_BODY_SIZE,
+    ) -> None:
+        self.session_factory = session_factory or self._make_session
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.max_body_size = max_body_size
+        self._session: aiohttp.ClientSession = None
+        self._session_loop = None
+
+    @staticmethod
+    def _make_session() -> aiohttp.ClientSession:
+        connector = aiohttp.TCPConnector(
+            limit=CONNECTION_LIMIT,
+            limit_per_host=CONNECTION_LIMIT_PER_HOST,
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=300,
+        )
+        # don't keep the cookies between the requests
+        return aiohttp.ClientSession(
+            connector=connector, cookie_jar=aiohttp.DummyCookieJar()
+        )
+
+    def get_session(self) -> aiohttp.ClientSession:
+        """Get the shared session, open it if it isn't opened in the current
+        event loop."""
+        loop = asyncio.get_running_loop()
+        if (
+            self._session is None
+            or self._session.closed
+            or self._session_loop is not loop
+        ):
+            # the connections are bound to the loop that opened them
+            # (the scripts can run more than one event loop)
+            self._session = self.session_factory()
+            self._session_loop = loop
+        return self._session
+
+    async def close(self):
+        """Close the shared session and its connections."""
+        loop = asyncio.get_running_loop()
+        if self._session is not None and self._session_loop is loop:
+            await self._session.close()
+        self._session = None
+        self._session_loop = None
+
+    @asynccontextmanager
+    async def request(self, method: str, url: str, retry: bool = None, **kwargs):
+        """Send a request and get the response in a context manager.
+
+        :param retry: retry the request on errors, default to True for the
+        idempotent requests
+        :param kwargs: the arguments of `aiohttp.ClientSession.request()`"""
+        session = self.get_session()
+        if retry is None:
+            retry = method.upper() in ("GET", "HEAD")
+        nb_attempts = self.retries + 1 if retry else 1
+        for attempt in range(nb_attempts):
+            last_attempt = attempt == nb_attempts - 1
+            try:
+                response = await session.request(method, url, **kwargs)
+            except (ClientConnectionError, asyncio.TimeoutError):
+                if last_attempt:
+                    raise
+            else:
+                if last_attempt or response.status not in RETRY_STATUSES:
+                    break
+                response.release()
+            await asyncio.sleep(self.retry_backoff * 2**attempt)
+        try:
+            yield response
+        finally:
+            response.release()
+
+    async def read(self, response: aiohttp.ClientResponse, max_size: int = -1) -> bytes:
+        """Read the body of a response, raise ValueError if it is bigger than
+        `max_size` bytes (default to `max_body_size`, None for no limit)."""
+        if max_size == -1:
+            max_size = self.max_body_size
+        too_big_error = ValueError("The response is too big.")
+        if max_size is not None and (response.content_length or 0) > max_size:
+            raise too_big_error
+        chunks = []
+        size = 0
+        async for chunk in response.content.iter_chunked(2**16):
+            size += len(chunk)
+            if max_size is not None and size > max_size:
+                raise too_big_error
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+
+_http_client = HttpClient()
+
+
+def get_http_client() -> HttpClient:
+    """Get the HTTP client shared by all the outbound requests."""
+    return _http_client
+
+
+def set_http_client(http_client: HttpClient):
+    """Replace the shared HTTP client (e.g. with a client using a test server)."""
+    global _http_client
+    _http_client = http_client
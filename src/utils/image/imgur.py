@@ -2,10 +2,10 @@ import json
 import os
 from io import BytesIO
 
-import aiohttp
 from dotenv import find_dotenv, load_dotenv, set_key
 from PIL import Image
 
+from utils.http_client import get_http_client
 from utils.log import get_logger
 from utils.utils import BadResponseError, in_executor
 
@@ -49,7 +49,8 @@ class Imgur:
             headers = {"Authorization": f"Client-ID {self.client_id}"}
         else:
             headers = headers = {"Authorization": f"Bearer {self.access_token}"}
-        async with aiohttp.request(method.lower(), url, headers=headers, data=data) as r:
+        http_client = get_http_client()
+        async with http_client.request(method, url, headers=headers, data=data) as r:
 
             if r.status == 403 and check_token:
                 # refresh the access token
@@ -61,7 +62,7 @@ class Imgur:
 
             if r.status != 200:
                 raise BadResponseError(f"The URL leads to an error {r.status}")
-            response_json = json.loads(await r.text())
+            response_json = json.loads(await http_client.read(r))
         if (
             "status" in response_json and response_json["status"] != 200
         ) or "error" in response_json:
@@ -1,13 +1,35 @@
+import asyncio
+import multiprocessing
 import os
 import re
-from hashlib import sha256
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from io import BytesIO
 
 import numpy as np
-from PIL import Image
+from PIL import Image, ImageColor
 
-from utils.setup import db_stats, stats
+from utils.log import get_logger
+from utils.plot_utils import get_gradient_palette, matplotlib_to_plotly
+from utils.pxls.canvas_log import (
+    CHUNK_SIZE,
+    LINES_CHUNK_SIZE,
+    CanvasLog,
+    find_user_rows_in_folder,
+    find_user_rows,
+    load_canvas_log,
+    load_heatmap,
+)
+from utils.pxls.log_replay import LogReplay
+from utils.setup import LOG_HASH_WORKERS, db_stats, stats
 from utils.utils import in_executor
 
+logger = get_logger(__name__)
+
+# number of pixels in the leaderboard of the most replaced pixels
+HEATMAP_TOP_N = 10
+
 basepath = os.path.dirname(__file__)
 CANVASES_FOLDER = os.path.abspath(
     os.path.join(basepath, "..", "..", "..", "resources", "canvases")
@@ -34,40 +56,102 @@ def get_canvas_image(input_canvas_code):
     return None
 
 
+_hash_pool: ProcessPoolExecutor = None
+
+
+def get_hash_pool() -> ProcessPoolExecutor:
+    """Get the process pool used to hash the logs (started on the first use).
+
+    The workers are forked from a forkserver (a single-threaded process with
+    `canvas_log` imported) and not from the bot process, which has running
+    threads and open connections."""
+    global _hash_pool
+    if _hash_pool is None:
+        mp_context = multiprocessing.get_context("forkserver")
+        mp_context.set_forkserver_preload(["utils.pxls.canvas_log"])
+        _hash_pool = ProcessPoolExecutor(
+            max_workers=LOG_HASH_WORKERS, mp_context=mp_context
+        )
+    return _hash_pool
+
+
+def shutdown_hash_pool():
+    """Stop the workers of the process pool used to hash the logs."""
+    global _hash_pool
+    if _hash_pool is not None:
+        _hash_pool.shutdown(wait=False, cancel_futures=True)
+        _hash_pool = None
+
+
+def find_user_rows_parallel(log: CanvasLog, user_key: str) -> np.ndarray:
+    """Find the rows placed by a user, with the log split in contiguous chunks
+    hashed in the process pool."""
+    global _hash_pool
+    chunks = range(0, len(log), LINES_CHUNK_SIZE)
+    try:
+        pool = get_hash_pool()
+        futures = [
+            pool.submit(
+                find_user_rows_in_folder,
+                log.folder,
+                user_key,
+                start,
+                start + LINES_CHUNK_SIZE,
+            )
+            for start in chunks
+        ]
+        results = [future.result() for future in futures]
+    except BrokenProcessPool:
+        logger.exception("The log hashing pool broke, hashing in the current thread:")
+        _hash_pool = None
+        results = [
+            find_user_rows(log, user_key, s, s + LINES_CHUNK_SIZE) for s in chunks
+        ]
+    if not results:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(results)
+
+
 @in_executor()
 def parse_log_file(log_file, user_key, res_array):
-    nb_undo = 0
-    nb_placed = 0
-    nb_replaced_by_others = 0
-    nb_replaced_by_you = 0
-    survived_map = res_array.copy()
-    with open(log_file) as logfile:
-        for line in logfile:
-            [date, random_hash, x, y, color_index, action] = line.split("\t")
-            digest_format = ",".join([date, x, y, color_index, user_key])
-            digested = sha256(digest_format.encode("utf-8")).hexdigest()
-
-            action = action.strip()
-            x = int(x)
-            y = int(y)
-            color_index = int(color_index)
-            if digested == random_hash:
-                # This is my pixel!
-                if action == "user place":
-                    nb_placed += 1
-                    if survived_map[y, x] != 255:
-                        nb_replaced_by_you += 1
-                    res_array[y, x] = color_index
-                    survived_map[y, x] = color_index
-                elif action == "user undo":
-                    nb_undo += 1
-                    res_array[y, x] = 255
-                    survived_map[y, x] = 255
-            else:
-                if survived_map[y, x] != 255:
-                    nb_replaced_by_others += 1
-                    survived_map[y, x] = 255
-    return res_array, nb_undo, nb_placed, nb_replaced_by_others, nb_replaced_by_you
+    log = load_canvas_log(log_file)
+    mine_rows = find_user_rows_parallel(log, user_key)
+    if len(mine_rows) == 0:
+        return res_array, 0, 0, 0, 0
+
+    height, width = res_array.shape
+    place = log.get_action_code("user place")
+    undo = log.get_action_code("user undo")
+
+    # only the rows at the positions where the user placed can change the stats
+    mine_positions = log.y[mine_rows].astype(np.int64) * width + log.x[mine_rows]
+    touched = np.zeros(height * width, dtype=bool)
+    touched[mine_positions] = True
+    rows = []
+    for start in range(0, len(log), CHUNK_SIZE):
+        end = start + CHUNK_SIZE
+        positions = log.y[start:end].astype(np.int64) * width + log.x[start:end]
+        rows.append(np.flatnonzero(touched[positions]) + start)
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+
+    replay = LogReplay(
+        log.y[rows].astype(np.int64) * width + log.x[rows],
+        log.action[rows],
+        log.color[rows],
+        place,
+        undo,
+        is_mine=np.isin(rows, mine_rows, assume_unique=True),
+        rows=rows,
+    )
+    counts = replay.get_counts()
+    replay.get_placemap(res_array.shape, out=res_array)
+    return (
+        res_array,
+        counts["nb_undo"],
+        counts["nb_placed"],
+        counts["nb_replaced_by_others"],
+        counts["nb_replaced_by_you"],
+    )
 
 
 async def get_user_placemap(canvas_code, user_key):
@@ -94,6 +178,81 @@ async def get_user_placemap(canvas_code, user_key):
     return res_image, nb_undo, nb_placed, nb_replaced_by_others, nb_replaced_by_you
 
 
+@lru_cache(maxsize=1)
+def get_heatmap_lut() -> np.ndarray:
+    """Get the RGBA lookup table with the color of each number of pixels placed
+    in a heatmap (the numbers above the table are clipped to its last color)."""
+    # 0: black (untouched pixels)
+    heatmap_palette = ["#000000"]
+    # from 1 to 20: plasma palette (dark blue -> yellow)
+    heatmap_palette += matplotlib_to_plotly("plasma", 20)
+    # from 21 to 520: yellow to white gradient
+    heatmap_palette += get_gradient_palette(["#EFF821", "#FFFFFF"], 500)
+    lut = np.array(
+        [ImageColor.getcolor(c, "RGBA") for c in heatmap_palette], dtype=np.uint8
+    )
+    lut.flags.writeable = False
+    return lut
+
+
+def colorize_heatmap(heatmap_array: np.ndarray) -> np.ndarray:
+    """Convert a heatmap to an RGBA array."""
+    lut = get_heatmap_lut()
+    return lut[np.clip(heatmap_array, 0, len(lut) - 1)]
+
+
+def get_top_replaced(heatmap_array: np.ndarray, n: int = HEATMAP_TOP_N) -> list:
+    """Get the n most replaced pixels of a heatmap as a list of (x, y, placed)
+    sorted by the number of pixels placed."""
+    n = min(n, heatmap_array.size)
+    if n == 0:
+        return []
+    part = np.argpartition(heatmap_array.ravel(), -n)[-n:]
+    y_coords, x_coords = np.divmod(part, heatmap_array.shape[1])
+    tops = heatmap_array[y_coords, x_coords]
+    top_list = list(zip(x_coords.tolist(), y_coords.tolist(), tops.tolist()))
+    top_list.sort(key=lambda i: i[-1], reverse=True)
+    return top_list
+
+
+# heatmaps of the archived canvases (their logs never change), the tasks are
+# shared by the requests made while the heatmap is built:
+# {canvas_code: task returning (PNG bytes, top replaced pixels, total placed)}
+_canvas_heatmaps = {}
+
+
+@in_executor()
+def make_canvas_heatmap(canvas_code):
+    log_file = get_log_file(canvas_code)
+    canvas_image = get_canvas_image(canvas_code)
+    shape = (canvas_image.height, canvas_image.width)
+    heatmap_array = load_heatmap(log_file, shape)
+    heatmap_image = Image.fromarray(colorize_heatmap(heatmap_array))
+    with BytesIO() as buffer:
+        heatmap_image.save(buffer, "PNG")
+        image_bytes = buffer.getvalue()
+    total = int(heatmap_array.sum())
+    return image_bytes, get_top_replaced(heatmap_array), total
+
+
+async def get_canvas_heatmap(canvas_code):
+    """Get the heatmap of an archived canvas as PNG bytes, the list of the most
+    replaced pixels (see `get_top_replaced`) and the number of pixels placed on
+    the canvas. The results are cached per canvas."""
+    task = _canvas_heatmaps.get(canvas_code)
+    if task is None:
+        task = asyncio.ensure_future(make_canvas_heatmap(canvas_code))
+        _canvas_heatmaps[canvas_code] = task
+    try:
+        # shielded so a cancelled request doesn't cancel the other ones
+        return await asyncio.shield(task)
+    except Exception:
+        # build it again on the next request
+        if _canvas_heatmaps.get(canvas_code) is task:
+            del _canvas_heatmaps[canvas_code]
+        raise
+
+
 def check_key(key: str):
     """Check if a key is valid (512 chars and hex) and remove empty spaces.
     Raises ValueError if the key is invalid."""
@@ -0,0 +1,354 @@
+import fcntl
+import json
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+from hashlib import sha256
+
+import numpy as np
+
+from utils.log import get_logger
+from utils.pxls.log_replay import LogReplay
+
+logger = get_logger(__name__)
+
+# name of the folder with the columns, next to the log file
+COLUMNS_FOLDER = "log_columns"
+# heatmap of a log, saved in the columns folder the first time it is computed
+HEATMAP_FILE = "heatmap.npy"
+# number of rows of the columns processed at a time
+CHUNK_SIZE = 2**20
+# number of lines parsed or hashed at a time, smaller because each line is a
+# python string
+LINES_CHUNK_SIZE = 2**16
+# columns of a canvas log: (name, dtype, shape of a row)
+COLUMNS = [
+    ("timestamp", np.int64, ()),  # milliseconds since epoch (UTC)
+    ("x", np.uint16, ()),
+    ("y", np.uint16, ()),
+    ("color", np.uint8, ()),
+    ("action", np.uint8, ()),  # index in `CanvasLog.actions`
+    ("hash", np.uint8, (32,)),  # SHA-256 digest
+]
+KNOWN_ACTIONS = ["user place", "user undo"]
+
+
+def parse_log_dates(dates: list[str]) -> np.ndarray:
+    """Convert the dates of a log ("2021-04-02 17:00:00,139") to timestamps in
+    milliseconds."""
+    dates = np.char.replace(np.array(dates), ",", ".")
+    return np.array(dates, dtype="datetime64[ms]").astype(np.int64)
+
+
+def format_log_dates(timestamps: np.ndarray) -> np.ndarray:
+    """Convert timestamps in milliseconds to the date strings of a log."""
+    dates = np.datetime_as_string(timestamps.astype("datetime64[ms]"), unit="ms")
+    return np.char.replace(np.char.replace(dates, "T", " "), ".", ",")
+
+
+class CanvasLog:
+    """The pixels of a canvas log in a columnar format.
+
+    Each column is a `.npy` file loaded as a memory-mapped array (see `COLUMNS`),
+    `info.json` has the number of rows, the list of the actions and the size and
+    modification time of the log it was made from."""
+
+    def __init__(self, folder: str) -> None:
+        self.folder = folder
+        with open(os.path.join(folder, "info.json")) as f:
+            self.info = json.load(f)
+        self.actions: list[str] = self.info["actions"]
+
+        def load(name):
+            return np.load(os.path.join(folder, f"{name}.npy"), mmap_mode="r")
+
+        self.timestamp: np.ndarray = load("timestamp")
+        self.x: np.ndarray = load("x")
+        self.y: np.ndarray = load("y")
+        self.color: np.ndarray = load("color")
+        self.action: np.ndarray = load("action")
+        self.hash: np.ndarray = load("hash")
+
+    def __len__(self) -> int:
+        return self.info["nb_rows"]
+
+    def get_action_code(self, action: str) -> int:
+        """Get the code of an action in the `action` column (-1 if the log doesn't
+        have this action)."""
+        try:
+            return self.actions.index(action)
+        except ValueError:
+            return -1
+
+    def get_dates(self, start: int = 0, end: int = None) -> np.ndarray:
+        """Get the date strings of the rows between start and end."""
+        return format_log_dates(self.timestamp[start:end])
+
+    def get_replay(self, start: int = 0, end: int = None, width: int = None):
+        """Get a `LogReplay` of the rows between start and end on the whole canvas.
+
+        :param width: the width of the canvas (to compute the positions)"""
+        positions = self.y[start:end].astype(np.int64) * width + self.x[start:end]
+        return LogReplay(
+            positions,
+            self.action[start:end],
+            self.color[start:end],
+            self.get_action_code("user place"),
+            self.get_action_code("user undo"),
+        )
+
+    def get_heatmap(self, shape: tuple[int, int]) -> np.ndarray:
+        """Count the pixels placed at each position (minus the undos)."""
+        heatmap = np.zeros(shape, dtype=np.int64)
+        for start in range(0, len(self), CHUNK_SIZE):
+            replay = self.get_replay(start, start + CHUNK_SIZE, width=shape[1])
+            heatmap += replay.get_heatmap(shape)
+        return heatmap
+
+
+def find_user_rows(
+    log: CanvasLog, user_key: str, start: int = 0, end: int = None
+) -> np.ndarray:
+    """Get the indexes of the rows of a log placed by the user with this key (the
+    hash of a row is the SHA-256 of "date,x,y,color,user_key")."""
+    end = len(log) if end is None else min(end, len(log))
+    dates = log.get_dates(start, end).tolist()
+    xs = log.x[start:end].tolist()
+    ys = log.y[start:end].tolist()
+    colors = log.color[start:end].tolist()
+    digests = b"".join(
+        sha256(f"{date},{x},{y},{color},{user_key}".encode("utf-8")).digest()
+        for date, x, y, color in zip(dates, xs, ys, colors)
+    )
+    digests = np.frombuffer(digests, dtype=np.uint8).reshape(-1, 32)
+    mine = (digests == log.hash[start:end]).all(axis=1)
+    return np.flatnonzero(mine) + start
+
+
+def find_user_rows_in_folder(folder: str, user_key: str, start: int, end: int):
+    # run in the worker processes: each worker maps the columns itself
+    return find_user_rows(CanvasLog(folder), user_key, start, end)
+
+
+def get_columns_folder(log_file: str) -> str:
+    return os.path.join(os.path.dirname(log_file), COLUMNS_FOLDER)
+
+
+def is_converted(log_file: str) -> bool:
+    """Check if a log has an up-to-date columnar copy."""
+    info_path = os.path.join(get_columns_folder(log_file), "info.json")
+    if not os.path.exists(info_path):
+        return False
+    with open(info_path) as f:
+        info = json.load(f)
+    log_stat = os.stat(log_file)
+    return info["log_size"] == log_stat.st_size and info["log_mtime"] == int(
+        log_stat.st_mtime
+    )
+
+
+_conversion_locks: dict[str, threading.Lock] = {}
+_conversion_locks_lock = threading.Lock()
+
+
+@contextmanager
+def conversion_lock(log_file: str):
+    """Lock the columnar copy of a log while it is checked or converted: with a
+    thread lock in this process and with a lock file between the processes (the
+    bot and the download script)."""
+    log_file = os.path.abspath(log_file)
+    with _conversion_locks_lock:
+        lock = _conversion_locks.setdefault(log_file, threading.Lock())
+    with lock, open(get_columns_folder(log_file) + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _load_canvas_log(log_file: str) -> CanvasLog:
+    # must be called with the conversion lock of the log
+    if not is_converted(log_file):
+        convert_log(log_file)
+    return CanvasLog(get_columns_folder(log_file))
+
+
+def load_canvas_log(log_file: str) -> CanvasLog:
+    """Get the columnar copy of a log, convert the log first if it isn't
+    converted yet (this can take a while for a large log)."""
+    with conversion_lock(log_file):
+        return _load_canvas_log(log_file)
+
+
+def load_heatmap(log_file: str, shape: tuple[int, int]) -> np.ndarray:
+    """Get the heatmap of a log (see `CanvasLog.get_heatmap`), it is computed
+    once and saved next to the columns of the log."""
+    with conversion_lock(log_file):
+        log = _load_canvas_log(log_file)
+        path = os.path.join(log.folder, HEATMAP_FILE)
+        if os.path.exists(path):
+            heatmap = np.load(path)
+            if heatmap.shape == tuple(shape):
+                return heatmap
+        heatmap = log.get_heatmap(shape)
+        try:
+            with open(path + ".tmp", "wb") as f:
+                np.save(f, heatmap)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            logger.warning(f"Couldn't save the heatmap of {log_file}: {e}")
+        return heatmap
+
+
+def count_lines(path: str) -> int:
+    nb_lines = 0
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**24), b""):
+            nb_lines += block.count(b"\n")
+            last = block
+        if nb_lines and not last.endswith(b"\n"):
+            # no line break after the last line
+            nb_lines += 1
+    return nb_lines
+
+
+def convert_log(log_file: str):
+    """Convert a tab-separated canvas log to the columnar format of `CanvasLog`
+    (with the conversion lock of the log, see `conversion_lock`)."""
+    converter = LogConverter(log_file, count_lines(log_file))
+    with open(log_file) as logfile:
+        for line in logfile:
+            converter.add_line(line)
+    converter.close()
+
+
+class LogConverter:
+    """Convert the lines of a log to the columnar format of `CanvasLog` as they
+    are added (e.g. while the log is downloaded).
+
+    The columns are allocated for `max_rows` rows and truncated to the number of
+    rows added in `close()`, the log file must be complete when it is called
+    (its size and modification time are saved in the info).
+
+    The columns are written in a temporary folder which replaces the columns
+    folder in `close()`, so the columns mapped by a `CanvasLog` are never
+    rewritten. It must be used with the conversion lock of the log."""
+
+    def __init__(self, log_file: str, max_rows: int) -> None:
+        self.log_file = log_file
+        self.folder = get_columns_folder(log_file) + ".tmp"
+        # remove the columns of an interrupted conversion
+        shutil.rmtree(self.folder, ignore_errors=True)
+        os.makedirs(self.folder)
+        self.info_path = os.path.join(self.folder, "info.json")
+
+        self.max_rows = max_rows
+        self.columns = {
+            name: np.lib.format.open_memmap(
+                os.path.join(self.folder, f"{name}.npy"),
+                mode="w+",
+                dtype=dtype,
+                shape=(max_rows, *row_shape),
+            )
+            for name, dtype, row_shape in COLUMNS
+        }
+        self.writer = ColumnsWriter(self.columns)
+        self.lines = []
+
+    def add_line(self, line: str):
+        if line.strip():
+            self.lines.append(line)
+        if len(self.lines) == LINES_CHUNK_SIZE:
+            self.writer.write(self.lines)
+            self.lines = []
+
+    def close(self):
+        """Write the last lines, truncate the columns and save the info."""
+        self.writer.write(self.lines)
+        self.lines = []
+        for column in self.columns.values():
+            column.flush()
+        nb_rows = self.writer.nb_rows
+        log_stat = os.stat(self.log_file)
+        info = dict(
+            nb_rows=nb_rows,
+            actions=self.writer.actions,
+            log_size=log_stat.st_size,
+            log_mtime=int(log_stat.st_mtime),
+        )
+        self.columns = self.writer = None
+
+        if nb_rows != self.max_rows:
+            # there were empty lines or fewer lines than allocated
+            for name, _, _ in COLUMNS:
+                truncate_column(os.path.join(self.folder, f"{name}.npy"), nb_rows)
+        with open(self.info_path, "w") as f:
+            json.dump(info, f)
+        replace_folder(self.folder, get_columns_folder(self.log_file))
+        logger.info(
+            f"Log converted to the columnar format: {self.log_file} ({nb_rows} rows)"
+        )
+
+
+def replace_folder(src: str, dst: str):
+    """Replace the folder dst with src, the files of dst are removed but they stay
+    readable where they are still open or memory-mapped."""
+    old = dst + ".old"
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.exists(dst):
+        os.replace(dst, old)
+    os.replace(src, dst)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def truncate_column(path: str, nb_rows: int):
+    column = np.load(path, mmap_mode="r")
+    truncated = np.lib.format.open_memmap(
+        path + ".tmp", mode="w+", dtype=column.dtype, shape=(nb_rows, *column.shape[1:])
+    )
+    for start in range(0, nb_rows, CHUNK_SIZE):
+        end = min(start + CHUNK_SIZE, nb_rows)
+        truncated[start:end] = column[start:end]
+    truncated.flush()
+    del column, truncated
+    os.replace(path + ".tmp", path)
+
+
+class ColumnsWriter:
+    """Parse chunks of log lines and write them in the column arrays."""
+
+    def __init__(self, columns: dict, actions: list[str] = None) -> None:
+        self.columns = columns
+        self.actions = (actions or KNOWN_ACTIONS).copy()
+        self.nb_rows = 0
+
+    def write(self, lines: list[str]):
+        if not lines:
+            return
+        start, end = self.nb_rows, self.nb_rows + len(lines)
+        rows = (line.split("\t") for line in lines)
+        dates, hashes, xs, ys, colors, actions = zip(*rows)
+        timestamps = parse_log_dates(dates)
+        # check that the dates can be formatted back for the hashes
+        if not np.array_equal(format_log_dates(timestamps), np.array(dates)):
+            raise ValueError("Unsupported date format in the log.")
+        self.columns["timestamp"][start:end] = timestamps
+        self.columns["x"][start:end] = np.array(xs, dtype=np.int64)
+        self.columns["y"][start:end] = np.array(ys, dtype=np.int64)
+        self.columns["color"][start:end] = np.array(colors, dtype=np.int64)
+        self.columns["action"][start:end] = [
+            self.get_action_code(action.strip()) for action in actions
+        ]
+        self.columns["hash"][start:end] = np.frombuffer(
+            bytes.fromhex("".join(hashes)), dtype=np.uint8
+        ).reshape(-1, 32)
+        self.nb_rows = end
+
+    def get_action_code(self, action: str) -> int:
+        try:
+            return self.actions.index(action)
+        except ValueError:
+            self.actions.append(action)
+            return len(self.actions) - 1
@@ -0,0 +1,112 @@
+import numpy as np
+
+
+class LogReplay:
+    """Replay the rows of a canvas log with array operations instead of a loop
+    over the rows.
+
+    The rows are grouped by position with a lexsort on (position, row index), so
+    the state of a pixel before a row is given by the previous row of its group:
+    - a place leaves its pixel on the canvas until the next row at its position
+    - an undo (or a row of another user when `is_mine` is given) removes it
+
+    :param positions: the position of each row (`y * width + x`)
+    :param actions: the action code of each row
+    :param colors: the color of each row
+    :param is_mine: a mask of the rows of the user the stats are computed for
+    (default to all the rows, to compute stats on the whole canvas)
+    :param rows: the index of each row in the log (default to their order)"""
+
+    def __init__(
+        self,
+        positions: np.ndarray,
+        actions: np.ndarray,
+        colors: np.ndarray,
+        place: int,
+        undo: int,
+        is_mine: np.ndarray = None,
+        rows: np.ndarray = None,
+    ) -> None:
+        self.positions = np.asarray(positions, dtype=np.int64)
+        self.actions = np.asarray(actions)
+        self.colors = np.asarray(colors)
+        self.place = place
+        self.undo = undo
+        if is_mine is None:
+            is_mine = np.ones(len(self.positions), dtype=bool)
+        self.is_mine = np.asarray(is_mine, dtype=bool)
+        if rows is None:
+            rows = np.arange(len(self.positions))
+        self.rows = np.asarray(rows)
+        self._sorted = None
+
+    def _get_sorted(self):
+        """Get the rows grouped by position (in the log order in each group),
+        without the rows of the user other than place/undo (they don't change
+        anything)."""
+        if self._sorted is None:
+            mine_place = self.is_mine & (self.actions == self.place)
+            mine_undo = self.is_mine & (self.actions == self.undo)
+            keep = ~self.is_mine | mine_place | mine_undo
+            order = np.flatnonzero(keep)
+            order = order[np.lexsort((self.rows[order], self.positions[order]))]
+            positions = self.positions[order]
+            self._sorted = dict(
+                order=order,
+                positions=positions,
+                mine_place=mine_place[order],
+                mine_undo=mine_undo[order],
+                is_mine=self.is_mine[order],
+                same_position=np.r_[False, positions[1:] == positions[:-1]],
+            )
+        return self._sorted
+
+    def get_counts(self) -> dict:
+        """Count the pixels placed and undone by the user, and the user's pixels
+        replaced by the user and by the others."""
+        s = self._get_sorted()
+        # the rows following a pixel of the user still on the canvas
+        after_survivor = s["same_position"] & np.r_[False, s["mine_place"][:-1]]
+        return dict(
+            nb_placed=int(np.count_nonzero(s["mine_place"])),
+            nb_undo=int(np.count_nonzero(s["mine_undo"])),
+            nb_replaced_by_you=int(np.count_nonzero(after_survivor & s["mine_place"])),
+            nb_replaced_by_others=int(np.count_nonzero(after_survivor & ~s["is_mine"])),
+        )
+
+    def get_last_writers(self, mask: np.ndarray = None) -> tuple[np.ndarray, np.ndarray]:
+        """Get the last row at each position (among the rows of `mask` if given,
+        in the sorted order of `_get_sorted()`).
+
+        :return: the positions and the indexes of their last row in the arrays
+        given to the constructor"""
+        s = self._get_sorted()
+        selected = np.arange(len(s["order"]))
+        if mask is not None:
+            selected = selected[mask]
+        positions = s["positions"][selected]
+        is_last = np.r_[positions[1:] != positions[:-1], True][: len(positions)]
+        return positions[is_last], s["order"][selected[is_last]]
+
+    def get_placemap(self, shape: tuple[int, int], out: np.ndarray = None) -> np.ndarray:
+        """Get the last pixel placed by the user at each position (255 if there
+        is none or if it was undone)."""
+        if out is None:
+            out = np.full(shape, 255, dtype=np.uint8)
+        s = self._get_sorted()
+        positions, last_rows = self.get_last_writers(s["is_mine"])
+        last_colors = np.where(
+            self.actions[last_rows] == self.place, self.colors[last_rows], 255
+        )
+        out.ravel()[positions] = last_colors
+        return out
+
+    def get_heatmap(self, shape: tuple[int, int]) -> np.ndarray:
+        """Count the pixels placed by the user at each position (minus the
+        undos)."""
+        weights = self.is_mine & (self.actions == self.place)
+        weights = weights.astype(np.int64) - (self.is_mine & (self.actions == self.undo))
+        heatmap = np.bincount(
+            self.positions, weights, minlength=shape[0] * shape[1]
+        ).astype(np.int64)
+        return heatmap.reshape(shape)
@@ -0,0 +1,76 @@
+import heapq
+from array import array
+
+
+def get_trigrams(string: str) -> set[str]:
+    return {string[i : i + 3] for i in range(len(string) - 2)}
+
+
+class NameIndex:
+    """An in-memory index of the pxls names used to find the names containing
+    a string (for the autocomplete).
+
+    Each name is indexed by the trigrams of its lowercased version: the names
+    containing a string are among the names with its rarest trigram. The strings
+    shorter than 3 characters are searched in all the names.
+
+    The results are ranked with the names starting with the string first, then
+    by recent activity (see `touch()`)."""
+
+    def __init__(self, names=()) -> None:
+        self.names: list[str] = []
+        self.lower_names: list[str] = []
+        # the value of `self.clock` when the name was last active
+        self.activity: list[int] = []
+        self.clock = 0
+        self.trigrams: dict[str, array] = {}
+        self._indexes: dict[str, int] = {}
+        for name in names:
+            self.add(name)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def add(self, name: str):
+        """Add a name in the index (nothing is done if it's already indexed)."""
+        if name in self._indexes:
+            return
+        index = len(self.names)
+        lower_name = name.lower()
+        self._indexes[name] = index
+        self.names.append(name)
+        self.lower_names.append(lower_name)
+        self.activity.append(0)
+        for trigram in get_trigrams(lower_name):
+            try:
+                self.trigrams[trigram].append(index)
+            except KeyError:
+                self.trigrams[trigram] = array("I", [index])
+
+    def touch(self, names: list[str]):
+        """Mark the names as the most recently active ones."""
+        self.clock += 1
+        for name in names:
+            index = self._indexes.get(name)
+            if index is not None:
+                self.activity[index] = self.clock
+
+    def search(self, string: str, limit: int = 25) -> list[str]:
+        """Get the best `limit` names containing the string (case-insensitive)."""
+        string = string.lower()
+        if len(string) < 3:
+            candidates = range(len(self.names))
+        else:
+            postings = [self.trigrams.get(t) for t in get_trigrams(string)]
+            if any(p is None for p in postings):
+                return []
+            candidates = min(postings, key=len)
+
+        lower_names = self.lower_names
+        matches = (i for i in candidates if string in lower_names[i])
+        best = heapq.nlargest(
+            limit,
+            matches,
+            key=lambda i: (lower_names[i].startswith(string), self.activity[i], -i),
+        )
+        return [self.names[i] for i in best]
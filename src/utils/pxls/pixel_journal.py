@@ -0,0 +1,269 @@
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+from utils.log import get_logger
+
+logger = get_logger(__name__)
+
+basepath = os.path.dirname(__file__)
+PIXEL_JOURNAL_FOLDER = os.path.abspath(
+    os.path.join(basepath, "..", "..", "..", "resources", "pixel_journal")
+)
+# a pixel placed on the board, the timestamp is in milliseconds (UTC)
+JOURNAL_DTYPE = np.dtype(
+    [("timestamp", "<i8"), ("x", "<u2"), ("y", "<u2"), ("color", "u1")]
+)
+# minimum time between 2 keyframes of a canvas (in seconds)
+KEYFRAME_INTERVAL = 6 * 3600
+
+
+def to_timestamp_ms(dt) -> int:
+    """Convert a datetime (naive datetimes are in UTC) or a UNIX timestamp in
+    seconds to a timestamp in milliseconds."""
+    if isinstance(dt, datetime):
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        dt = dt.timestamp()
+    return round(dt * 1000)
+
+
+def get_day(timestamp_ms: int) -> str:
+    return datetime.fromtimestamp(timestamp_ms / 1000, timezone.utc).strftime("%Y-%m-%d")
+
+
+class PixelJournal:
+    """An append-only journal of the pixels placed on the canvas.
+
+    The pixels received from the websocket are appended as fixed-width
+    `JOURNAL_DTYPE` records in a file per canvas and per day (UTC), and the
+    board is saved as a keyframe every `KEYFRAME_INTERVAL`. The board at any time
+    is the last keyframe before this time with the pixels placed since then.
+
+    When the websocket disconnects, the pixels placed until it reconnects are
+    missed: the journal is marked with `mark_gap()`, the pixels are ignored until
+    the next keyframe and this keyframe is saved whatever the interval is. The
+    pixels placed while the bot was down are missed too, so the journal starts
+    marked.
+
+    A keyframe is saved in 2 steps: `copy_keyframe()` copies the board while the
+    board lock is held and `save_keyframe()` writes the copy (in an executor).
+
+    Files in the canvas folder (`c<canvas_code>`):
+    - `<YYYY-MM-DD>.bin`: the pixels placed this day (raw records, they can be
+    memory-mapped with `np.memmap(path, dtype=JOURNAL_DTYPE)`)
+    - `keyframes/<timestamp>.npy`: the board at this timestamp (in ms)"""
+
+    def __init__(self, folder: str = PIXEL_JOURNAL_FOLDER, enabled: bool = True) -> None:
+        self.folder = folder
+        self.enabled = enabled
+        # canvas of the pixels received, set when a keyframe is saved
+        self.canvas_code = None
+        # pixels were missed since the last keyframe
+        self.has_gap = True
+        self._lock = threading.Lock()
+        self._file = None
+        self._file_path = None
+
+    def canvas_folder(self, canvas_code) -> str:
+        return os.path.join(self.folder, f"c{canvas_code}")
+
+    def keyframes_folder(self, canvas_code) -> str:
+        return os.path.join(self.canvas_folder(canvas_code), "keyframes")
+
+    # --- writer ---
+
+    def mark_gap(self):
+        """Stop journaling the pixels until the next keyframe because some pixels
+        were missed (called from the websocket thread when it disconnects)."""
+        with self._lock:
+            self.has_gap = True
+
+    def copy_keyframe(self, canvas_code, board_array: np.ndarray):
+        """Copy the board for a keyframe and start journaling the pixels of this
+        canvas, called with the board lock held so the pixels applied after the copy
+        are journaled.
+
+        :return: a (board copy, force) tuple to give to `save_keyframe()`, force is
+        True if pixels were missed since the last keyframe"""
+        if not self.enabled or canvas_code is None or board_array is None:
+            return None, False
+        board_copy = board_array.copy()
+        with self._lock:
+            if canvas_code != self.canvas_code:
+                self._close_file()
+                self.canvas_code = canvas_code
+            # the pixels after this copy can be journaled again
+            force, self.has_gap = self.has_gap, False
+        return board_copy, force
+
+    def save_keyframe(
+        self, canvas_code, board_array: np.ndarray, timestamp=None, force=False
+    ):
+        """Save a board copied with `copy_keyframe()` as a keyframe if the last
+        keyframe of the canvas is older than `KEYFRAME_INTERVAL` or if force is True.
+
+        :param timestamp: the time of the board (a datetime or a UNIX timestamp)"""
+        if not self.enabled or canvas_code is None or board_array is None:
+            return
+        timestamp_ms = to_timestamp_ms(time.time() if timestamp is None else timestamp)
+        keyframes = self.get_keyframe_timestamps(canvas_code)
+        if (
+            not force
+            and keyframes
+            and timestamp_ms - keyframes[-1] < KEYFRAME_INTERVAL * 1000
+        ):
+            return
+        folder = self.keyframes_folder(canvas_code)
+        path = os.path.join(folder, f"{timestamp_ms}.npy")
+        try:
+            os.makedirs(folder, exist_ok=True)
+            # write in a temporary file first so a keyframe is never incomplete
+            with open(path + ".tmp", "wb") as f:
+                np.save(f, board_array)
+            os.replace(path + ".tmp", path)
+            logger.debug(f"Pixel journal keyframe saved for canvas {canvas_code}")
+        except OSError as e:
+            logger.warning(f"Couldn't save the pixel journal keyframe: {e}")
+            if force:
+                self.mark_gap()
+
+    def append(self, timestamps_ms: np.ndarray, xs, ys, colors):
+        """Append a batch of pixels to the journal of the current canvas
+        (called from the websocket thread)."""
+        if not self.enabled or not len(timestamps_ms):
+            return
+        records = np.empty(len(timestamps_ms), dtype=JOURNAL_DTYPE)
+        records["timestamp"] = timestamps_ms
+        records["x"] = xs
+        records["y"] = ys
+        records["color"] = colors
+        with self._lock:
+            if self.canvas_code is None or self.has_gap:
+                # no keyframe to replay the pixels on
+                return
+            try:
+                first_day = get_day(int(records["timestamp"][0]))
+                if first_day == get_day(int(records["timestamp"][-1])):
+                    self._write(first_day, records)
+                else:
+                    # the batch is split on 2 days
+                    for record in records:
+                        self._write(get_day(int(record["timestamp"])), record[None])
+                self._file.flush()
+            except OSError as e:
+                logger.warning(f"Couldn't write in the pixel journal: {e}")
+
+    def _write(self, day: str, records: np.ndarray):
+        path = os.path.join(self.canvas_folder(self.canvas_code), f"{day}.bin")
+        if path != self._file_path:
+            self._close_file()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._file = open(path, "ab")
+            self._file_path = path
+        self._file.write(records.tobytes())
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+        self._file_path = None
+
+    def close(self):
+        with self._lock:
+            self._close_file()
+
+    # --- reader ---
+
+    def get_keyframe_timestamps(self, canvas_code) -> list[int]:
+        """Get the sorted timestamps (in ms) of the keyframes of a canvas."""
+        folder = self.keyframes_folder(canvas_code)
+        if not os.path.exists(folder):
+            return []
+        return sorted(
+            int(f[: -len(".npy")]) for f in os.listdir(folder) if f.endswith(".npy")
+        )
+
+    def get_keyframe(self, canvas_code, timestamp) -> tuple[int, np.ndarray]:
+        """Get the last keyframe of a canvas before a time as a (timestamp in ms,
+        memory-mapped board) tuple, or (None, None) if there is none."""
+        timestamp_ms = to_timestamp_ms(timestamp)
+        keyframes = [
+            t for t in self.get_keyframe_timestamps(canvas_code) if t <= timestamp_ms
+        ]
+        if not keyframes:
+            return None, None
+        path = os.path.join(self.keyframes_folder(canvas_code), f"{keyframes[-1]}.npy")
+        return keyframes[-1], np.load(path, mmap_mode="r")
+
+    def read_events(self, canvas_code, start, end) -> np.ndarray:
+        """Get the pixels placed on a canvas between 2 times (start excluded,
+        end included) as an array of `JOURNAL_DTYPE` records."""
+        start_ms = to_timestamp_ms(start)
+        end_ms = to_timestamp_ms(end)
+        folder = self.canvas_folder(canvas_code)
+        if not os.path.exists(folder):
+            return np.empty(0, dtype=JOURNAL_DTYPE)
+        start_day, end_day = get_day(start_ms), get_day(end_ms)
+        # the file names sort in the chronological order
+        day_files = sorted(
+            f
+            for f in os.listdir(folder)
+            if f.endswith(".bin") and start_day <= f[: -len(".bin")] <= end_day
+        )
+        events = []
+        for day_file in day_files:
+            path = os.path.join(folder, day_file)
+            # ignore an incomplete record at the end of the file
+            nb_records = os.path.getsize(path) // JOURNAL_DTYPE.itemsize
+            if nb_records == 0:
+                continue
+            records = np.memmap(
+                path, dtype=JOURNAL_DTYPE, mode="r", shape=(nb_records,)
+            )
+            timestamps = records["timestamp"]
+            first = np.searchsorted(timestamps, start_ms, side="right")
+            last = np.searchsorted(timestamps, end_ms, side="right")
+            events.append(np.array(records[first:last]))
+        if not events:
+            return np.empty(0, dtype=JOURNAL_DTYPE)
+        return np.concatenate(events)
+
+    def get_board_at(self, canvas_code, timestamp, region=None) -> np.ndarray:
+        """Rebuild the board of a canvas (or a region of it) at a given time from the
+        last keyframe before this time and the pixels placed since then.
+
+        :param region: a (x0, y0, x1, y1) tuple (x1 and y1 excluded), default to the
+        whole board
+        :return: the board array or None if there is no keyframe before this time"""
+        keyframe_ms, keyframe = self.get_keyframe(canvas_code, timestamp)
+        if keyframe is None:
+            return None
+        if region is None:
+            x0, y0, x1, y1 = 0, 0, keyframe.shape[1], keyframe.shape[0]
+        else:
+            x0, y0, x1, y1 = region
+            x0, y0 = max(x0, 0), max(y0, 0)
+            x1, y1 = min(x1, keyframe.shape[1]), min(y1, keyframe.shape[0])
+        board = np.array(keyframe[y0:y1, x0:x1])
+        events = self.read_events(canvas_code, keyframe_ms / 1000, timestamp)
+        apply_events(board, events, x0, y0)
+        return board
+
+
+def apply_events(board: np.ndarray, events: np.ndarray, x0: int = 0, y0: int = 0):
+    """Apply journal records in order on a board whose top-left pixel is at
+    (x0, y0), the records outside of the board are ignored."""
+    xs = events["x"].astype(np.int64) - x0
+    ys = events["y"].astype(np.int64) - y0
+    height, width = board.shape
+    inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+    positions = (ys * width + xs)[inside]
+    colors = events["color"][inside]
+    # keep the last pixel placed at each position
+    reversed_positions = positions[::-1]
+    unique_positions, last = np.unique(reversed_positions, return_index=True)
+    board.ravel()[unique_positions] = colors[::-1][last]
@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+# This import is only necessary for type hints
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from utils.pxls.template_manager import Template
+
+
+class ProgressEngine:
+    """An index of the placeable pixels of many templates used to compute the
+    progress of all the templates (and their combo) in a single pass over the board.
+
+    All the placeable pixels of the templates are flattened in 3 arrays sorted by
+    their position on the canvas:
+    - `indexes`: the index of the pixel in the flattened canvas
+    - `colors`: the color expected by the template at this pixel
+    - `labels`: the index of the template in the `templates` list
+
+    The first pixel of each canvas position is the one from the template on top
+    (the first one in the list), it's the pixel used in the combo.
+
+    Once a board is tracked with `track()`, the progress counters can be kept up
+    to date pixel by pixel with `update_pixel()`, the sorted `indexes` array is
+    used as a spatial index to find the templates covering a pixel."""
+
+    def __init__(self, templates: list[Template], canvas_shape: tuple[int, int]) -> None:
+        self.templates = list(templates)
+        self.canvas_shape = canvas_shape
+        canvas_width = canvas_shape[1]
+
+        indexes_list = []
+        colors_list = []
+        labels_list = []
+        for label, template in enumerate(self.templates):
+            ys, xs = np.nonzero(template.placeable_mask)
+            indexes_list.append((ys + template.oy) * canvas_width + (xs + template.ox))
+            colors_list.append(template.palettized_array[ys, xs])
+            labels_list.append(np.full(len(ys), label, dtype=np.int32))
+
+        if self.templates:
+            indexes = np.concatenate(indexes_list).astype(np.int64)
+            colors = np.concatenate(colors_list).astype(np.uint8)
+            labels = np.concatenate(labels_list)
+        else:
+            indexes = np.zeros(0, dtype=np.int64)
+            colors = np.zeros(0, dtype=np.uint8)
+            labels = np.zeros(0, dtype=np.int32)
+
+        # stable sort to keep the templates order for the same canvas position
+        order = np.argsort(indexes, kind="stable")
+        self.indexes: np.ndarray = indexes[order]
+        self.colors: np.ndarray = colors[order]
+        self.labels: np.ndarray = labels[order]
+
+        # mask of the pixels visible in the combo (the top pixel at each position)
+        self.top_mask = np.ones(len(self.indexes), dtype=bool)
+        self.top_mask[1:] = self.indexes[1:] != self.indexes[:-1]
+
+        # live progress counters (init with self.track())
+        self.board_array = None
+        self.board_version = None
+        self.progress = np.zeros(len(self.templates), dtype=np.int64)
+        self.combo_progress = 0
+
+    def matches(self, templates: list[Template], canvas_shape: tuple[int, int]) -> bool:
+        """Check if the engine was built with the same templates (in the same
+        order) and canvas size."""
+        return (
+            self.canvas_shape == canvas_shape
+            and len(self.templates) == len(templates)
+            and all(a is b for a, b in zip(self.templates, templates))
+        )
+
+    def compute(self, board_array: np.ndarray) -> tuple[np.ndarray, int]:
+        """Compute the number of correct pixels of every template and of the combo.
+
+        Return a tuple (progress, combo_progress) where `progress[i]` is the
+        number of correct pixels of `templates[i]`."""
+        correct = board_array.ravel()[self.indexes] == self.colors
+        progress = np.bincount(self.labels[correct], minlength=len(self.templates))
+        combo_progress = int(np.count_nonzero(correct & self.top_mask))
+        return progress, combo_progress
+
+    def track(
+        self, board_array: np.ndarray, board_version=None
+    ) -> tuple[np.ndarray, int]:
+        """Compute the progress on the given board and keep it in the live
+        counters, the board must then be updated with `update_pixel()`."""
+        self.progress, self.combo_progress = self.compute(board_array)
+        self.board_array = board_array
+        self.board_version = board_version
+        return self.progress, self.combo_progress
+
+    def is_tracking(self, board_array: np.ndarray, board_version=None) -> bool:
+        """Check if the live counters are tracking the given board (the board
+        buffers are reused so the version is also checked)."""
+        return self.board_array is board_array and self.board_version == board_version
+
+    def update_pixel(self, x: int, y: int, old_color: int, new_color: int) -> list[int]:
+        """Update the live counters with a pixel placed on the tracked board.
+
+        Return the labels of the templates with a progress change."""
+        if old_color == new_color:
+            return []
+        index = y * self.canvas_shape[1] + x
+        start = np.searchsorted(self.indexes, index, side="left")
+        end = np.searchsorted(self.indexes, index, side="right")
+        changed_labels = []
+        for i in range(start, end):
+            expected_color = self.colors[i]
+            delta = int(new_color == expected_color) - int(old_color == expected_color)
+            if delta == 0:
+                continue
+            label = self.labels[i]
+            self.progress[label] += delta
+            changed_labels.append(label)
+            if self.top_mask[i]:
+                self.combo_progress += delta
+        return changed_labels
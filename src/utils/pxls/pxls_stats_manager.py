@@ -1,6 +1,8 @@
 import math
+import threading
 import uuid
 from datetime import datetime
+from functools import lru_cache
 
 import numpy as np
 import pytz
@@ -27,6 +29,15 @@ class PxlsStatsManager:
         self.virginmap_array = None
         self.placemap_array = None
         self.palette = None
+        # RGBA lookup table of the current palette (see get_palette_lut())
+        self._palette_lut = None
+        # lock held while the board is updated from the websocket thread
+        self.board_lock = threading.Lock()
+        # incremented every time a new board is fetched
+        self.board_version = 0
+        # the boards are fetched in a back buffer and swapped with the current one
+        # so the current board is never seen half-updated
+        self._back_buffers = {}
 
     async def refresh(self):
 
@@ -118,6 +129,7 @@ class PxlsStatsManager:
             return palette
 
     async def update_palette(self):
+        old_palette = self.palette
         self.palette = None
         try:
             self.palette = self.board_info["palette"]
@@ -130,6 +142,8 @@ class PxlsStatsManager:
             # couldn't get the palette from the board info or stats info
             # so we get the last palette saved in the database
             self.palette = await self.get_db_palette()
+        if self.palette != old_palette:
+            self._palette_lut = None
         return self.palette
 
     async def get_db_palette(self):
@@ -180,64 +194,80 @@ class PxlsStatsManager:
                 VALUES(?,?,?,?)"""
         await self.db_conn.sql_update(sql, ("online_count", count, canvas_code, dt))
 
-    def palettize_array(self, array, palette=None):
+    def get_palette_lut(self, palette=None) -> np.ndarray:
+        """Get the RGBA lookup table of a palette (a list of hex colors) or of
+        the current pxls palette if no palette is given."""
+        if palette:
+            return make_palette_lut(tuple(palette))
+        if self._palette_lut is None:
+            self._palette_lut = make_palette_lut(
+                tuple(f"#{c['value']}" for c in self.get_palette(restricted=True))
+            )
+        return self._palette_lut
+
+    def palettize_array(self, array, palette=None, out=None):
         """Convert a numpy array of palette indexes to a color numpy array
         (RGBA). If a palette is given, it will be used to map the array, if not
-        the current pxls palette will be used"""
-        colors_list = []
-        if not palette:
-            palette = [f"#{c['value']}" for c in self.get_palette(restricted=True)]
-        for color in palette:
-            rgb = ImageColor.getcolor(color, "RGBA")
-            colors_list.append(rgb)
-        colors_dict = dict(enumerate(colors_list))
-        colors_dict[255] = (0, 0, 0, 0)
-
-        img = np.stack(np.vectorize(colors_dict.get)(array), axis=-1)
-        return img.astype(np.uint8)
+        the current pxls palette will be used.
+
+        The result is written in `out` if given (an uint8 array with the shape
+        of the array and 4 channels)."""
+        lut = self.get_palette_lut(palette)
+        return np.take(lut, array, axis=0, out=out)
+
+    def decode_board(self, board_bytes: bytes, out: np.ndarray = None) -> np.ndarray:
+        """Decode the raw bytes of a board to an array of palette indexes.
+
+        The bytes are read without copy (`np.frombuffer`) and copied in `out` if
+        it is given, the array returned is always writable."""
+        shape = (self.board_info["height"], self.board_info["width"])
+        board_array = np.frombuffer(board_bytes, dtype=np.uint8).reshape(shape)
+        if out is None:
+            return board_array.copy()
+        np.copyto(out, board_array)
+        return out
+
+    def _swap_board(self, name: str, board_bytes: bytes) -> np.ndarray:
+        """Decode a board in the back buffer of the attribute `name` and swap it
+        with the current board."""
+        shape = (self.board_info["height"], self.board_info["width"])
+        current = getattr(self, name)
+        back = self._back_buffers.get(name)
+        if back is None or back.shape != shape or back is current:
+            back = np.empty(shape, dtype=np.uint8)
+        board_array = self.decode_board(board_bytes, out=back)
+        with self.board_lock:
+            setattr(self, name, board_array)
+            if name == "board_array":
+                self.board_version += 1
+        # the previous board stays valid until the next fetch
+        self._back_buffers[name] = current
+        return board_array
 
     async def fetch_board(self):
         "fetch the board with a get request"
         board_bytes = await self.query("boarddata", "bytes")
-        board_array = np.asarray(list(board_bytes), dtype=np.uint8).reshape(
-            self.board_info["height"], self.board_info["width"]
-        )
-        self.board_array = board_array
-        return board_array
+        return self._swap_board("board_array", board_bytes)
 
     async def fetch_virginmap(self):
         "fetch the virgin map with a get request"
         board_bytes = await self.query("virginmap", "bytes")
-        board_array = np.asarray(list(board_bytes), dtype=np.uint8).reshape(
-            self.board_info["height"], self.board_info["width"]
-        )
-        self.virginmap_array = board_array
-        return board_array
+        return self._swap_board("virginmap_array", board_bytes)
 
     async def fetch_heatmap(self):
         "fetch the heatmap with a get request"
         board_bytes = await self.query("heatmap", "bytes")
-        board_array = np.asarray(list(board_bytes), dtype=np.uint8).reshape(
-            self.board_info["height"], self.board_info["width"]
-        )
-        return board_array
+        return self.decode_board(board_bytes)
 
     async def fetch_initial_canvas(self):
         "fetch the initial canvas with a get request"
         board_bytes = await self.query("initialboarddata", "bytes")
-        board_array = np.asarray(list(board_bytes), dtype=np.uint8).reshape(
-            self.board_info["height"], self.board_info["width"]
-        )
-        return board_array
+        return self.decode_board(board_bytes)
 
     async def fetch_placemap(self):
         "fetch the placemap with a get request"
         board_bytes = await self.query("placemap", "bytes")
-        board_array = np.asarray(list(board_bytes), dtype=np.uint8).reshape(
-            self.board_info["height"], self.board_info["width"]
-        )
-        self.placemap_array = board_array
-        return board_array
+        return self._swap_board("placemap_array", board_bytes)
 
     async def get_placable_board(self):
         """fetch the board as an index array and use the placemap as a mask"""
@@ -249,11 +279,33 @@ class PxlsStatsManager:
 
         return placeable_board
 
-    def update_board_pixel(self, x, y, color):
-        self.board_array[y, x] = color
-
-    def update_virginmap_pixel(self, x, y, color):
-        self.virginmap_array[y, x] = 0
+    def update_board_pixels(
+        self, xs: np.ndarray, ys: np.ndarray, colors: np.ndarray
+    ) -> np.ndarray:
+        """Update a batch of pixels on the board (in the order of the arrays) and
+        return the previous color of each pixel.
+
+        If a pixel is placed more than once in the batch, its previous color is
+        the color of the previous placement and the last color is kept."""
+        board = self.board_array
+        positions = ys * board.shape[1] + xs
+        old_colors = board.ravel()[positions]
+        if len(positions) > 1:
+            order = np.argsort(positions, kind="stable")
+            sorted_positions = positions[order]
+            repeated = sorted_positions[1:] == sorted_positions[:-1]
+            if repeated.any():
+                sorted_old_colors = old_colors[order]
+                sorted_old_colors[1:][repeated] = colors[order][:-1][repeated]
+                old_colors[order] = sorted_old_colors
+                last = order[np.r_[~repeated, True]]
+                positions, colors = positions[last], colors[last]
+        board.ravel()[positions] = colors
+        return old_colors
+
+    def update_virginmap_pixels(self, xs: np.ndarray, ys: np.ndarray):
+        """Mark a batch of pixels as non-virgin."""
+        self.virginmap_array[ys, xs] = 0
 
     async def query(self, endpoint, content_type):
         url = self.base_url + endpoint
@@ -294,3 +346,19 @@ class PxlsStatsManager:
             return self.board_info["cooldownInfo"]["activityCooldown"]["multiplier"]
         except Exception:
             return 1.0
+
+
+@lru_cache(maxsize=32)
+def make_palette_lut(palette: tuple) -> np.ndarray:
+    """Make a lookup table with the RGBA color of each palette index, the index
+    255 and the indexes out of the palette are transparent.
+
+    The table has 256 rows or more for the palettes with more than 256 colors
+    (used to map arrays of counts)."""
+    lut = np.zeros((max(256, len(palette)), 4), dtype=np.uint8)
+    for i, color in enumerate(palette):
+        if i != 255:
+            lut[i] = ImageColor.getcolor(color, "RGBA")
+    # the LUT is shared between the calls
+    lut.flags.writeable = False
+    return lut
@@ -0,0 +1,151 @@
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from utils.log import get_logger
+
+logger = get_logger(__name__)
+
+basepath = os.path.dirname(__file__)
+SNAPSHOTS_FOLDER = os.path.abspath(
+    os.path.join(basepath, "..", "..", "..", "resources", "snapshots")
+)
+# size of the square tiles of the snapshots (in pixels)
+TILE_SIZE = 256
+# number of days the snapshots are kept
+RETENTION_DAYS = 30
+DATETIME_FORMAT = "%Y%m%dT%H%M%S"
+
+
+class SnapshotStore:
+    """A local store of the canvas snapshots, used to make the timelapses without
+    downloading the snapshots sent on Discord.
+
+    Each snapshot is saved as the palettized board (array of palette indexes) in a
+    `.npz` file per canvas and datetime (UTC), with a compressed array per tile of
+    `TILE_SIZE` pixels. A region of a snapshot is read by decompressing only the
+    tiles it covers.
+
+    The snapshots older than `retention_days` are removed when a snapshot is
+    saved (they are kept forever if it is 0), the timelapses download them from
+    Discord instead."""
+
+    def __init__(
+        self,
+        folder: str = SNAPSHOTS_FOLDER,
+        tile_size: int = TILE_SIZE,
+        retention_days: int = RETENTION_DAYS,
+    ):
+        self.folder = folder
+        self.tile_size = tile_size
+        self.retention_days = retention_days
+
+    def canvas_folder(self, canvas_code) -> str:
+        return os.path.join(self.folder, f"c{canvas_code}")
+
+    def get_path(self, canvas_code, dt: datetime) -> str:
+        filename = f"{dt.strftime(DATETIME_FORMAT)}.npz"
+        return os.path.join(self.canvas_folder(canvas_code), filename)
+
+    def save(self, canvas_code, dt: datetime, board_array: np.ndarray):
+        """Save a palettized board as the snapshot of a canvas at a datetime
+        (naive in UTC)."""
+        height, width = board_array.shape
+        tiles = {}
+        for y in range(0, height, self.tile_size):
+            for x in range(0, width, self.tile_size):
+                tile = board_array[y : y + self.tile_size, x : x + self.tile_size]
+                tiles[f"t{y // self.tile_size}_{x // self.tile_size}"] = tile
+        path = self.get_path(canvas_code, dt)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write in a temporary file first so a snapshot is never incomplete
+            with open(path + ".tmp", "wb") as f:
+                np.savez_compressed(
+                    f,
+                    shape=np.array([height, width]),
+                    tile_size=np.array(self.tile_size),
+                    **tiles,
+                )
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            logger.warning(f"Couldn't save the snapshot in the store: {e}")
+        if self.retention_days:
+            self.prune(dt - timedelta(days=self.retention_days))
+
+    def prune(self, before: datetime):
+        """Remove the snapshots of all the canvases older than a datetime (naive in
+        UTC)."""
+        if not os.path.isdir(self.folder):
+            return
+        removed = 0
+        for canvas_folder in os.listdir(self.folder):
+            if not canvas_folder.startswith("c"):
+                continue
+            canvas_code = canvas_folder[1:]
+            for dt in self.get_snapshot_datetimes(canvas_code, dt2=before):
+                if dt == before:
+                    continue
+                try:
+                    os.remove(self.get_path(canvas_code, dt))
+                    removed += 1
+                except OSError as e:
+                    logger.warning(f"Couldn't remove the snapshot {dt}: {e}")
+        if removed:
+            logger.debug(f"{removed} old snapshot(s) removed from the store")
+
+    def get_snapshot_datetimes(self, canvas_code, dt1=None, dt2=None) -> list[datetime]:
+        """Get the sorted datetimes (naive in UTC) of the snapshots of a canvas
+        between 2 datetimes."""
+        folder = self.canvas_folder(canvas_code)
+        if not os.path.exists(folder):
+            return []
+        datetimes = []
+        for filename in os.listdir(folder):
+            if not filename.endswith(".npz"):
+                continue
+            try:
+                dt = datetime.strptime(filename[: -len(".npz")], DATETIME_FORMAT)
+            except ValueError:
+                continue
+            if (dt1 is None or dt >= dt1) and (dt2 is None or dt <= dt2):
+                datetimes.append(dt)
+        return sorted(datetimes)
+
+    def get_shape(self, canvas_code, dt: datetime) -> tuple[int, int]:
+        """Get the shape (height, width) of a snapshot."""
+        with np.load(self.get_path(canvas_code, dt)) as snapshot:
+            return tuple(int(v) for v in snapshot["shape"])
+
+    def read(self, canvas_code, dt: datetime, region=None) -> np.ndarray:
+        """Read a snapshot or a region of it.
+
+        :param region: a (x0, y0, x1, y1) tuple (x1 and y1 excluded), the pixels out
+        of the canvas are transparent (255), default to the whole canvas
+        :return: the array of palette indexes of the region"""
+        with np.load(self.get_path(canvas_code, dt)) as snapshot:
+            height, width = (int(v) for v in snapshot["shape"])
+            tile_size = int(snapshot["tile_size"])
+            if region is None:
+                region = (0, 0, width, height)
+            x0, y0, x1, y1 = region
+            res = np.full((y1 - y0, x1 - x0), 255, dtype=np.uint8)
+            # part of the region inside the canvas
+            cx0, cy0 = max(x0, 0), max(y0, 0)
+            cx1, cy1 = min(x1, width), min(y1, height)
+            if cx0 >= cx1 or cy0 >= cy1:
+                return res
+            for ty in range(cy0 // tile_size, (cy1 - 1) // tile_size + 1):
+                for tx in range(cx0 // tile_size, (cx1 - 1) // tile_size + 1):
+                    tile = snapshot[f"t{ty}_{tx}"]
+                    # intersection of the tile and the region
+                    ix0 = max(cx0, tx * tile_size)
+                    iy0 = max(cy0, ty * tile_size)
+                    ix1 = min(cx1, tx * tile_size + tile.shape[1])
+                    iy1 = min(cy1, ty * tile_size + tile.shape[0])
+                    res[iy0 - y0 : iy1 - y0, ix0 - x0 : ix1 - x0] = tile[
+                        iy0 - ty * tile_size : iy1 - ty * tile_size,
+                        ix0 - tx * tile_size : ix1 - tx * tile_size,
+                    ]
+            return res
@@ -1,9 +1,12 @@
 # code base by Nanineye#2417
 
+import hashlib
 import os
+import threading
+from collections import OrderedDict
 
 import numpy as np
-from numba import jit
+from numba import jit, prange
 from numba.core import types
 from numba.typed import Dict
 from PIL import Image
@@ -15,6 +18,25 @@ from utils.setup import stats
 
 logger = get_logger(__name__)
 
+basepath = os.path.dirname(__file__)
+PALETTE_LUT_FOLDER = os.path.abspath(
+    os.path.join(basepath, "..", "..", "..", "resources", "palette_lut")
+)
+# value of the colors not matched yet in a palette lookup table
+UNSET_INDEX = 254
+# number of lookup tables kept in memory (16 MiB each)
+PALETTE_LUT_CACHE_SIZE = 8
+# minimum number of pixels (or new colors for a lookup table) to use all the
+# cores, below this the parallel kernels are slower than the serial ones
+PARALLEL_MIN_PIXELS = 512 * 512
+PARALLEL_MIN_COLORS = 4096
+# number of rows reduced by a thread at a time
+PARALLEL_CHUNK_ROWS = 64
+# held while a parallel kernel runs: numba's default threading layer (workqueue)
+# aborts the process if parallel kernels are launched from several threads at
+# once, so the other threads use the serial kernels meanwhile
+parallel_lock = threading.Lock()
+
 
 class InvalidStyleException(Exception):
     def __init__(self, *args: object) -> None:
@@ -164,6 +186,147 @@ def _fast_reduce(array, palette, dist_func):
     return res
 
 
+@jit(nopython=True, parallel=True, cache=True)
+def _fast_reduce_parallel(array, palette, ciede2000_matching, chunk_rows):
+    res = np.empty(array.shape[:2], dtype=np.uint8)
+    height, width = array.shape[:2]
+    nb_chunks = (height + chunk_rows - 1) // chunk_rows
+    for chunk in prange(nb_chunks):
+        # each chunk has its own cache so the threads don't share a dict
+        cache = Dict.empty(key_type=types.uint64, value_type=types.uint8)
+        for i in range(chunk * chunk_rows, min(height, (chunk + 1) * chunk_rows)):
+            for j in range(width):
+                if array[i, j, 3] > 128:
+                    color = array[i, j, :3]
+                    color_bit = np.uint64(
+                        (np.int64(color[0]) << 16) + (np.int64(color[1]) << 8) + color[2]
+                    )
+                    if color_bit in cache:
+                        res[i, j] = cache[color_bit]
+                    else:
+                        mapped_color_idx = _nearest_color_idx(
+                            color, palette, ciede2000_matching
+                        )
+                        cache[color_bit] = mapped_color_idx
+                        res[i, j] = mapped_color_idx
+                else:
+                    res[i, j] = 255
+    return res
+
+
+@jit(nopython=True, cache=True)
+def _fill_palette_lut(lut, color_keys, palette, dist_func):
+    color = np.empty(3, dtype=np.uint8)
+    for color_key in color_keys:
+        if lut[color_key] == UNSET_INDEX:
+            color[0] = (color_key >> 16) & 0xFF
+            color[1] = (color_key >> 8) & 0xFF
+            color[2] = color_key & 0xFF
+            lut[color_key] = dist_func(color, palette)
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def _fill_palette_lut_parallel(lut, color_keys, palette, ciede2000_matching):
+    # the keys are unique so each thread writes different entries
+    for k in prange(len(color_keys)):
+        color_key = color_keys[k]
+        if lut[color_key] == UNSET_INDEX:
+            color = np.empty(3, dtype=np.uint8)
+            color[0] = (color_key >> 16) & 0xFF
+            color[1] = (color_key >> 8) & 0xFF
+            color[2] = color_key & 0xFF
+            lut[color_key] = _nearest_color_idx(color, palette, ciede2000_matching)
+
+
+class PaletteLUT:
+    """A lookup table with the index of the nearest palette color of every
+    24-bit RGB color.
+
+    The table is filled lazily: the colors are matched the first time they are
+    seen, so an image is reduced with a single gather once its colors are known.
+    The table is memory-mapped from `PALETTE_LUT_FOLDER` so the matched colors are
+    kept between restarts (it stays in memory if the file can't be made)."""
+
+    def __init__(self, palette: np.ndarray, matching: str) -> None:
+        self.matching = matching
+        self.palette = palette
+        self.ciede2000_matching = matching != "fast"
+        if matching == "fast":
+            self.dist_func = nearest_color_idx_euclidean
+            self.match_palette = palette
+        else:
+            self.dist_func = nearest_color_idx_ciede2000
+            self.match_palette = np.asarray([rgb2lab(color) for color in palette])
+        self.table = self._open_table(get_palette_lut_key(palette, matching))
+
+    @staticmethod
+    def _open_table(key: str) -> np.ndarray:
+        path = os.path.join(PALETTE_LUT_FOLDER, f"{key}.npy")
+        try:
+            if not os.path.exists(path):
+                os.makedirs(PALETTE_LUT_FOLDER, exist_ok=True)
+                # make the file in a temporary file so it's never incomplete
+                tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                table = np.lib.format.open_memmap(
+                    tmp_path, mode="w+", dtype=np.uint8, shape=(2**24,)
+                )
+                table[:] = UNSET_INDEX
+                table.flush()
+                del table
+                os.replace(tmp_path, path)
+            table = np.load(path, mmap_mode="r+")
+        except (OSError, ValueError) as e:
+            logger.warning(f"Couldn't open the palette lookup table file: {e}")
+            table = np.full(2**24, UNSET_INDEX, dtype=np.uint8)
+        return table.view(np.ndarray)
+
+    def lookup(self, color_keys: np.ndarray) -> np.ndarray:
+        """Get the palette index of the given colors (as `0xRRGGBB` integers)."""
+        res = self.table[color_keys]
+        missing = res == UNSET_INDEX
+        if missing.any():
+            missing_keys = color_keys[missing]
+            new_keys = np.unique(missing_keys)
+            use_parallel = len(new_keys) >= PARALLEL_MIN_COLORS
+            if use_parallel and parallel_lock.acquire(blocking=False):
+                try:
+                    _fill_palette_lut_parallel(
+                        self.table, new_keys, self.match_palette, self.ciede2000_matching
+                    )
+                finally:
+                    parallel_lock.release()
+            else:
+                _fill_palette_lut(
+                    self.table, new_keys, self.match_palette, self.dist_func
+                )
+            res[missing] = self.table[missing_keys]
+        return res
+
+
+_palette_luts: "OrderedDict[str, PaletteLUT]" = OrderedDict()
+_palette_luts_lock = threading.Lock()
+
+
+def get_palette_lut_key(palette: np.ndarray, matching: str) -> str:
+    palette = np.ascontiguousarray(palette, dtype=np.uint8)
+    return f"{matching}_{hashlib.sha1(palette.tobytes()).hexdigest()[:16]}"
+
+
+def get_palette_lut(palette: np.ndarray, matching: str) -> PaletteLUT:
+    """Get the lookup table of a palette of RGB colors (make it if it's not in
+    the cache)."""
+    key = get_palette_lut_key(palette, matching)
+    # the images are reduced in executor threads
+    with _palette_luts_lock:
+        if key in _palette_luts:
+            _palette_luts.move_to_end(key)
+        else:
+            _palette_luts[key] = PaletteLUT(palette, matching)
+            if len(_palette_luts) > PALETTE_LUT_CACHE_SIZE:
+                _palette_luts.popitem(last=False)
+        return _palette_luts[key]
+
+
 def reduce(array: np.array, palette: np.array, matching="fast") -> np.array:
     """Convert an image array of RGBA colors to an array of palette index
     matching the nearest color in the given palette
@@ -186,12 +349,31 @@ def reduce(array: np.array, palette: np.array, matching="fast") -> np.array:
     # Get rid of the alpha component
     palette = palette[:, :3]
 
+    if len(palette) < UNSET_INDEX:
+        # map the colors with the lookup table of the palette
+        rgb = array[:, :, :3].astype(np.uint32)
+        color_keys = rgb[:, :, 0] << 16
+        color_keys |= rgb[:, :, 1] << 8
+        color_keys |= rgb[:, :, 2]
+        opaque = array[:, :, 3] > 128
+        res = np.full(array.shape[:2], 255, dtype=np.uint8)
+        res[opaque] = get_palette_lut(palette, matching).lookup(color_keys[opaque])
+        return res
+
     if matching == "fast":
         dist_func = nearest_color_idx_euclidean
     else:
         dist_func = nearest_color_idx_ciede2000
         palette = np.asarray([rgb2lab(color) for color in palette])
 
+    use_parallel = array.shape[0] * array.shape[1] >= PARALLEL_MIN_PIXELS
+    if use_parallel and parallel_lock.acquire(blocking=False):
+        try:
+            return _fast_reduce_parallel(
+                array, palette, matching != "fast", PARALLEL_CHUNK_ROWS
+            )
+        finally:
+            parallel_lock.release()
     res = _fast_reduce(array, palette, dist_func)
     return res
 
@@ -233,6 +415,15 @@ def nearest_color_idx_euclidean(color, palette) -> int:
     return np.argmin(distances)
 
 
+@jit(nopython=True, cache=True)
+def _nearest_color_idx(color, palette, ciede2000_matching) -> int:
+    """Find the nearest color with the matching algorithm as an argument
+    (to call it from the parallel kernels)."""
+    if ciede2000_matching:
+        return nearest_color_idx_ciede2000(color, palette)
+    return nearest_color_idx_euclidean(color, palette)
+
+
 @jit(nopython=True, cache=True)
 def fast_templatize(n, m, st, red, style_size):
     res = np.zeros((style_size * n, style_size * m, 4), dtype=np.uint8)
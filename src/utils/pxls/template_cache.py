@@ -0,0 +1,79 @@
+import hashlib
+import os
+
+import numpy as np
+
+from utils.log import get_logger
+
+logger = get_logger(__name__)
+
+basepath = os.path.dirname(__file__)
+TEMPLATE_CACHE_FOLDER = os.path.abspath(
+    os.path.join(basepath, "..", "..", "..", "resources", "template_cache")
+)
+
+
+def get_palette_hash(palette: list[str]) -> str:
+    """Get a short hash of a palette (a list of hex colors)."""
+    return hashlib.sha1(",".join(palette).lower().encode()).hexdigest()[:16]
+
+
+class TemplateCache:
+    """An on-disk cache of the palettized arrays of the templates, used to make
+    the templates without downloading and reducing their image again.
+
+    Each array is saved in a `.npy` file named after the hash of the template
+    URL and of the palette used to reduce the image. Only the tracked templates
+    are saved and the files of the templates that aren't tracked anymore are
+    removed with `prune()`."""
+
+    def __init__(self, folder: str = TEMPLATE_CACHE_FOLDER) -> None:
+        self.folder = folder
+
+    def get_path(self, template_url: str, palette_hash: str) -> str:
+        key = hashlib.sha256(f"{palette_hash}:{template_url}".encode()).hexdigest()
+        return os.path.join(self.folder, f"{key}.npy")
+
+    def load(self, template_url: str, palette_hash: str) -> np.ndarray:
+        """Get the cached array of a template or None if it isn't cached."""
+        path = self.get_path(template_url, palette_hash)
+        if not os.path.exists(path):
+            return None
+        try:
+            return np.load(path)
+        except Exception as e:
+            logger.warning(f"Couldn't load the cached template {path}: {e}")
+            return None
+
+    def save(self, template_url: str, palette_hash: str, palettized_array: np.ndarray):
+        """Save the array of a template in the cache."""
+        path = self.get_path(template_url, palette_hash)
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            # write in a temporary file first so a cached file is never incomplete
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, palettized_array)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Couldn't save the template in the cache: {e}")
+
+    def prune(self, template_urls: list[str], palette_hash: str):
+        """Remove the cached arrays that aren't for one of the template URLs
+        with the palette."""
+        if not os.path.isdir(self.folder):
+            return
+        keep = set(
+            os.path.basename(self.get_path(url, palette_hash)) for url in template_urls
+        )
+        removed = 0
+        for filename in os.listdir(self.folder):
+            if filename in keep:
+                continue
+            try:
+                os.remove(os.path.join(self.folder, filename))
+                removed += 1
+            except OSError as e:
+                logger.warning(f"Couldn't remove {filename} from the cache: {e}")
+        if removed:
+            logger.debug(f"{removed} untracked template(s) removed from the cache")
@@ -1,7 +1,9 @@
 from __future__ import annotations
 
 import asyncio
+import bisect
 import copy
+import itertools
 import os
 import re
 import sqlite3
@@ -15,19 +17,33 @@ from urllib.parse import parse_qs, urlparse
 import disnake
 import numpy as np
 from dotenv import load_dotenv
-from numba import jit
+from numba import jit, prange
 from PIL import Image
 
 from utils.font.font_manager import PixelText
 from utils.image.gif_saver import save_transparent_gif
 from utils.image.image_utils import highlight_image
 from utils.log import get_logger
-from utils.pxls.template import get_rgba_palette, reduce
+from utils.pxls.progress_engine import ProgressEngine
+from utils.pxls.template import (
+    PARALLEL_MIN_PIXELS,
+    get_rgba_palette,
+    parallel_lock,
+    reduce,
+)
+from utils.pxls.template_cache import TemplateCache, get_palette_hash
 from utils.setup import PXLS_URL, db_templates, stats
 from utils.time_converter import round_minutes_down, td_format
 from utils.utils import get_content, in_executor
 
 logger = get_logger("template_manager")
+
+# maximum number of templates downloaded at the same time (in total and per host)
+TEMPLATE_LOAD_CONCURRENCY = 10
+TEMPLATE_LOAD_PER_HOST = 3
+
+# cache of the palettized template arrays
+template_cache = TemplateCache()
 tracker_logger = get_logger("template_tracker", file="templates.log", in_console=False)
 
 
@@ -41,7 +57,10 @@ class Template:
         ox: int,
         oy: int,
         canvas_code,
+        palettized_array: np.ndarray = None,
     ) -> None:
+        """Make a template from its RGBA image array, or from its `palettized_array`
+        if it's given (`image_array` is then ignored)."""
         # template metadata
         self.url = url
         self.stylized_url = stylized_url
@@ -56,9 +75,9 @@ class Template:
         self.id = None
 
         # template image and array
-        self.palettized_array: np.ndarray = reduce(
-            image_array, get_rgba_palette()
-        )  # array of palette indexes
+        if palettized_array is None:
+            palettized_array = reduce(image_array, get_rgba_palette())
+        self.palettized_array: np.ndarray = palettized_array  # array of palette indexes
 
         # template size and dimensions
         self.width = self.palettized_array.shape[1]
@@ -390,6 +409,7 @@ class Combo(Template):
         self.owner_id = bot_id
         self.hidden = False
         self.name = name
+        self.id = None
 
         self.palettized_array: np.ndarray = palettized_array
 
@@ -413,6 +433,11 @@ class TemplateManager:
         self.progress_admins = []
         self.combo: Combo = None
         self.is_loading = False
+        # (number of templates processed, number of templates to load)
+        self.loading_progress = (0, 0)
+        # task checking the templates loaded from the cache
+        self.revalidation_task: asyncio.Task = None
+        self.progress_engine: ProgressEngine = None
 
     def load_progress_admins(self, bot_owner_id: int):
         """Update the current `progress_admins` list with the PROGRESS_ADMINS env variable
@@ -516,6 +541,7 @@ class TemplateManager:
         # save in db
         id = await db_templates.create_template(template)
         template.id = id
+        await cache_template(template)
         # save in list
         self.list.append(template)
         # update the @combo
@@ -656,6 +682,8 @@ class TemplateManager:
             )
         if not temp_id:
             raise ValueError("There was an error while updating the template.")
+        if new_url:
+            await cache_template(new_temp)
         old_temp_index = self.list.index(old_temp)
         self.list.remove(old_temp)
         self.list.insert(old_temp_index, new_temp)
@@ -681,51 +709,69 @@ class TemplateManager:
         return [t for t in self.list if t.hidden and t.owner_id == owner_id]
 
     async def load_all_templates(self, canvas_code, update=False):
-        """Load all the templates from the database in self.list"""
+        """Load all the templates from the database in self.list
+
+        The templates are downloaded concurrently (`TEMPLATE_LOAD_CONCURRENCY`
+        at a time and `TEMPLATE_LOAD_PER_HOST` per image host) and added in
+        self.list as soon as they are loaded, sorted by ID."""
         if self.is_loading:
             return
         self.is_loading = True
+        try:
+            await self._load_all_templates(canvas_code, update)
+        finally:
+            self.is_loading = False
+
+    async def _load_all_templates(self, canvas_code, update):
         start = time.time()
         db_list = await db_templates.get_all_templates(canvas_code)
         initial_len = len(self.list)
         has_combo = False
+        db_templates_to_load = []
         if stats.placemap_array is not None:
             for db_temp in db_list:
                 name = db_temp["name"]
-                owner_id = db_temp["owner_id"]
-                hidden = db_temp["hidden"]
-                url = db_temp["url"]
-                id = db_temp["id"]
-                if name != "@combo":
-                    if self.get_template(name, owner_id, hidden):
-                        if not update:
-                            logger.debug(
-                                f"Template {name} not loaded: Duplicate template."
-                            )
-                        continue
-                    try:
-                        temp = await asyncio.wait_for(
-                            get_template_from_url(url), timeout=5.0
-                        )
-                        temp.name = name
-                        temp.owner_id = int(owner_id)
-                        temp.hidden = bool(hidden)
-                        temp.canvas_code = canvas_code
-                        temp.id = id
-                        self.list.append(temp)
-                        logger.debug(
-                            f"template {temp.name} loaded ({len(self.list)}/{len(db_list)-1})"
-                        )
-                    except asyncio.TimeoutError:
-                        if not update:
-                            logger.warn(
-                                "Failed to load template {}: TimeoutError".format(name)
-                            )
-                    except Exception as e:
-                        if not update:
-                            logger.warn("Failed to load template {}: {}".format(name, e))
-                else:
+                if name == "@combo":
                     has_combo = True
+                elif self.get_template(name, db_temp["owner_id"], db_temp["hidden"]):
+                    if not update:
+                        logger.debug(f"Template {name} not loaded: Duplicate template.")
+                else:
+                    db_templates_to_load.append(db_temp)
+
+        self.loading_progress = (0, len(db_templates_to_load))
+
+        def add_template(db_temp, temp):
+            loaded, total = self.loading_progress
+            self.loading_progress = (loaded + 1, total)
+            if temp is None:
+                return
+            # the template could have been added while it was loading
+            if not self.get_template(temp.name, db_temp["owner_id"], temp.hidden):
+                self.insert_template(temp)
+            logger.debug(f"template {temp.name} loaded ({loaded + 1}/{total})")
+
+        # make the templates in the cache first, they are checked against
+        # their source in the background
+        db_templates_to_download = []
+        db_templates_to_revalidate = []
+        for db_temp in db_templates_to_load:
+            try:
+                temp = await get_cached_template(db_temp["url"])
+            except Exception as e:
+                logger.warn(f"Failed to load cached template {db_temp['name']}: {e}")
+                temp = None
+            if temp is None:
+                db_templates_to_download.append(db_temp)
+            else:
+                self.setup_db_template(temp, db_temp, canvas_code)
+                add_template(db_temp, temp)
+                db_templates_to_revalidate.append(db_temp)
+
+        await self.download_templates(
+            db_templates_to_download, canvas_code, add_template, update
+        )
+
         end = time.time()
         nb_templates = len(db_list) - (1 if has_combo else 0)
         if not update or (update and len(self.list) != initial_len):
@@ -737,7 +783,90 @@ class TemplateManager:
 
         # sort the list by id
         self.list.sort(key=lambda x: x.id)
-        self.is_loading = False
+
+        # only keep the templates still tracked in the cache
+        template_urls = [db_temp["url"] for db_temp in db_list]
+        palette_hash = get_current_palette_hash()
+        await asyncio.get_running_loop().run_in_executor(
+            None, template_cache.prune, template_urls, palette_hash
+        )
+
+        if db_templates_to_revalidate:
+            self.revalidation_task = asyncio.create_task(
+                self.revalidate_templates(db_templates_to_revalidate, canvas_code)
+            )
+
+    async def download_templates(self, db_list, canvas_code, callback, update=False):
+        """Download the templates of a list of database rows concurrently
+        (`TEMPLATE_LOAD_CONCURRENCY` at a time and `TEMPLATE_LOAD_PER_HOST` per
+        image host) and call `callback(db_temp, template)` for each of them
+        (the template is None if it couldn't be loaded)."""
+        semaphore = asyncio.Semaphore(TEMPLATE_LOAD_CONCURRENCY)
+        host_semaphores = {}
+
+        async def download_template(db_temp):
+            name = db_temp["name"]
+            host = get_template_host(db_temp["url"])
+            if host not in host_semaphores:
+                host_semaphores[host] = asyncio.Semaphore(TEMPLATE_LOAD_PER_HOST)
+            temp = None
+            try:
+                # wait for the host slot first to not hold a global slot while waiting
+                async with host_semaphores[host], semaphore:
+                    temp = await asyncio.wait_for(
+                        get_template_from_url(db_temp["url"]), timeout=5.0
+                    )
+                self.setup_db_template(temp, db_temp, canvas_code)
+                await cache_template(temp)
+            except asyncio.TimeoutError:
+                if not update:
+                    logger.warn("Failed to load template {}: TimeoutError".format(name))
+            except Exception as e:
+                temp = None
+                if not update:
+                    logger.warn("Failed to load template {}: {}".format(name, e))
+            callback(db_temp, temp)
+
+        await asyncio.gather(
+            *[download_template(db_temp) for db_temp in interleave_by_host(db_list)]
+        )
+
+    async def revalidate_templates(self, db_list, canvas_code):
+        """Download the templates made from the cache again and replace the ones
+        that changed."""
+        replaced = []
+
+        def replace_template(db_temp, temp):
+            if temp is None:
+                return
+            old_temp = next((t for t in self.list if t.id == temp.id), None)
+            if old_temp is None or (
+                old_temp.url == temp.url
+                and np.array_equal(old_temp.palettized_array, temp.palettized_array)
+            ):
+                return
+            self.list[self.list.index(old_temp)] = temp
+            replaced.append(temp.name)
+
+        await self.download_templates(db_list, canvas_code, replace_template, update=True)
+        if replaced:
+            logger.info(f"Templates updated from their source: {', '.join(replaced)}")
+            if self.combo is not None:
+                self.update_combo()
+
+    @staticmethod
+    def setup_db_template(temp: Template, db_temp, canvas_code):
+        """Set the attributes of a template loaded from a database row."""
+        temp.name = db_temp["name"]
+        temp.owner_id = int(db_temp["owner_id"])
+        temp.hidden = bool(db_temp["hidden"])
+        temp.canvas_code = canvas_code
+        temp.id = db_temp["id"]
+
+    def insert_template(self, template: Template):
+        """Add a template in self.list, keeping the list sorted by ID."""
+        index = bisect.bisect_right([t.id for t in self.list], template.id)
+        self.list.insert(index, template)
 
     def make_combo_image(self) -> np.ndarray:
         """Make an index array combining all the template arrays in self.list"""
@@ -763,16 +892,69 @@ class TemplateManager:
         else:
             self.combo.palettized_array = palettized_array
             # update the canvas code in case it changes
-            if canvas_code:
+            if canvas_code and canvas_code != self.combo.canvas_code:
                 self.combo.canvas_code = canvas_code
+                # the combo has a different ID for each canvas
+                self.combo.id = None
 
         # remove the non placeable pixels
         self.combo.palettized_array[stats.placemap_array == 255] = 255
         # update the placeable mask
         self.combo.placeable_mask = self.combo.make_placeable_mask()
         self.combo.total_placeable = int(np.sum(self.combo.placeable_mask))
+        # start tracking the progress of the new templates list
+        if stats.board_array is not None:
+            self.update_all_progress()
         return self.combo
 
+    def get_progress_engine(self) -> ProgressEngine:
+        """Get the progress engine of the current templates list, (re)build it
+        if the list or the canvas size changed."""
+        canvas_shape = stats.board_array.shape
+        if self.progress_engine is None or not self.progress_engine.matches(
+            self.list, canvas_shape
+        ):
+            self.progress_engine = ProgressEngine(self.list, canvas_shape)
+        return self.progress_engine
+
+    def update_all_progress(self, board_array=None) -> int:
+        """Update the progress of all the templates and of the combo with a single
+        pass over the board, return the combo progress.
+
+        The progress on the current board is kept up to date with the websocket
+        pixels (see `on_pixel()`) so it is only computed again when the templates
+        list or the board array changed.
+
+        This only updates the `current_progress` of the templates, their
+        `placed_mask` are computed with `Template.update_progress()` when needed."""
+        engine = self.get_progress_engine()
+        if board_array is not None and board_array is not stats.board_array:
+            progress, combo_progress = engine.compute(board_array)
+        else:
+            with stats.board_lock:
+                if not engine.is_tracking(stats.board_array, stats.board_version):
+                    engine.track(stats.board_array, stats.board_version)
+                progress, combo_progress = engine.progress, engine.combo_progress
+        for template, template_progress in zip(engine.templates, progress):
+            template.current_progress = int(template_progress)
+        if self.combo is not None:
+            self.combo.current_progress = combo_progress
+        return combo_progress
+
+    def on_pixel(self, x: int, y: int, old_color: int, new_color: int):
+        """Update the live progress of the templates covering a pixel placed on
+        the board (called from the websocket thread)."""
+        engine = self.progress_engine
+        if engine is None or not engine.is_tracking(
+            stats.board_array, stats.board_version
+        ):
+            # the progress isn't tracked on this board
+            return
+        for label in engine.update_pixel(x, y, old_color, new_color):
+            engine.templates[label].current_progress = int(engine.progress[label])
+        if self.combo is not None:
+            self.combo.current_progress = engine.combo_progress
+
     async def get_templates(self, templates_uris: list[str]) -> list[Template]:
         """Turn a list of strings (either template names or URLs) to a list of template.
 
@@ -831,6 +1013,27 @@ def fast_detemplatize(array, true_height, true_width, block_size):
     return result
 
 
+@jit(nopython=True, parallel=True, cache=True)
+def fast_detemplatize_parallel(array, true_height, true_width, block_size):
+    result = np.zeros((true_height, true_width, 4), dtype=np.uint8)
+    # the rows are independent: each thread detemplatizes different rows
+    for y in prange(true_height):
+        for x in range(true_width):
+            found = False
+            for j in range(block_size):
+                for i in range(block_size):
+                    py = y * block_size + j
+                    px = x * block_size + i
+                    if array[py, px, 3] > 128:
+                        result[y, x] = array[py, px]
+                        result[y, x, 3] = 255
+                        found = True
+                        break
+                if found:
+                    break
+    return result
+
+
 def detemplatize(img_raw: np.ndarray, true_width: int) -> np.ndarray:
     """
     Convert a styled template image back to its original version.
@@ -840,10 +1043,41 @@ def detemplatize(img_raw: np.ndarray, true_width: int) -> np.ndarray:
     block_size = img_raw.shape[1] // true_width
     true_height = img_raw.shape[0] // block_size
     img_array = np.array(img_raw, dtype=np.uint8)
-    img = fast_detemplatize(img_array, true_height, true_width, block_size)
+    use_parallel = img_array.shape[0] * img_array.shape[1] >= PARALLEL_MIN_PIXELS
+    if use_parallel and parallel_lock.acquire(blocking=False):
+        try:
+            img = fast_detemplatize_parallel(
+                img_array, true_height, true_width, block_size
+            )
+        finally:
+            parallel_lock.release()
+    else:
+        img = fast_detemplatize(img_array, true_height, true_width, block_size)
     return img
 
 
+def get_template_host(template_url: str) -> str:
+    """Get the host of the image of a template URL (empty if the URL is invalid)."""
+    params = parse_template(template_url)
+    if params is None:
+        return ""
+    return urlparse(params["template"]).netloc
+
+
+def interleave_by_host(db_templates: list) -> list:
+    """Reorder the templates to alternate between the hosts of their image,
+    keeping the order of the templates with the same host."""
+    hosts = {}
+    for db_temp in db_templates:
+        hosts.setdefault(get_template_host(db_temp["url"]), []).append(db_temp)
+    return [
+        db_temp
+        for batch in itertools.zip_longest(*hosts.values())
+        for db_temp in batch
+        if db_temp is not None
+    ]
+
+
 def parse_template(template_url: str):
     """Get the parameters from a template URL, return `None` if the template is invalid"""
     for e in ["http", "://", "template", "tw", "ox", "oy"]:
@@ -886,7 +1120,7 @@ async def get_template_from_url(template_url: str) -> Template:
         detemp_array = detemplatize(template_array, true_width)
         ox = int(params["ox"])
         oy = int(params["oy"])
-        return Template(
+        template = Template(
             template_url,
             image_url,
             params.get("title"),
@@ -895,12 +1129,51 @@ async def get_template_from_url(template_url: str) -> Template:
             oy,
             canvas_code,
         )
+        return template
 
     # run this part of the code in executor to make it not blocking
     template = await _get_template()
     return template
 
 
+async def cache_template(template: Template):
+    """Save the array of a tracked template in the template cache."""
+    await asyncio.get_running_loop().run_in_executor(
+        None,
+        template_cache.save,
+        template.url,
+        get_current_palette_hash(),
+        template.palettized_array,
+    )
+
+
+async def get_cached_template(template_url: str) -> Template:
+    """Make a Template object from the cached array of a template URL
+    (None if the template isn't in the cache)"""
+    params = parse_template(template_url)
+    if params is None:
+        return None
+    palettized_array = template_cache.load(template_url, get_current_palette_hash())
+    if palettized_array is None:
+        return None
+    canvas_code = await stats.get_canvas_code()
+    return Template(
+        template_url,
+        params["template"],
+        params.get("title"),
+        None,
+        int(params["ox"]),
+        int(params["oy"]),
+        canvas_code,
+        palettized_array=palettized_array,
+    )
+
+
+def get_current_palette_hash() -> str:
+    """Get the hash of the palette used to reduce the template images."""
+    return get_palette_hash([c["value"] for c in stats.get_palette()])
+
+
 def crop_array_to_shape(array1, height, width, oy, ox):
     y0 = min(max(0, oy), array1.shape[0])
     y1 = max(0, min(array1.shape[0], oy + height))
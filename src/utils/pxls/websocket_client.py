@@ -1,41 +1,111 @@
 import asyncio
 import json
 import threading
+import time
 import uuid
+from collections import deque
 
+import numpy as np
 import websockets
 
 from utils.log import get_logger
+from utils.pxls.pixel_journal import PixelJournal
 
 logger = get_logger("pxls_websocket")
 
+# time between 2 batches of pixels applied on the boards (in seconds)
+APPLY_INTERVAL = 0.05
+# time window used to compute the message rate (in seconds)
+RATE_WINDOW = 60
+# number of batches used to compute the apply latency
+LATENCY_WINDOW = 100
+
 
 class WebsocketClient:
     """A threaded websocket client to update the canvas board and online count
-    in real-time."""
+    in real-time.
+
+    The pixels received are buffered and applied on the boards in batches every
+    `APPLY_INTERVAL` seconds. While the client is paused (e.g. while the boards are
+    fetched again) the pixels are kept in the buffer and they are replayed on the
+    new boards when it is resumed."""
 
-    def __init__(self, uri: str, stats_manager):
+    def __init__(self, uri: str, stats_manager, journal: PixelJournal = None):
         self.uri = uri
         self.stats = stats_manager
+        # journal where the pixels applied are saved
+        self.journal = journal
         self.loop = asyncio.new_event_loop()
         self.thread = threading.Thread(target=self._start, daemon=True)
         self._paused = False
         self.status = False
+        # functions called with (x, y, old_color, new_color) for each pixel placed
+        self.pixel_listeners = []
+
+        # pixels received and not applied yet: list of (UNIX time received, pixels)
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._pending_event: asyncio.Event = None
+
+        # counters
+        self.messages_received = 0
+        self.pixels_received = 0
+        self.pixels_applied = 0
+        self.pixels_replayed = 0
+        self._message_times = deque()
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
 
     def start(self):
         """Start the websocket in a separate thread."""
         self.thread.start()
 
     def _start(self):
-        self.loop.run_until_complete(self._listen())
+        self.loop.run_until_complete(self._run())
 
     def pause(self):
-        """Pause the websocket."""
+        """Pause the websocket: the pixels received are kept until `resume()`."""
         self._paused = True
 
     def resume(self):
-        """Resume the websocket."""
+        """Resume the websocket and replay the pixels received during the pause."""
         self._paused = False
+        if self._pending_event is not None:
+            self.loop.call_soon_threadsafe(self._pending_event.set)
+
+    def add_pixel_listener(self, listener):
+        """Add a function called with (x, y, old_color, new_color) for every pixel
+        placed on the board, the function is called from the websocket thread."""
+        if listener not in self.pixel_listeners:
+            self.pixel_listeners.append(listener)
+
+    def get_message_rate(self) -> float:
+        """Get the number of messages received per second in the last
+        `RATE_WINDOW` seconds."""
+        # the times are pruned by the websocket thread
+        start = time.monotonic() - RATE_WINDOW
+        message_times = list(self._message_times)
+        return sum(1 for t in message_times if t >= start) / RATE_WINDOW
+
+    def get_apply_latency(self) -> tuple[float, float]:
+        """Get the average and maximum time (in seconds) between the reception of
+        a batch of pixels and its application on the boards, for the last
+        `LATENCY_WINDOW` batches."""
+        latencies = list(self._latencies)
+        if not latencies:
+            return 0.0, 0.0
+        return sum(latencies) / len(latencies), max(latencies)
+
+    def _prune_message_times(self, now: float):
+        while self._message_times and self._message_times[0] < now - RATE_WINDOW:
+            self._message_times.popleft()
+
+    async def _run(self):
+        self._pending_event = asyncio.Event()
+        applier = asyncio.ensure_future(self._apply_loop())
+        try:
+            await self._listen()
+        finally:
+            applier.cancel()
 
     async def _listen(self):
 
@@ -49,27 +119,111 @@ class WebsocketClient:
                     self.status = True
                     logger.info("Websocket connected")
                     async for message in websocket:
-                        while self._paused:
-                            pass
                         try:
-                            message_json = json.loads(message)
-
-                            if message_json["type"] == "pixel":
-                                pixels = message_json["pixels"]
-                                for pixel in pixels:
-                                    if self.stats.board_array is not None:
-                                        self.stats.update_board_pixel(**pixel)
-                                    if self.stats.virginmap_array is not None:
-                                        self.stats.update_virginmap_pixel(**pixel)
-                            if message_json["type"] == "users":
-                                count = message_json["count"]
-                                self.stats.online_count = count
-
+                            self._on_message(message)
                         except Exception:
                             logger.exception("Websocket client raised")
             except Exception as error:
                 self.status = False
                 self.stats.online_count = None
+                if self.journal is not None:
+                    # the pixels placed until the next keyframe are missed
+                    self.journal.mark_gap()
                 logger.debug(f"Websocket disconnected: {error}")
                 logger.debug("Attempting reconnect...")
                 await asyncio.sleep(1)
+
+    def _on_message(self, message):
+        now = time.monotonic()
+        self.messages_received += 1
+        self._message_times.append(now)
+        self._prune_message_times(now)
+
+        message_json = json.loads(message)
+        if message_json["type"] == "pixel":
+            pixels = message_json["pixels"]
+            self.pixels_received += len(pixels)
+            with self._pending_lock:
+                self._pending.append((time.time(), pixels))
+            if not self._paused:
+                self._pending_event.set()
+        if message_json["type"] == "users":
+            count = message_json["count"]
+            self.stats.online_count = count
+
+    async def _apply_loop(self):
+        """Apply the pending pixels in batches."""
+        replay = False
+        while True:
+            await self._pending_event.wait()
+            # let the next messages arrive to apply them in the same batch
+            await asyncio.sleep(APPLY_INTERVAL)
+            self._pending_event.clear()
+            if self._paused:
+                replay = True
+                continue
+            try:
+                self._apply_pending(replay)
+            except Exception:
+                logger.exception("Couldn't apply the websocket pixels")
+            replay = False
+
+    def _apply_pending(self, replay=False):
+        with self._pending_lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+        pixels = [pixel for _, message_pixels in pending for pixel in message_pixels]
+        nb_pixels = len(pixels)
+        xs = np.fromiter((p["x"] for p in pixels), dtype=np.int64, count=nb_pixels)
+        ys = np.fromiter((p["y"] for p in pixels), dtype=np.int64, count=nb_pixels)
+        colors = np.fromiter(
+            (p["color"] for p in pixels), dtype=np.int64, count=nb_pixels
+        )
+        timestamps = np.repeat(
+            np.array([int(t * 1000) for t, _ in pending], dtype=np.int64),
+            [len(message_pixels) for _, message_pixels in pending],
+        )
+
+        with self.stats.board_lock:
+            applied = self._apply_pixels(xs, ys, colors, timestamps)
+        # the journal is written without the lock to not make the board readers
+        # wait on the disk
+        if applied is not None and self.journal is not None:
+            self.journal.append(*applied)
+        self.pixels_applied += nb_pixels
+        if replay:
+            self.pixels_replayed += nb_pixels
+            logger.debug(f"{nb_pixels} pixels received during the pause replayed")
+        self._latencies.append(time.time() - pending[0][0])
+
+    def _apply_pixels(
+        self, xs: np.ndarray, ys: np.ndarray, colors: np.ndarray, timestamps: np.ndarray
+    ):
+        """Update the boards with a batch of pixels and notify the pixel listeners.
+
+        :return: the (timestamps, xs, ys, colors) of the pixels applied or None if
+        there is no board"""
+        board = self.stats.board_array
+        if board is None:
+            board = self.stats.virginmap_array
+        if board is None:
+            return None
+        height, width = board.shape
+        valid = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+        if not valid.all():
+            logger.debug(f"{np.count_nonzero(~valid)} pixels out of the board ignored")
+            xs, ys, colors = xs[valid], ys[valid], colors[valid]
+            timestamps = timestamps[valid]
+
+        if self.stats.board_array is not None:
+            old_colors = self.stats.update_board_pixels(xs, ys, colors)
+            if self.pixel_listeners:
+                for x, y, old_color, color in zip(
+                    xs.tolist(), ys.tolist(), old_colors.tolist(), colors.tolist()
+                ):
+                    for listener in self.pixel_listeners:
+                        listener(x, y, old_color, color)
+        if self.stats.virginmap_array is not None:
+            self.stats.update_virginmap_pixels(xs, ys)
+        return timestamps, xs, ys, colors
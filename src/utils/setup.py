@@ -11,7 +11,9 @@ from database.db_template_manager import DbTemplateManager
 from database.db_user_manager import DbUserManager
 from utils.image.imgur import Imgur
 from utils.image.s3compat import S3Compat
+from utils.pxls.pixel_journal import PixelJournal
 from utils.pxls.pxls_stats_manager import PxlsStatsManager
+from utils.pxls.snapshot_store import SnapshotStore
 from utils.pxls.websocket_client import WebsocketClient
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
@@ -35,7 +37,8 @@ stats = PxlsStatsManager(db_conn, PXLS_URL_API)
 DEFAULT_PREFIX = ">"
 
 # database managers
-db_stats = DbStatsManager(db_conn, stats)
+STATS_DELTA_INGESTION = os.getenv("STATS_DELTA_INGESTION", "").lower() == "true"
+db_stats = DbStatsManager(db_conn, stats, delta_ingestion=STATS_DELTA_INGESTION)
 db_servers = DbServersManager(db_conn, DEFAULT_PREFIX)
 db_users = DbUserManager(db_conn)
 db_templates = DbTemplateManager(db_conn)
@@ -43,7 +46,16 @@ db_canvas = DbCanvasManager(db_conn)
 
 # websocket
 ws_uri = os.getenv("PXLS_WEBSOCKET")
-ws_client = WebsocketClient(ws_uri, stats)
+PIXEL_JOURNAL = os.getenv("PIXEL_JOURNAL", "true").lower() == "true"
+pixel_journal = PixelJournal(enabled=PIXEL_JOURNAL)
+ws_client = WebsocketClient(ws_uri, stats, journal=pixel_journal)
+
+# local copy of the canvas snapshots
+SNAPSHOT_RETENTION_DAYS = int(os.getenv("SNAPSHOT_RETENTION_DAYS", "30"))
+snapshot_store = SnapshotStore(retention_days=SNAPSHOT_RETENTION_DAYS)
+
+# number of processes hashing the canvas logs (default to the number of CPUs)
+LOG_HASH_WORKERS = int(os.getenv("LOG_HASH_WORKERS") or os.cpu_count() or 1)
 
 # guild IDs
 test_server_id = os.getenv("TEST_SERVER_ID")
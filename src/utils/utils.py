@@ -3,6 +3,7 @@ from __future__ import annotations
 import asyncio
 import base64
 import functools
+import json
 import re
 import timeit
 from typing import Awaitable, Callable, Optional, TypeVar
@@ -12,6 +13,8 @@ import numpy as np
 from aiohttp.client_exceptions import ClientConnectionError, InvalidURL
 from typing_extensions import ParamSpec
 
+from utils.http_client import get_http_client
+
 T = TypeVar("T")
 P = ParamSpec("P")
 _MaybeEventLoop = Optional[asyncio.AbstractEventLoop]
@@ -21,15 +24,20 @@ class BadResponseError(Exception):
     """Raised when response code isn't 200."""
 
 
-async def get_content(url: str, content_type, **kwargs):
+async def get_content(url: str, content_type, max_size=-1, **kwargs):
     """Send a GET request to the url and return the response as json or bytes.
-    Raise BadResponseError or ValueError."""
+    Raise BadResponseError or ValueError.
+
+    The request is sent with the shared HTTP client (see `utils.http_client`),
+    `max_size` is the maximum size of the response (None for no limit) and
+    the `headers` and `cookies` can be given in the kwargs."""
     # check if the URL is a data URL
     data = check_data_url(url)
     # set headers for user-agent
     headers = {
-            'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36'
-        }
+        **kwargs.get("headers", {}),
+        'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36'
+    }
     if content_type == "image":
         if url.startswith('https://imgur.com/'):
             reurl = re.search(r'https://imgur\.com/([^?#]*)', url)
@@ -40,28 +48,27 @@ async def get_content(url: str, content_type, **kwargs):
     timeout = aiohttp.ClientTimeout(
         sock_connect=10.0, sock_read=10.0
     )  # set a timeout of 10 seconds
-    async with aiohttp.ClientSession(timeout=timeout, **kwargs) as session:
-        try:
-            async with session.get(url, headers=headers) as r:
-                if r.status == 200:
-                    if content_type == "json":
-                        return await r.json()
-                    if content_type == "bytes":
-                        return await r.read()
-                    if content_type == "image":
-                        content_type = r.headers["content-type"]
-                        if "image" not in content_type:
-                            raise ValueError("The URL doesn't contain any image.")
-                        else:
-                            return await r.read()
-                else:
-                    raise BadResponseError(f"The URL leads to an error {r.status}")
-        except InvalidURL:
-            raise ValueError("The URL provided is invalid.")
-        except asyncio.TimeoutError:
-            raise ValueError("Couldn't connect to URL. (Timeout)")
-        except ClientConnectionError:
-            raise ValueError("Couldn't connect to URL.")
+    http_client = get_http_client()
+    try:
+        async with http_client.request(
+            "GET", url, headers=headers, cookies=kwargs.get("cookies"), timeout=timeout
+        ) as r:
+            if r.status == 200:
+                if content_type == "image":
+                    if "image" not in r.headers.get("content-type", ""):
+                        raise ValueError("The URL doesn't contain any image.")
+                content = await http_client.read(r, max_size)
+                if content_type == "json":
+                    return json.loads(content)
+                return content
+            else:
+                raise BadResponseError(f"The URL leads to an error {r.status}")
+    except InvalidURL:
+        raise ValueError("The URL provided is invalid.")
+    except asyncio.TimeoutError:
+        raise ValueError("Couldn't connect to URL. (Timeout)")
+    except ClientConnectionError:
+        raise ValueError("Couldn't connect to URL.")
 
 
 def check_data_url(url):